@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+批量注册/删除基准测试
+对比逐个 save_app_config/delete_app_config 与 register_many/delete_many 的耗时
+
+用法: python benchmarks/bench_bulk_register.py [sqlite|json]
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from loguru import logger
+
+from am3.config.manager import ConfigManager
+
+logger.remove()
+
+
+def make_configs(count):
+    return [{
+        'start': f'/opt/bench/app-{i}',
+        'name': f'app-{i}',
+        'working_directory': '/opt/bench',
+    } for i in range(count)]
+
+
+def bench(backend, count, bulk):
+    """返回 (注册耗时, 删除耗时)"""
+    home = tempfile.mkdtemp(prefix='am3-bench-')
+    os.environ['HOME'] = home
+    try:
+        config_manager = ConfigManager(state_backend=backend)
+        app_configs = make_configs(count)
+
+        begin = time.perf_counter()
+        if bulk:
+            _, app_ids = config_manager.register_many(app_configs)
+        else:
+            app_ids = [config_manager.save_app_config(app_config)[1] for app_config in app_configs]
+        register_elapsed = time.perf_counter() - begin
+
+        begin = time.perf_counter()
+        if bulk:
+            config_manager.delete_many(app_ids)
+        else:
+            for app_id in app_ids:
+                config_manager.delete_app_config(app_id)
+        delete_elapsed = time.perf_counter() - begin
+        return register_elapsed, delete_elapsed
+    finally:
+        shutil.rmtree(home)
+
+
+def main():
+    backend = sys.argv[1] if len(sys.argv) > 1 else 'sqlite'
+    print(f'存储后端: {backend}')
+    print(f"{'应用数量':<8}{'逐个注册(ms)':>14}{'批量注册(ms)':>14}{'逐个删除(ms)':>14}{'批量删除(ms)':>14}")
+    for count in (10, 100, 1000):
+        single = bench(backend, count, bulk=False)
+        bulk = bench(backend, count, bulk=True)
+        print(f'{count:<12}{single[0] * 1000:>14.1f}{bulk[0] * 1000:>14.1f}'
+              f'{single[1] * 1000:>14.1f}{bulk[1] * 1000:>14.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+应用运行状态检查基准测试
+对比逐个应用检查进程身份和一次进程表快照解析所有应用的耗时
+
+用法: python benchmarks/bench_liveness.py [应用数量] [运行中的应用数量]
+"""
+import os
+import sys
+import time
+import tempfile
+import subprocess
+
+# 使用临时目录作为 HOME，不影响真实的 ~/.am3
+os.environ['HOME'] = tempfile.mkdtemp(prefix='am3-bench-')
+
+from loguru import logger
+
+from am3.config.manager import ConfigManager
+from am3.core.app_manager import AppManager
+from am3.utils.process_util import process_identity
+
+logger.remove()
+
+
+def register_apps(config_manager, count, running):
+    """注册测试应用，前 running 个应用指向真实的进程，其余应用的进程已经退出"""
+    processes = [subprocess.Popen(['sleep', '600']) for _ in range(running)]
+    _, app_ids = config_manager.register_many([{
+        'start': f'/opt/bench/app-{i}',
+        'name': f'app-{i}',
+        'working_directory': '/opt/bench',
+    } for i in range(count)])
+
+    def set_processes(txn):
+        for i, app_id in enumerate(app_ids):
+            app = txn.get_app(app_id)
+            if i < running:
+                app['process'] = process_identity(processes[i].pid)
+            else:
+                app['process'] = {'pid': 4000000 + i, 'create_time': 0, 'cmdline_hash': ''}
+            txn.put_app(app_id, app)
+
+    config_manager.mutate(set_processes)
+    return processes
+
+
+def timeit(fn, rounds=5):
+    """多次执行取最短耗时"""
+    best = None
+    for _ in range(rounds):
+        begin = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - begin
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    running = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+    config_manager = ConfigManager()
+    app_manager = AppManager(config_manager)
+    processes = register_apps(config_manager, count, running)
+    try:
+        apps = config_manager.get_status_data()['apps']
+
+        per_app = timeit(lambda: [app_manager.check_app_running(app) for app in apps.values()])
+        snapshot = timeit(lambda: app_manager.get_app_statuses(apps))
+
+        statuses = app_manager.get_app_statuses(apps)
+        assert sum(status['running'] for status in statuses.values()) == running
+    finally:
+        for process in processes:
+            process.kill()
+            process.wait()
+
+    print(f'应用数量: {count}, 运行中: {running}')
+    print(f'逐个检查:     {per_app * 1000:8.1f} ms')
+    print(f'进程表快照:   {snapshot * 1000:8.1f} ms')
+    print(f'加速比:       {per_app / snapshot:8.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+应用监控方式基准测试
+对比每个应用一个监控进程和 supervisor 守护进程的监控引擎(一个事件循环)监控 N 个应用时，
+监控本身占用的内存(RSS/USS)、CPU 时间和上下文切换次数，不包括应用进程
+
+每个应用是一个每 0.2 秒输出一行的 shell 循环
+
+用法: python benchmarks/bench_monitor_engine.py [应用数量] [测量秒数]
+"""
+import os
+import sys
+import json
+import time
+import signal
+import asyncio
+import tempfile
+import subprocess
+
+# 使用临时目录作为 HOME，不影响真实的 ~/.am3
+os.environ['HOME'] = tempfile.mkdtemp(prefix='am3-bench-')
+
+import psutil
+from loguru import logger
+
+logger.remove()
+
+# 等待监控进程完成启动和导入，不计入测量
+WARMUP = 5
+
+
+def app_configs(count, logs_path):
+    return [{
+        'name': f'app-{i}',
+        'start': '/bin/sh',
+        'params': "-c 'while :; do echo tick; sleep 0.2; done'",
+        'working_directory': '/tmp',
+        'app_log_path': os.path.join(logs_path, f'app-{i}.log'),
+        'metrics_interval': 0,
+        'restart_keyword': ['never-matches'],
+    } for i in range(count)]
+
+
+def run_engine(count):
+    """子进程: 在一个事件循环中监控所有应用，收到 SIGTERM 后退出"""
+    from am3.config.manager import ConfigManager
+    from am3.process.engine import MonitorEngine
+
+    config_manager = ConfigManager()
+    _, app_ids = config_manager.register_many(app_configs(count, config_manager.am3_logs_path))
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        engine = MonitorEngine(config_manager, loop)
+        for app_id in app_ids:
+            engine._start(app_id, config_manager.get_app_config(app_id), None)
+        stopping = asyncio.Event()
+        loop.add_signal_handler(signal.SIGTERM, stopping.set)
+        await stopping.wait()
+
+    asyncio.run(main())
+
+
+def start_monitors(count):
+    """每个应用一个监控进程，和 am start 不使用守护进程时相同"""
+    data_path = os.path.join(os.environ['HOME'], '.am3')
+    logs_path = os.path.join(data_path, 'logs')
+    os.makedirs(logs_path, exist_ok=True)
+    return [subprocess.Popen(
+        [sys.executable, '-m', 'am3.process.monitor', json.dumps({
+            'app_id': str(i), 'data_path': data_path, 'app_config': app_config, 'cgroup': None,
+        })],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True,
+    ) for i, app_config in enumerate(app_configs(count, logs_path))]
+
+
+def usage(processes):
+    """监控进程的 CPU 时间、上下文切换次数之和"""
+    cpu = switches = 0
+    for process in processes:
+        times = process.cpu_times()
+        cpu += times.user + times.system
+        ctx = process.num_ctx_switches()
+        switches += ctx.voluntary + ctx.involuntary
+    return cpu, switches
+
+
+def measure(name, processes, duration):
+    processes = [psutil.Process(process.pid) for process in processes]
+    time.sleep(WARMUP)
+    cpu_begin, switches_begin = usage(processes)
+    time.sleep(duration)
+    cpu_end, switches_end = usage(processes)
+    rss = uss = 0
+    for process in processes:
+        memory = process.memory_full_info()
+        rss += memory.rss
+        uss += memory.uss
+    cpu = cpu_end - cpu_begin
+    print(f'{name:<10} 进程数: {len(processes):>4}  RSS: {rss / 1048576:8.1f} MB  USS: {uss / 1048576:8.1f} MB  '
+          f'CPU: {cpu:6.2f} s ({cpu / duration * 100:5.1f}%)  上下文切换: {switches_end - switches_begin}')
+
+
+def stop(processes, app_groups):
+    for pgid in app_groups:
+        try:
+            os.killpg(pgid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    for process in processes:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    duration = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    print(f'应用数量: {count}, 测量 {duration} 秒')
+
+    monitors = start_monitors(count)
+    try:
+        measure('监控进程', monitors, duration)
+    finally:
+        # 监控进程是进程组组长，应用在同一个进程组中
+        stop([], [monitor.pid for monitor in monitors])
+        for monitor in monitors:
+            monitor.wait()
+
+    engine = subprocess.Popen([sys.executable, __file__, '--engine', str(count)])
+    try:
+        measure('监控引擎', [engine], duration)
+    finally:
+        # 应用在各自的进程组中
+        stop([engine], [child.pid for child in psutil.Process(engine.pid).children()])
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == '--engine':
+        run_engine(int(sys.argv[2]))
+    else:
+        main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+应用状态表基准测试
+对比 get_app_list() 读取 supervisor 守护进程发布的状态表(mmap)和遍历进程表、读取状态存储的耗时，
+以及守护进程发布一次状态表的耗时
+
+用法: python benchmarks/bench_status_board.py [应用数量] [读取次数]
+"""
+import os
+import sys
+import time
+import tempfile
+import subprocess
+
+# 使用临时目录作为 HOME，不影响真实的 ~/.am3
+os.environ['HOME'] = tempfile.mkdtemp(prefix='am3-bench-')
+
+from loguru import logger
+
+from am3.config.manager import ConfigManager
+from am3.core.app_manager import AppManager
+from am3.core.status_board import StatusPublisher
+from am3.utils.process_util import process_identity
+
+logger.remove()
+
+
+def timed(name, fn, repeat):
+    fn()
+    begin = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    elapsed = (time.perf_counter() - begin) / repeat
+    print(f'{name:<28} {elapsed * 1e6:10.1f} us')
+    return elapsed
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    config_manager = ConfigManager()
+    # 每个应用指向一个真实的进程，和守护进程管理的应用一样记录进程身份
+    processes = [subprocess.Popen(['sleep', '600']) for _ in range(count)]
+    _, app_ids = config_manager.register_many([{
+        'name': f'app-{i}',
+        'start': f'/opt/app-{i}/run.sh',
+        'working_directory': '/tmp',
+    } for i in range(count)])
+    for app_id, process in zip(app_ids, processes):
+        config_manager.set_app_process(app_id, process_identity(process.pid, ['sleep', '600']))
+    app_manager = AppManager(config_manager)
+
+    # 在当前进程中发布，读取方检查写入方 PID 时视为守护进程在运行
+    publisher = StatusPublisher(app_manager)
+    print(f'应用数量: {count}, 读取 {repeat} 次')
+    timed('发布状态表', publisher.publish, 20)
+    assert app_manager.get_app_list() == app_manager.get_app_list(use_board=False)
+
+    board = timed('get_app_list (状态表)', app_manager.get_app_list, repeat)
+    store = timed('get_app_list (进程表)', lambda: app_manager.get_app_list(use_board=False), max(repeat // 10, 1))
+    print(f'加速: {store / board:.0f}x')
+    publisher.close()
+
+    for process in processes:
+        process.kill()
+        process.wait()
+
+
+if __name__ == '__main__':
+    main()
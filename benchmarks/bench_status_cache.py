@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+状态缓存基准测试
+统计每个命令调用 get_status_data 的次数(没有缓存时每次都要解析)和实际解析次数
+
+用法: python benchmarks/bench_status_cache.py [应用数量]
+"""
+import os
+import sys
+import time
+import tempfile
+
+# 使用临时目录作为 HOME，不影响真实的 ~/.am3
+os.environ['HOME'] = tempfile.mkdtemp(prefix='am3-bench-')
+
+from loguru import logger
+
+from am3.cli.commands import cli
+from am3.cli.context import LazyContext
+from am3.config.manager import ConfigManager
+
+logger.remove()
+
+
+def register_apps(count):
+    """注册测试应用"""
+    config_manager = ConfigManager()
+    for i in range(count):
+        config_manager.save_app_config({
+            'start': f'/opt/bench/app-{i}',
+            'name': f'app-{i}',
+            'working_directory': '/opt/bench',
+            'app_log_path': f'/tmp/app-{i}.log',
+        })
+
+
+def run_command(args):
+    """执行一个命令，返回 (调用次数, 解析次数, 耗时)"""
+    obj = LazyContext()
+    begin = time.perf_counter()
+    cli.main(args, obj=obj, standalone_mode=False)
+    elapsed = time.perf_counter() - begin
+    config_manager = obj['config_manager']
+    return config_manager.status_read_count, config_manager.status_parse_count, elapsed
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    register_apps(count)
+
+    results = []
+    # 输出重定向，只打印统计结果
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        for args in (['list'], ['list', '--all'], ['save'], ['list']):
+            results.append((' '.join(args), *run_command(args)))
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    print(f'应用数量: {count}')
+    print(f"{'命令':<12}{'无缓存解析次数':>16}{'缓存后解析次数':>16}{'耗时(ms)':>12}")
+    for name, reads, parses, elapsed in results:
+        print(f'{name:<12}{reads:>16}{parses:>16}{elapsed * 1000:>12.1f}')
+
+
+if __name__ == '__main__':
+    main()
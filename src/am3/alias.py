@@ -2,14 +2,18 @@ alias_dict = {
     # 命令的alias设置
     'delete': ('del', 'dele', 'delete'),
     'help': ('h', 'help', '-h', '--help'),
+    'history': ('his', 'history'),
     'list': ('l', 'ls', 'lis', 'list'),
     'load': ('ld', 'load',),
     'log': ('log', 'logs'),
     'restart': ('re', 'res', 'restart',),
     'save': ('sav', 'save'),
+    'scale': ('sc', 'scale'),
     'start': ('st', 'star', 'start',),
     'startup': ('startup',),
+    'stats': ('stat', 'stats'),
     'stop': ('sto', 'stop'),
+    'top': ('top',),
     # api 命令
     'api': ('api',),
     'init': ('init',),
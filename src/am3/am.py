@@ -4,14 +4,12 @@
 AM3 - 应用管理工具
 主入口文件
 """
-import os
 import re
 import sys
-from loguru import logger
 
 from am3.cli.commands import cli
 from am3.cli.alias_commands import process_args
-from am3.config.manager import ConfigManager
+from am3.cli.context import LazyContext
 
 
 def main():
@@ -24,14 +22,8 @@ def main():
     if new_args:
         sys.argv[1:] = new_args
 
-    # 初始化配置
-    config_manager = ConfigManager()
-
-    # 设置日志
-    logger.add(config_manager.am3_log_path, rotation="10 MB")
-
-    # 执行命令行接口
-    cli(obj={})
+    # 执行命令行接口，配置和日志文件在命令用到时才初始化
+    cli(obj=LazyContext())
 
 
 if __name__ == '__main__':
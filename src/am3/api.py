@@ -1,11 +1,12 @@
 import asyncio
 import os
+import threading
 import time
 
 import socketio
 import urllib3
-from am3.cmdline import get_status_data, get_app_list, get_app_id_by_uuid
-from am3.settings import am3_data_path, am3_pids_path
+from am3.config.manager import ConfigManager
+from am3.core.app_manager import AppManager
 from loguru import logger
 from watchdog.events import PatternMatchingEventHandler
 from watchdog.observers import Observer
@@ -15,7 +16,11 @@ urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 def push_app_list():
     print('主动推送app列表')
-    app_list = get_app_list()
+    emit_app_list()
+
+
+def emit_app_list(use_board=True):
+    app_list = app_manager.get_app_list(use_board=use_board)
     data = {
         'api_token': api_token,
         'app_list': app_list,
@@ -23,14 +28,32 @@ def push_app_list():
     sio.emit('recieve_app_list', {'data': data}, namespace=namespace)
 
 
+def push_app_events():
+    """状态日志中有新增的事件时推送最新的应用列表，只读取日志新增的部分
+
+    控制中心使用 recieve_app_list，新增的事件另外通过 recieve_app_events 推送
+    """
+    global journal_position
+    with journal_lock:
+        events, journal_position = config_manager.journal.read_new_events(journal_position)
+    if not events:
+        return
+    # 状态日志只记录事件，运行状态以进程为准，这里不使用有延迟的状态表
+    emit_app_list(use_board=False)
+    data = {
+        'api_token': api_token,
+        'events': events,
+    }
+    sio.emit('recieve_app_events', {'data': data}, namespace=namespace)
+
+
 def on_file_modified(event):
-    print(f"{event.src_path} 被修改")
-    push_app_list()
+    push_app_events()
 
 
 def on_file_deleted(event):
     print(f"{event.src_path} 被删除")
-    push_app_list()
+    push_app_events()
 
 
 def init_event_handler(watch_patterns, on_modified, on_deleted):
@@ -54,14 +77,10 @@ def init_observer(event_handler, watch_path):
     my_observer.start()
 
 
-def observer_status_json():
-    event_handler = init_event_handler(["status.json", ], on_file_modified, on_file_deleted)
-    init_observer(event_handler, am3_data_path)
-
-
-def observer_pids():
-    event_handler = init_event_handler(["*.pid", ], on_file_modified, on_file_deleted)
-    init_observer(event_handler, am3_pids_path)
+def observer_journal():
+    # 应用的注册、启动、退出、停止、删除都会追加到状态日志，只读取新增的部分
+    event_handler = init_event_handler(["journal.log", ], on_file_modified, on_file_deleted)
+    init_observer(event_handler, config_manager.am3_data_path)
 
 
 class AmConnect(socketio.ClientNamespace):
@@ -84,13 +103,13 @@ class AmConnect(socketio.ClientNamespace):
     def on_start_node_app(self, message):
         print('接收到启动app的命令')
         app_uuid = message['data']['uuid']
-        app_id = get_app_id_by_uuid(app_uuid)
+        app_id = config_manager.get_app_id_by_uuid(app_uuid)
         os.system(f'am start {app_id}')
 
     def on_stop_node_app(self, message):
         print('接收到停止app的命令')
         app_uuid = message['data']['uuid']
-        app_id = get_app_id_by_uuid(app_uuid)
+        app_id = config_manager.get_app_id_by_uuid(app_uuid)
         os.system(f'am stop {app_id}')
 
 
@@ -128,15 +147,21 @@ if __name__ == '__main__':
     sio = socketio.Client(ssl_verify=False)
     # sio = socketio.Client()
 
-    status_data = get_status_data()
+    config_manager = ConfigManager()
+    app_manager = AppManager(config_manager)
+
+    status_data = config_manager.get_status_data()
     api_status_data = status_data['api']
     api_token = api_status_data['api_token']
     namespace = api_status_data['namespace']
     server_address = api_status_data['server_address']
     socketio_path = api_status_data['socketio_path']
 
+    # 状态日志的读取位置，从启动时的末尾开始，之前的状态由服务端请求时推送完整列表
+    journal_position = config_manager.journal.read_new_events()[1]
+    journal_lock = threading.Lock()
+
     # 启动文件监控
-    observer_status_json()
-    observer_pids()
+    observer_journal()
 
     start_server()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+supervisor 守护进程的客户端
+守护进程在运行时，am 命令通过 ~/.am3/am3.sock 把命令交给它执行，输出原样转发到终端；
+守护进程没有运行时返回None，命令照常在当前进程执行
+
+协议: 每条消息是一行 JSON。客户端发送一个请求(带上工作目录和环境变量)，守护进程返回若干条 {"out": ...} / {"err": ...} 输出，
+最后一条消息带 rc(退出码)
+"""
+import os
+import sys
+import json
+import time
+import socket
+import subprocess
+
+from am3.utils.path_util import format_path
+
+SOCKET_NAME = 'am3.sock'
+# 等待守护进程启动的秒数
+DAEMON_WAIT = 10
+# 等待守护进程退出的秒数，使用监控引擎时它要先停止所有应用
+DAEMON_STOP_WAIT = 60
+
+
+def get_socket_path():
+    return os.path.join(format_path('~/.am3'), SOCKET_NAME)
+
+
+def request(message, socket_path=None):
+    """发送一个请求，逐条返回守护进程的响应，守护进程没有运行时抛出 OSError"""
+    socket_path = socket_path or get_socket_path()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(message, ensure_ascii=False).encode('utf-8') + b'\n')
+        with sock.makefile('r', encoding='utf-8') as responses:
+            for line in responses:
+                yield json.loads(line)
+
+
+def ping(socket_path=None):
+    """守护进程的信息，没有运行时返回None"""
+    socket_path = socket_path or get_socket_path()
+    if not os.path.exists(socket_path):
+        return None
+    try:
+        for response in request({'op': 'ping'}, socket_path):
+            return response
+    except (OSError, ValueError):
+        return None
+    return None
+
+
+def run_command(argv, socket_path=None):
+    """让守护进程执行一条 am 命令，返回退出码，守护进程没有运行时返回None"""
+    socket_path = socket_path or get_socket_path()
+    # 没有 socket 文件时不需要尝试连接，不影响没有使用守护进程的命令
+    if not os.path.exists(socket_path):
+        return None
+    # 守护进程启动的应用使用客户端的工作目录和环境变量，和不使用守护进程时一样
+    message = {'op': 'run', 'argv': argv, 'cwd': os.getcwd(), 'env': dict(os.environ),
+               'color': sys.stdout.isatty()}
+    responses = request(message, socket_path)
+    try:
+        response = next(responses)
+    except (OSError, StopIteration):
+        # socket 文件残留，守护进程已经退出
+        return None
+
+    while 'rc' not in response:
+        stream = sys.stderr if 'err' in response else sys.stdout
+        stream.write(response.get('out') or response.get('err') or '')
+        stream.flush()
+        try:
+            response = next(responses)
+        except (OSError, StopIteration):
+            sys.stderr.write("错误: 与 supervisor 守护进程的连接已断开\n")
+            return 1
+    return response['rc']
+
+
+def _is_running(pid):
+    """进程是否还在运行，已经退出但还没有被回收的僵尸进程也算退出"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            return f.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except (OSError, IndexError):
+        return True
+
+
+def start_daemon(socket_path=None, use_engine=False):
+    """在后台启动守护进程，返回守护进程的信息，启动失败时返回None
+
+    use_engine 为True时应用由守护进程的监控引擎直接监控，不再为每个应用启动监控进程
+    """
+    socket_path = socket_path or get_socket_path()
+    info = ping(socket_path)
+    if info:
+        return info
+    args = ['--engine'] if use_engine else []
+    subprocess.Popen(
+        [sys.executable, '-m', 'am3.cli.supervisor'] + args + [socket_path],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        cwd='/',
+        start_new_session=True,
+    )
+    deadline = time.monotonic() + DAEMON_WAIT
+    while time.monotonic() < deadline:
+        info = ping(socket_path)
+        if info:
+            return info
+        time.sleep(0.05)
+    return None
+
+
+def stop_daemon(socket_path=None):
+    """停止守护进程，返回是否已经停止"""
+    socket_path = socket_path or get_socket_path()
+    info = ping(socket_path)
+    if not info:
+        return True
+    try:
+        for _ in request({'op': 'shutdown'}, socket_path):
+            pass
+    except OSError:
+        pass
+    deadline = time.monotonic() + DAEMON_STOP_WAIT
+    while time.monotonic() < deadline:
+        if not _is_running(info['pid']):
+            return True
+        time.sleep(0.05)
+    return False
+
+
+if __name__ == '__main__':
+    print(get_socket_path(), ping())
@@ -6,13 +6,15 @@
 """
 import os
 import sys
+import time
 import click
 from loguru import logger
 
-from am3.config.manager import ConfigManager
-from am3.core.app_manager import AppManager
-from am3.process.process_manager import ProcessManager
+from am3.cli import client
 from am3.cli.alias_commands import setup_aliases
+from am3.cli.context import LazyContext
+from am3.utils.output_util import OUTPUT_FORMATS
+from am3.utils.path_util import resolve_path
 from am3.version import __version__
 
 
@@ -24,23 +26,51 @@ def cli(ctx):
 
     用于管理和监控应用程序的运行。
     """
-    # 确保 context 对象存在
-    ctx.ensure_object(dict)
-    # 初始化配置管理器
-    ctx.obj['config_manager'] = ConfigManager()
-    # 初始化应用管理器
-    ctx.obj['app_manager'] = AppManager(ctx.obj['config_manager'])
-    # 初始化进程管理器
-    ctx.obj['process_manager'] = ProcessManager(ctx.obj['config_manager'])
+    # 确保 context 对象存在，配置管理器、应用管理器、进程管理器在命令用到时才创建
+    ctx.ensure_object(LazyContext)
+
+
+def forward_to_supervisor(ctx):
+    """supervisor 守护进程在运行时把命令交给它执行，返回True表示已经执行，守护进程没有运行时返回False"""
+    if ctx.obj.get('supervisor'):
+        # 已经在守护进程中
+        return False
+    rc = client.run_command(sys.argv[1:])
+    if rc is None:
+        return False
+    if rc:
+        sys.exit(rc)
+    return True
 
 
 @cli.command('list', short_help='列出所有应用')
 @click.option('-a', '--all', is_flag=True, help='显示所有详细信息')
+@click.option('-w', '--watch', is_flag=True, help='持续刷新应用的资源占用，和 am top 相同')
+@click.option('-i', '--interval', type=float, default=2.0, help='刷新间隔(秒)')
+@click.option('--format', 'output_format', type=click.Choice(OUTPUT_FORMATS), help='机器可读的输出格式')
 @click.pass_context
-def list_apps(ctx, all):
+def list_apps(ctx, all, watch, interval, output_format):
     """列出所有已注册的应用"""
+    if not watch and not ctx.obj.get('supervisor'):
+        # 守护进程发布的状态表有效时直接读取，不经过 socket 也不遍历进程表
+        if ctx.obj['app_manager'].list_apps(show_details=all, output_format=output_format, board_only=True):
+            return
+        if forward_to_supervisor(ctx):
+            return
     app_manager = ctx.obj['app_manager']
-    app_manager.list_apps(show_details=all)
+    if watch:
+        app_manager.watch_apps(interval)
+    else:
+        app_manager.list_apps(show_details=all, output_format=output_format)
+
+
+@cli.command('top', short_help='实时查看应用的资源占用')
+@click.option('-i', '--interval', type=float, default=2.0, help='刷新间隔(秒)')
+@click.pass_context
+def top_apps(ctx, interval):
+    """实时查看每个应用整个进程树的 CPU、内存、线程数、文件描述符和运行时间"""
+    app_manager = ctx.obj['app_manager']
+    app_manager.watch_apps(interval)
 
 
 @cli.command('start', short_help='启动应用')
@@ -57,17 +87,43 @@ def list_apps(ctx, all):
 @click.option('--restart-check-delay', type=int, default=0, help='重启关键字检测延迟(秒)')
 @click.option('--restart-keyword', multiple=True, help='如出现关键字则自动重启，多个关键字可重复使用此选项')
 @click.option('--restart-keyword-regex', multiple=True, help='如出现正则关键字则自动重启，多个正则可重复使用此选项')
-@click.option('-t', '--restart-wait-time', type=int, default=1, help='自动重启等待时间(秒)')
+@click.option('-t', '--restart-wait-time', type=int, default=1, help='自动重启等待时间(秒)，连续重启时按倍数增长')
+@click.option('--restart-on-failure', is_flag=True, help='应用以非零返回码退出时按重启策略自动重启')
+@click.option('--restart-backoff', type=click.FloatRange(min=1), default=2, help='连续重启时等待时间的增长倍数，1 表示不增长')
+@click.option('--restart-max-wait-time', type=int, default=60, help='自动重启最长等待时间(秒)')
+@click.option('--restart-limit', type=int, default=10, help='时间窗口内最多自动重启的次数，超过后应用进入 errored 状态，0 表示不限制')
+@click.option('--restart-window', type=int, default=600, help='统计重启次数的时间窗口(秒)')
+@click.option('--restart-stable-time', type=int, default=60, help='应用运行超过这个秒数视为稳定，重启等待时间和次数重新计算')
 @click.option('--update-script', help='更新脚本路径')
+@click.option('--metrics-interval', type=int, default=10, help='资源指标采样间隔(秒)，0 表示不采样')
+@click.option('--before-execute-timeout', type=int, default=0, help='前置检查最多等待的秒数，0 表示一直等待')
+@click.option('--kill-timeout', type=int, default=5, help='停止时等待进程退出的秒数，超时后强制杀死')
+@click.option('--depends-on', multiple=True, help='依赖的应用ID或名称，批量启动时先启动它们，多个用逗号分隔')
+@click.option('--ready-check', help='就绪检查脚本路径，依赖这个应用的应用等它通过后才启动')
+@click.option('--ready-timeout', type=int, default=0, help='就绪检查最多等待的秒数，0 表示一直等待')
+@click.option('--shell', is_flag=True, help='通过 /bin/sh 执行命令，可以在参数中使用管道、重定向和环境变量')
+@click.option('--instances', type=click.IntRange(min=1), default=1,
+              help='同时运行的实例数量，每个实例有自己的日志和环境变量 AM3_INSTANCE')
+@click.option('-P', '--parallel', type=int, help='批量操作时同时处理的应用数量，默认启动 8 个，停止不限制')
+@click.option('--timeout', type=float, help='本次操作每个应用最多等待的秒数(包括前置检查)，批量操作时超时的应用记为失败')
 @click.pass_context
 def start_app(ctx, app_id, start, interpreter, conf, working_directory, params, name, generate,
               before_execute, restart_control, restart_check_delay, restart_keyword,
-              restart_keyword_regex, restart_wait_time, update_script):
+              restart_keyword_regex, restart_wait_time, restart_on_failure, restart_backoff, restart_max_wait_time,
+              restart_limit, restart_window, restart_stable_time, update_script, metrics_interval,
+              before_execute_timeout, kill_timeout, depends_on, ready_check, ready_timeout, shell,
+              instances, parallel, timeout):
     """启动应用
 
     可以通过APP_ID启动已注册的应用，或者通过提供参数启动新应用
     """
+    if not generate and forward_to_supervisor(ctx):
+        return
     app_manager = ctx.obj['app_manager']
+    depends_on = [app.strip() for value in depends_on for app in value.split(',') if app.strip()]
+    # 在守护进程中执行时，相对路径按客户端的工作目录解析
+    conf = resolve_path(conf) if conf else conf
+    generate = resolve_path(generate) if generate else generate
 
     # 如果指定了生成配置文件选项
     if generate and (start or conf):
@@ -92,6 +148,16 @@ def start_app(ctx, app_id, start, interpreter, conf, working_directory, params,
             app_config['name'] = name
         if before_execute:
             app_config['before_execute'] = before_execute
+            app_config['before_execute_timeout'] = before_execute_timeout
+        if depends_on:
+            app_config['depends_on'] = depends_on
+        if ready_check:
+            app_config['ready_check'] = ready_check
+            app_config['ready_timeout'] = ready_timeout
+        if shell:
+            app_config['shell'] = True
+        if instances > 1:
+            app_config['instances'] = instances
 
         # 添加重启相关配置
         app_config['restart_control'] = restart_control
@@ -99,6 +165,15 @@ def start_app(ctx, app_id, start, interpreter, conf, working_directory, params,
         app_config['restart_keyword'] = list(restart_keyword) if restart_keyword else []
         app_config['restart_keyword_regex'] = list(restart_keyword_regex) if restart_keyword_regex else []
         app_config['restart_wait_time'] = restart_wait_time
+        if restart_on_failure:
+            app_config['restart_on_failure'] = True
+        app_config['restart_backoff'] = restart_backoff
+        app_config['restart_max_wait_time'] = restart_max_wait_time
+        app_config['restart_limit'] = restart_limit
+        app_config['restart_window'] = restart_window
+        app_config['restart_stable_time'] = restart_stable_time
+        app_config['metrics_interval'] = metrics_interval
+        app_config['kill_timeout'] = kill_timeout
 
         # 添加更新脚本配置
         if update_script:
@@ -113,11 +188,11 @@ def start_app(ctx, app_id, start, interpreter, conf, working_directory, params,
         # 启动已存在的应用
         if app_id.lower() == 'all':
             # 启动所有应用
-            app_manager.start_all_apps()
+            app_manager.start_all_apps(parallel, timeout)
         else:
             try:
                 app_id = int(app_id)
-                app_manager.start_app_by_id(app_id)
+                app_manager.start_app_by_id(app_id, timeout)
             except ValueError:
                 click.echo(f"错误: 应用ID必须是数字，收到的是 '{app_id}'")
                 sys.exit(1)
@@ -130,11 +205,25 @@ def start_app(ctx, app_id, start, interpreter, conf, working_directory, params,
             'params': params,
             'name': name,
             'before_execute': before_execute,
+            'before_execute_timeout': before_execute_timeout,
+            'depends_on': depends_on,
+            'ready_check': ready_check,
+            'ready_timeout': ready_timeout,
+            'shell': shell,
+            'instances': instances,
             'restart_control': restart_control,
             'restart_check_delay': restart_check_delay,
             'restart_keyword': list(restart_keyword) if restart_keyword else [],
             'restart_keyword_regex': list(restart_keyword_regex) if restart_keyword_regex else [],
-            'restart_wait_time': restart_wait_time
+            'restart_wait_time': restart_wait_time,
+            'restart_on_failure': restart_on_failure,
+            'restart_backoff': restart_backoff,
+            'restart_max_wait_time': restart_max_wait_time,
+            'restart_limit': restart_limit,
+            'restart_window': restart_window,
+            'restart_stable_time': restart_stable_time,
+            'metrics_interval': metrics_interval,
+            'kill_timeout': kill_timeout,
         }
 
         # 添加更新脚本配置
@@ -143,7 +232,7 @@ def start_app(ctx, app_id, start, interpreter, conf, working_directory, params,
 
         if conf:
             # 从配置文件加载
-            app_manager.start_app_from_config(conf)
+            app_manager.start_app_from_config(conf, parallel, timeout)
         else:
             # 使用命令行参数
             app_manager.start_app(app_config)
@@ -154,14 +243,18 @@ def start_app(ctx, app_id, start, interpreter, conf, working_directory, params,
 
 @cli.command('stop', short_help='停止应用')
 @click.argument('app_id')
+@click.option('-P', '--parallel', type=int, help='批量操作时同时处理的应用数量，默认启动 8 个，停止不限制')
+@click.option('--timeout', type=float, help='批量操作时每个应用最多等待的秒数，超时的应用记为失败')
 @click.pass_context
-def stop_app(ctx, app_id):
+def stop_app(ctx, app_id, parallel, timeout):
     """停止运行中的应用"""
+    if forward_to_supervisor(ctx):
+        return
     app_manager = ctx.obj['app_manager']
 
     if app_id.lower() == 'all':
         # 停止所有应用
-        app_manager.stop_all_apps()
+        app_manager.stop_all_apps(parallel, timeout)
     else:
         try:
             app_id = int(app_id)
@@ -173,34 +266,65 @@ def stop_app(ctx, app_id):
 
 @cli.command('restart', short_help='重启应用')
 @click.argument('app_id')
+@click.option('-P', '--parallel', type=int, help='批量操作时同时处理的应用数量，默认启动 8 个，停止不限制')
+@click.option('--timeout', type=float, help='本次操作每个应用最多等待的秒数(包括前置检查)，批量操作时超时的应用记为失败')
 @click.pass_context
-def restart_app(ctx, app_id):
+def restart_app(ctx, app_id, parallel, timeout):
     """重启应用"""
+    if forward_to_supervisor(ctx):
+        return
     app_manager = ctx.obj['app_manager']
 
     if app_id.lower() == 'all':
         # 重启所有应用
-        app_manager.restart_all_apps()
+        app_manager.restart_all_apps(parallel, timeout)
     else:
         try:
             app_id = int(app_id)
-            app_manager.restart_app_by_id(app_id)
+            app_manager.restart_app_by_id(app_id, timeout)
         except ValueError:
             click.echo(f"错误: 应用ID必须是数字，收到的是 '{app_id}'")
             sys.exit(1)
 
 
+@cli.command('scale', short_help='调整应用的实例数量')
+@click.argument('app_id')
+@click.argument('count', type=click.IntRange(min=1))
+@click.option('--timeout', type=float, help='新增实例前置检查最多等待的秒数')
+@click.pass_context
+def scale_app(ctx, app_id, count, timeout):
+    """调整应用同时运行的实例数量
+
+    应用在运行时立即启动新增的实例、停止多出的实例，没有运行时下次启动生效
+    """
+    if forward_to_supervisor(ctx):
+        return
+    app_manager = ctx.obj['app_manager']
+
+    try:
+        app_id = int(app_id)
+    except ValueError:
+        click.echo(f"错误: 应用ID必须是数字，收到的是 '{app_id}'")
+        sys.exit(1)
+    if not app_manager.scale_app(app_id, count, timeout):
+        sys.exit(1)
+
+
 @cli.command('delete', short_help='删除应用')
 @click.argument('app_id')
+@click.option('-P', '--parallel', type=int, help='批量操作时同时处理的应用数量，默认启动 8 个，停止不限制')
 @click.pass_context
-def delete_app(ctx, app_id):
+def delete_app(ctx, app_id, parallel):
     """从管理列表中删除应用"""
+    # 删除所有应用需要在终端确认，在当前进程执行
+    if app_id.lower() != 'all' and forward_to_supervisor(ctx):
+        return
     app_manager = ctx.obj['app_manager']
 
     if app_id.lower() == 'all':
         # 删除所有应用
         if click.confirm('确定要删除所有应用吗?'):
-            app_manager.delete_all_apps()
+            app_manager.delete_all_apps(parallel)
     else:
         try:
             app_id = int(app_id)
@@ -214,15 +338,18 @@ def delete_app(ctx, app_id):
 @click.argument('app_id', required=False)
 @click.option('-f', '--follow', is_flag=True, help='持续查看日志')
 @click.option('-n', '--lines', type=int, default=10, help='显示的行数')
+@click.option('-I', '--instance', type=click.IntRange(min=0), default=0, help='多实例应用的实例编号')
 @click.pass_context
-def view_log(ctx, app_id, follow, lines):
+def view_log(ctx, app_id, follow, lines, instance):
     """查看应用日志"""
+    if not follow and forward_to_supervisor(ctx):
+        return
     app_manager = ctx.obj['app_manager']
 
     if app_id:
         try:
             app_id = int(app_id)
-            app_manager.view_app_log(app_id, follow, lines)
+            app_manager.view_app_log(app_id, follow, lines, instance)
         except ValueError:
             click.echo(f"错误: 应用ID必须是数字，收到的是 '{app_id}'")
             sys.exit(1)
@@ -231,6 +358,49 @@ def view_log(ctx, app_id, follow, lines):
         app_manager.view_am3_log(follow, lines)
 
 
+@cli.command('history', short_help='查看应用状态变化历史')
+@click.argument('app_id', required=False)
+@click.option('-f', '--follow', is_flag=True, help='持续查看新的状态变化')
+@click.option('-n', '--lines', type=int, default=20, help='显示的条数')
+@click.option('--format', 'output_format', type=click.Choice(OUTPUT_FORMATS), help='机器可读的输出格式')
+@click.pass_context
+def view_history(ctx, app_id, follow, lines, output_format):
+    """查看应用的注册、启动、退出、重启、停止等状态变化历史"""
+    app_manager = ctx.obj['app_manager']
+
+    if app_id:
+        try:
+            app_id = int(app_id)
+        except ValueError:
+            click.echo(f"错误: 应用ID必须是数字，收到的是 '{app_id}'")
+            sys.exit(1)
+    app_manager.view_history(app_id, follow, lines, output_format)
+
+
+@cli.command('stats', short_help='查看应用的资源指标历史')
+@click.argument('app_id')
+@click.option('--since', default='1h', help='查看最近一段时间，如 30m、1h、7d')
+@click.option('-r', '--rows', type=int, default=30, help='最多显示的行数，记录更多时均匀抽取')
+@click.option('--format', 'output_format', type=click.Choice(OUTPUT_FORMATS), help='机器可读的输出格式，输出所有记录')
+@click.option('-I', '--instance', type=click.IntRange(min=0), default=0, help='多实例应用的实例编号')
+@click.pass_context
+def view_stats(ctx, app_id, since, rows, output_format, instance):
+    """查看应用的 CPU、内存、IO 和文件描述符的历史记录"""
+    from am3.process.metrics import parse_duration
+
+    app_manager = ctx.obj['app_manager']
+    seconds = parse_duration(since)
+    if seconds is None:
+        click.echo(f"错误: 无法识别的时长 '{since}'，请使用 30s、15m、1h、7d 这样的格式")
+        sys.exit(1)
+    try:
+        app_id = int(app_id)
+    except ValueError:
+        click.echo(f"错误: 应用ID必须是数字，收到的是 '{app_id}'")
+        sys.exit(1)
+    app_manager.view_stats(app_id, seconds, rows, output_format, instance)
+
+
 @cli.command('save', short_help='保存应用列表')
 @click.pass_context
 def save_apps(ctx):
@@ -240,11 +410,26 @@ def save_apps(ctx):
 
 
 @cli.command('load', short_help='加载应用列表')
+@click.option('-g', '--generation', help='要加载的版本，默认为最新版本')
+@click.option('-o', '--only', multiple=True, help='只加载这些应用ID，多个ID用逗号分隔')
+@click.option('-l', '--list', 'list_generations', is_flag=True, help='列出保存的版本')
 @click.pass_context
-def load_apps(ctx):
+def load_apps(ctx, generation, only, list_generations):
     """从保存的配置加载应用列表"""
     app_manager = ctx.obj['app_manager']
-    app_manager.load_apps()
+
+    if list_generations:
+        app_manager.list_saved_generations()
+        return
+
+    app_ids = None
+    if only:
+        app_ids = [app_id.strip() for value in only for app_id in value.split(',') if app_id.strip()]
+        for app_id in app_ids:
+            if not app_id.isdigit():
+                click.echo(f"错误: 应用ID必须是数字，收到的是 '{app_id}'")
+                sys.exit(1)
+    app_manager.load_apps(generation, app_ids)
 
 
 @cli.command('startup', short_help='设置开机自启动')
@@ -255,6 +440,62 @@ def setup_startup(ctx):
     config_manager.setup_startup()
 
 
+@cli.group('daemon', short_help='supervisor 守护进程管理')
+def daemon():
+    """管理 supervisor 守护进程
+
+    守护进程运行时，list、start、stop、restart、scale、delete、log 命令交给它执行，
+    应用的监控进程都由它启动和回收；没有运行时命令照常在当前进程执行
+    """
+    pass
+
+
+@daemon.command('start', short_help='启动守护进程')
+@click.option('-f', '--foreground', is_flag=True, help='在前台运行，不进入后台')
+@click.option('-e', '--engine', is_flag=True, help='在守护进程中直接监控所有应用，不再为每个应用启动监控进程')
+def start_daemon(foreground, engine):
+    """启动 supervisor 守护进程
+
+    使用 --engine 时，之后启动的应用由守护进程直接启动和监控，停止守护进程时这些应用也会停止
+    """
+    if foreground:
+        from am3.cli.supervisor import Supervisor
+        if not Supervisor(client.get_socket_path(), use_engine=engine).run():
+            sys.exit(1)
+        return
+    info = client.start_daemon(use_engine=engine)
+    if not info:
+        click.echo("错误: supervisor 守护进程启动失败，请查看 am3.log")
+        sys.exit(1)
+    click.echo(f"supervisor 守护进程在运行 PID: {info['pid']}")
+
+
+@daemon.command('stop', short_help='停止守护进程')
+def stop_daemon():
+    """停止 supervisor 守护进程
+
+    由各自的监控进程启动的应用继续运行，由监控引擎(--engine)启动的应用会被停止
+    """
+    if not client.stop_daemon():
+        click.echo("错误: supervisor 守护进程没有在规定时间内退出")
+        sys.exit(1)
+    click.echo("supervisor 守护进程已停止")
+
+
+@daemon.command('status', short_help='查看守护进程状态')
+def daemon_status():
+    """查看 supervisor 守护进程是否在运行"""
+    info = client.ping()
+    if not info:
+        click.echo("supervisor 守护进程没有运行")
+        sys.exit(1)
+    uptime = int(time.time() - info['started_at'])
+    click.echo(f"supervisor 守护进程在运行 PID: {info['pid']} 版本: {info['version']} "
+               f"运行时间: {uptime} 秒 已处理命令: {info['requests']}")
+    if info.get('engine'):
+        click.echo(f"监控引擎中的应用数量: {info['apps']}")
+
+
 @cli.group('api', short_help='API服务管理')
 def api():
     """管理API服务"""
@@ -289,4 +530,4 @@ def stop_api(ctx):
 setup_aliases(cli)
 
 if __name__ == '__main__':
-    cli(obj={})
+    cli(obj=LazyContext())
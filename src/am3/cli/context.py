@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+命令行上下文模块
+管理器对象在命令第一次用到时才创建，每个进程只创建一次，
+am --help、am --version 等用不到它们的命令不会访问数据目录，
+交给 supervisor 守护进程执行的命令也不会导入它们(am list 先读取守护进程发布的状态表，需要状态存储)
+"""
+from loguru import logger
+
+
+class LazyContext(dict):
+    """按需创建管理器的 click 上下文对象，用法和普通的 dict 相同"""
+
+    def __missing__(self, key):
+        factory = getattr(self, f'_create_{key}', None)
+        if factory is None:
+            raise KeyError(key)
+        value = self[key] = factory()
+        return value
+
+    def _create_config_manager(self):
+        from am3.config.manager import ConfigManager
+        config_manager = ConfigManager()
+        # 数据目录创建后再把日志写入文件
+        logger.add(config_manager.am3_log_path, rotation="10 MB")
+        return config_manager
+
+    def _create_app_manager(self):
+        from am3.core.app_manager import AppManager
+        return AppManager(self['config_manager'])
+
+    def _create_process_manager(self):
+        from am3.process.process_manager import ProcessManager
+        return ProcessManager(self['config_manager'])
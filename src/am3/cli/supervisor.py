@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+supervisor 守护进程
+常驻后台，在 ~/.am3/am3.sock 上接收 am 命令并在自己的进程中执行: 配置、状态存储和进程管理器只初始化一次，
+应用的监控进程都是守护进程的子进程，由它负责回收
+
+每个命令在单独的线程中执行，命令的输出通过 contextvars 发回发起命令的客户端，多个客户端可以同时执行命令
+
+使用监控引擎(--engine)时，应用不再由各自的监控进程启动，而是由守护进程直接启动，
+所有应用的输出都在守护进程的事件循环中处理，见 am3.process.engine
+
+守护进程每秒(以及每个命令执行完后)把所有应用的状态发布到 ~/.am3/status.board，
+其他进程不连接守护进程就能读取，见 am3.core.status_board
+
+启动方式: am daemon start [--engine] 或 python -m am3.cli.supervisor [--engine] [socket路径]
+"""
+import io
+import os
+import sys
+import json
+import time
+import signal
+import asyncio
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+from loguru import logger
+
+from am3.cli.client import get_socket_path, ping
+from am3.cli.context import LazyContext
+from am3.core.status_board import StatusPublisher, PUBLISH_INTERVAL
+from am3.process.engine import MonitorEngine
+from am3.utils.path_util import environment, working_directory
+from am3.version import __version__
+
+# 回收已退出的监控进程的间隔(秒)
+REAP_INTERVAL = 1
+# 使用监控引擎时，守护进程退出前等待应用停止的秒数
+ENGINE_STOP_TIMEOUT = 30
+
+# 当前线程正在为哪个客户端执行命令
+_client_output = contextvars.ContextVar('client_output', default=None)
+
+
+class ClientOutput:
+    """一个客户端的输出通道"""
+
+    def __init__(self, emit, color):
+        self.emit = emit
+        self.color = color
+
+
+class ClientStream(io.TextIOBase):
+    """替换守护进程的 sys.stdout 和 sys.stderr，执行命令的线程写入的内容发给对应的客户端"""
+
+    encoding = 'utf-8'
+    errors = 'strict'
+
+    def __init__(self, name, fallback):
+        super().__init__()
+        self.name = name
+        self._fallback = fallback
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        if not isinstance(text, str):
+            # 和普通的文本流一样拒绝 bytes，click 用 write(b'') 判断流的类型
+            raise TypeError(f'write() argument must be str, not {type(text).__name__}')
+        output = _client_output.get()
+        if output is None:
+            return self._fallback.write(text)
+        output.emit(self.name, text)
+        return len(text)
+
+    def isatty(self):
+        # click 根据这个决定是否输出颜色，和客户端的终端保持一致
+        output = _client_output.get()
+        return output.color if output is not None else False
+
+    def flush(self):
+        if _client_output.get() is None:
+            self._fallback.flush()
+
+
+class Supervisor:
+    """在 Unix socket 上执行 am 命令的守护进程"""
+
+    def __init__(self, socket_path, context=None, use_engine=False):
+        self.socket_path = socket_path
+        self.use_engine = use_engine
+        self.engine = None
+        self.context = context if context is not None else LazyContext()
+        # 守护进程中执行的命令不再转发
+        self.context['supervisor'] = True
+        self.started_at = time.time()
+        self.requests = 0
+        self._stopping = None
+        self.publisher = None
+
+    def execute(self, argv, cwd=None, env=None):
+        """执行一条 am 命令，返回退出码
+
+        命令中的相对路径和新应用默认的工作目录按客户端的工作目录解析，启动的应用使用客户端的环境变量，
+        只设置当前线程的 contextvar，不切换守护进程的工作目录和环境变量，多个命令可以同时执行
+        """
+        from am3.cli.commands import cli
+
+        cwd_token = working_directory.set(cwd)
+        env_token = environment.set(env)
+        try:
+            return self._invoke(cli, argv)
+        finally:
+            environment.reset(env_token)
+            working_directory.reset(cwd_token)
+
+    def _invoke(self, cli, argv):
+        try:
+            cli.main(args=list(argv), prog_name='am', standalone_mode=False, obj=self.context)
+            return 0
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                return e.code or 0
+            click.echo(e.code, err=True)
+            return 1
+        except click.ClickException as e:
+            e.show()
+            return e.exit_code
+        except click.Abort:
+            click.echo('Aborted!', err=True)
+            return 1
+        except Exception as e:
+            logger.exception(f"执行命令 {argv} 出错: {e}")
+            click.echo(f"错误: {e}", err=True)
+            return 1
+
+    async def _send(self, writer, message):
+        writer.write(json.dumps(message, ensure_ascii=False).encode('utf-8') + b'\n')
+        await writer.drain()
+
+    async def _run(self, request, writer):
+        """在新线程中执行命令，输出按顺序转发给客户端"""
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+
+        def emit(name, text):
+            loop.call_soon_threadsafe(queue.put_nowait, {name: text})
+
+        def target():
+            _client_output.set(ClientOutput(emit, bool(request.get('color'))))
+            rc = self.execute(request.get('argv') or [], request.get('cwd'), request.get('env'))
+            # 命令可能启动或停止了应用，返回之前更新状态表
+            self._publish_status()
+            loop.call_soon_threadsafe(queue.put_nowait, {'rc': rc})
+
+        self.requests += 1
+        threading.Thread(target=target, daemon=True).start()
+        while True:
+            message = await queue.get()
+            try:
+                await self._send(writer, message)
+            except ConnectionError:
+                # 客户端已经断开，命令继续执行完
+                pass
+            if 'rc' in message:
+                return
+
+    async def _handle_client(self, reader, writer):
+        try:
+            line = await reader.readline()
+            if not line:
+                return
+            request = json.loads(line)
+            op = request.get('op')
+            if op == 'ping':
+                await self._send(writer, {'pid': os.getpid(), 'version': __version__, 'started_at': self.started_at,
+                                          'requests': self.requests, 'engine': self.engine is not None,
+                                          'apps': len(self.engine.apps) if self.engine is not None else None})
+            elif op == 'shutdown':
+                await self._send(writer, {'rc': 0})
+                self._stopping.set()
+            elif op == 'run':
+                await self._run(request, writer)
+            else:
+                await self._send(writer, {'err': f"错误: 未知的请求 {op}\n"})
+                await self._send(writer, {'rc': 1})
+        except (ValueError, ConnectionError) as e:
+            logger.warning(f"处理客户端请求出错: {e}")
+        finally:
+            writer.close()
+
+    async def _reap_monitors(self):
+        """定时回收已退出的监控进程，避免留下僵尸进程"""
+        while True:
+            await asyncio.sleep(REAP_INTERVAL)
+            self.context['app_manager'].process_manager.reap_monitors()
+
+    def _publish_status(self):
+        try:
+            self.publisher.publish()
+        except Exception as e:
+            logger.exception(f"发布应用状态表出错: {e}")
+
+    async def _publish_loop(self):
+        """定时发布应用状态表，采样要遍历进程表，在线程池中执行，不阻塞事件循环"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await loop.run_in_executor(None, self._publish_status)
+            await asyncio.sleep(PUBLISH_INTERVAL)
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, self._stopping.set)
+
+        process_manager = self.context['app_manager'].process_manager
+        if self.use_engine:
+            self.engine = process_manager.engine = MonitorEngine(self.context['config_manager'], loop)
+
+        # socket 创建时就只有当前用户可以连接，不存在短暂可以被其他用户连接的时间
+        old_umask = os.umask(0o177)
+        try:
+            server = await asyncio.start_unix_server(self._handle_client, path=self.socket_path)
+        finally:
+            os.umask(old_umask)
+        os.chmod(self.socket_path, 0o600)
+        logger.info(f"supervisor 守护进程已启动 PID: {os.getpid()} socket: {self.socket_path}")
+        self.publisher = StatusPublisher(self.context['app_manager'])
+        reaper = asyncio.ensure_future(self._reap_monitors())
+        publisher = asyncio.ensure_future(self._publish_loop())
+        try:
+            await self._stopping.wait()
+        finally:
+            reaper.cancel()
+            publisher.cancel()
+            server.close()
+            await server.wait_closed()
+            if self.engine is not None:
+                # 应用的输出管道由守护进程读取，守护进程退出前停止它启动的应用
+                await loop.run_in_executor(None, self._stop_engine_apps)
+                await self.engine.wait_closed(ENGINE_STOP_TIMEOUT)
+            self.publisher.close()
+            try:
+                os.remove(self.socket_path)
+            except FileNotFoundError:
+                pass
+            logger.info("supervisor 守护进程已停止")
+
+    def _stop_engine_apps(self):
+        app_manager = self.context['app_manager']
+        app_ids = self.engine.app_ids()
+        if not app_ids:
+            return
+        logger.info(f"停止监控引擎中的应用: {app_ids}")
+        with ThreadPoolExecutor(max_workers=len(app_ids)) as executor:
+            for app_id in app_ids:
+                app_config = app_manager.config_manager.get_app_config(app_id)
+                if app_config:
+                    executor.submit(app_manager.process_manager.stop_process, app_config, app_id)
+
+    def run(self):
+        """运行守护进程直到收到 shutdown 请求或 SIGTERM"""
+        if ping(self.socket_path):
+            click.echo("错误: supervisor 守护进程已经在运行")
+            return False
+        # 上次异常退出时残留的 socket 文件
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        os.makedirs(os.path.dirname(self.socket_path), exist_ok=True)
+
+        # 先创建管理器，日志写入 am3.log
+        self.context['app_manager']
+        sys.stdout = ClientStream('out', sys.stdout)
+        sys.stderr = ClientStream('err', sys.stderr)
+        os.chdir('/')
+        asyncio.run(self.serve())
+        return True
+
+
+def main():
+    args = sys.argv[1:]
+    use_engine = '--engine' in args
+    args = [arg for arg in args if arg != '--engine']
+    socket_path = args[0] if args else get_socket_path()
+    Supervisor(socket_path, use_engine=use_engine).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -17,7 +17,7 @@ import psutil
 from am3.alias import get_aliases, alias_dict
 from am3.settings import am3_pids_path, am3_status_path, am3_log_path, am3_logs_path, am3_dump_path, am3_dump_bak_path, \
     am3_data_path, am3_init_path
-from am3.utils.cmd_util import parse_args, guess_interpreter
+from am3.utils.cmd_util import parse_args, guess_interpreter, build_command
 from am3.utils.color_util import bright_cyan, bool_color, green
 from am3.utils.linux_util import detect_init_system
 from am3.utils.path_util import format_path, format_name
@@ -288,13 +288,10 @@ def watch_application(app_conf):
 
     # DONE: 解决丢失高亮
     begin_time = datetime.now()
-    if interpreter:
-        cmd = [interpreter, start, params]
-    else:
-        cmd = [start, params]
+    shell = app_conf.get('shell', False)
+    cmd = build_command(interpreter, start, params, shell)
     logger.info(cmd)
-    cmd_str = ' '.join(cmd)
-    p = subprocess.Popen(cmd_str, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+    p = subprocess.Popen(cmd, shell=shell, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
                          encoding='utf-8', universal_newlines=True, cwd=working_directory)
     logger.info(f'应用 {name} 进程id {p.pid}')
 
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+应用依赖模块
+应用配置中的 depends_on 列出它依赖的应用(应用ID或名称)，所有应用的依赖构成一个有向无环图:
+批量启动时按拓扑顺序启动，没有依赖关系的应用并行启动；批量停止时按相反的顺序停止
+"""
+
+
+class DependencyError(Exception):
+    """依赖的应用不存在、名称不唯一或存在循环依赖"""
+
+
+def resolve_dependencies(apps):
+    """把每个应用的 depends_on 解析为应用ID列表，返回 {app_id: [依赖的app_id]}
+
+    Args:
+        apps: {app_id: app} 形式的应用状态
+    """
+    names = {}
+    for app_id, app in apps.items():
+        names.setdefault(app['app_conf'].get('name'), []).append(app_id)
+
+    dependencies = {}
+    for app_id, app in apps.items():
+        resolved = []
+        for dependency in app['app_conf'].get('depends_on') or []:
+            dependency = str(dependency)
+            if dependency in apps:
+                dependency_id = dependency
+            elif len(names.get(dependency, [])) == 1:
+                dependency_id = names[dependency][0]
+            elif dependency in names:
+                raise DependencyError(f'应用 {app_id} 依赖的应用名称 {dependency} 不唯一，请使用应用ID')
+            else:
+                raise DependencyError(f'应用 {app_id} 依赖的应用 {dependency} 不存在')
+            if dependency_id == app_id:
+                raise DependencyError(f'应用 {app_id} 不能依赖自己')
+            if dependency_id not in resolved:
+                resolved.append(dependency_id)
+        dependencies[app_id] = resolved
+    return dependencies
+
+
+def find_cycle(dependencies):
+    """查找一个循环依赖，返回环上的应用ID列表(首尾相同)，没有时返回None"""
+    # 0: 未访问 1: 在当前路径上 2: 已访问完
+    state = {}
+    for root in dependencies:
+        if state.get(root):
+            continue
+        # 用显式栈做深度优先遍历，依赖链很长时不会超过递归深度
+        path = [root]
+        stack = [iter(dependencies.get(root, ()))]
+        state[root] = 1
+        while stack:
+            dependency = next(stack[-1], None)
+            if dependency is None:
+                state[path.pop()] = 2
+                stack.pop()
+            elif state.get(dependency) == 1:
+                return path[path.index(dependency):] + [dependency]
+            elif not state.get(dependency):
+                state[dependency] = 1
+                path.append(dependency)
+                stack.append(iter(dependencies.get(dependency, ())))
+    return None
+
+
+def check_dependencies(apps):
+    """解析并检查依赖，有问题时抛出 DependencyError，返回 {app_id: [依赖的app_id]}"""
+    dependencies = resolve_dependencies(apps)
+    cycle = find_cycle(dependencies)
+    if cycle:
+        raise DependencyError(f"存在循环依赖: {' -> '.join(cycle)}")
+    return dependencies
+
+
+def reverse_dependencies(dependencies):
+    """反转依赖图，返回 {app_id: [依赖它的app_id]}，用于按相反的顺序停止"""
+    dependents = {app_id: [] for app_id in dependencies}
+    for app_id, app_dependencies in dependencies.items():
+        for dependency in app_dependencies:
+            dependents.setdefault(dependency, []).append(app_id)
+    return dependents
+
+
+if __name__ == '__main__':
+    apps = {
+        '0': {'app_conf': {'name': 'db'}},
+        '1': {'app_conf': {'name': 'broker', 'depends_on': ['db']}},
+        '2': {'app_conf': {'name': 'web', 'depends_on': ['db', 'broker']}},
+    }
+    print(check_dependencies(apps))
+    apps['0']['app_conf']['depends_on'] = ['web']
+    try:
+        check_dependencies(apps)
+    except DependencyError as e:
+        print(e)
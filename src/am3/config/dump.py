@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+应用列表保存模块
+每次 am save 生成一个新的版本目录，保留最近的若干个版本:
+
+    dumps/<版本名>/meta.json           版本信息、除应用外的状态字段、应用ID列表和哈希
+    dumps/<版本名>/app_list.json       保存时的应用状态列表
+    dumps/<版本名>/apps/<app_id>.json  每个应用一个文件
+
+版本先写入临时目录，全部落盘后再重命名为正式目录，保存过程中崩溃不会破坏已有的版本
+恢复部分应用时只读取对应的应用文件，不需要解析整个应用列表
+"""
+import os
+import json
+import time
+import shutil
+import tempfile
+from datetime import datetime
+
+# 每种版本保留的数量
+KEEP_GENERATIONS = 10
+# 加载前自动备份的版本名后缀
+BACKUP_SUFFIX = '-backup'
+# 超过这个时间的临时目录认为是保存中途崩溃留下的
+STALE_TMP_SECONDS = 3600
+
+
+def _write_file(path, content):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class DumpStore:
+    """按版本保存应用列表"""
+
+    def __init__(self, dumps_path, keep=KEEP_GENERATIONS):
+        self.dumps_path = dumps_path
+        self.keep = keep
+
+    def list_generations(self, backup=None):
+        """按时间从旧到新列出版本名，backup 为 True/False 时只列出备份/普通版本"""
+        if not os.path.isdir(self.dumps_path):
+            return []
+        names = sorted(name for name in os.listdir(self.dumps_path)
+                       if not name.startswith('.') and os.path.isdir(os.path.join(self.dumps_path, name)))
+        if backup is not None:
+            names = [name for name in names if name.endswith(BACKUP_SUFFIX) == backup]
+        return names
+
+    def latest(self):
+        """最新的普通版本名，没有时返回None"""
+        names = self.list_generations(backup=False)
+        return names[-1] if names else None
+
+    def save(self, status_data, app_list, digest_data, backup=False):
+        """保存一个新版本，返回版本名"""
+        name = datetime.now().strftime('%Y%m%d-%H%M%S-%f') + (BACKUP_SUFFIX if backup else '')
+        os.makedirs(self.dumps_path, exist_ok=True)
+        tmp_path = tempfile.mkdtemp(prefix=f'.{name}.', dir=self.dumps_path)
+        os.chmod(tmp_path, 0o755)
+        try:
+            apps = status_data.get('apps', {})
+            os.makedirs(os.path.join(tmp_path, 'apps'))
+            for app_id, app in apps.items():
+                _write_file(os.path.join(tmp_path, 'apps', f'{app_id}.json'),
+                            json.dumps(app, ensure_ascii=False, indent=4))
+            _fsync_dir(os.path.join(tmp_path, 'apps'))
+
+            _write_file(os.path.join(tmp_path, 'app_list.json'), json.dumps(app_list, ensure_ascii=False, indent=4))
+            meta = {
+                'created_at': datetime.now().isoformat(),
+                'status_meta': {key: value for key, value in status_data.items() if key != 'apps'},
+                'app_ids': list(apps),
+                **digest_data,
+            }
+            _write_file(os.path.join(tmp_path, 'meta.json'), json.dumps(meta, ensure_ascii=False, indent=4))
+            _fsync_dir(tmp_path)
+
+            os.rename(tmp_path, os.path.join(self.dumps_path, name))
+            _fsync_dir(self.dumps_path)
+        except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+
+        self.prune()
+        return name
+
+    def prune(self):
+        """删除超出保留数量的旧版本和残留的临时目录"""
+        for backup in (False, True):
+            for name in self.list_generations(backup=backup)[:-self.keep]:
+                shutil.rmtree(os.path.join(self.dumps_path, name), ignore_errors=True)
+
+        for name in os.listdir(self.dumps_path):
+            path = os.path.join(self.dumps_path, name)
+            if name.startswith('.') and time.time() - os.path.getmtime(path) > STALE_TMP_SECONDS:
+                shutil.rmtree(path, ignore_errors=True)
+
+    def read_meta(self, name):
+        with open(os.path.join(self.dumps_path, name, 'meta.json'), 'r', encoding='utf-8') as f:
+            return json.loads(f.read())
+
+    def read_app(self, name, app_id):
+        with open(os.path.join(self.dumps_path, name, 'apps', f'{app_id}.json'), 'r', encoding='utf-8') as f:
+            return json.loads(f.read())
+
+    def exists(self, name):
+        return os.path.exists(os.path.join(self.dumps_path, name, 'meta.json'))
+
+
+if __name__ == '__main__':
+    store = DumpStore(tempfile.mkdtemp())
+    generation = store.save({'version': '1.1.0', 'apps': {'0': {'app_conf': {'start': 'a'}}}}, [], {})
+    print(generation, store.read_meta(generation)['app_ids'], store.read_app(generation, '0'))
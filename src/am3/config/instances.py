@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+应用实例模块
+配置了 instances 的应用同时运行多个实例(进程)，每个实例有自己的编号、进程身份、日志文件和资源指标文件:
+- 实例 0 使用应用原来的进程身份(app['process'])、日志路径和指标文件，只有一个实例的应用和以前完全相同
+- 其他实例的进程身份保存在 app['instance_processes'][编号]，日志为 <日志名>.<编号>.log
+- 应用进程通过环境变量 AM3_INSTANCE 得到自己的编号，AM3_INSTANCES 为实例数量
+"""
+import os
+
+INSTANCE_ENV = 'AM3_INSTANCE'
+INSTANCES_ENV = 'AM3_INSTANCES'
+
+
+def instance_count(app_config):
+    """应用配置的实例数量，至少为 1"""
+    try:
+        return max(int(app_config.get('instances') or 1), 1)
+    except (TypeError, ValueError):
+        return 1
+
+
+def instance_log_path(app_config, index):
+    """实例的日志路径，实例 0 就是应用的日志路径"""
+    log_path = app_config['app_log_path']
+    if not index:
+        return log_path
+    root, ext = os.path.splitext(log_path)
+    return f'{root}.{index}{ext}'
+
+
+def instance_metrics_name(app_id, index):
+    """实例的资源指标文件名"""
+    return f'{app_id}.{index}.ring' if index else f'{app_id}.ring'
+
+
+def instance_env(app_config, index):
+    """启动实例时添加的环境变量"""
+    return {INSTANCE_ENV: str(index), INSTANCES_ENV: str(instance_count(app_config))}
+
+
+def app_processes(app):
+    """应用记录的所有实例的进程身份 {编号: 进程身份}，包括超出实例数量还没有停止的实例"""
+    processes = {}
+    if app.get('process'):
+        processes[0] = app['process']
+    for index, identity in (app.get('instance_processes') or {}).items():
+        if identity:
+            processes[int(index)] = identity
+    return dict(sorted(processes.items()))
+
+
+if __name__ == '__main__':
+    app_config = {'app_log_path': '/tmp/web.log', 'instances': 3}
+    print([instance_log_path(app_config, index) for index in range(instance_count(app_config))])
+    print(app_processes({'process': {'pid': 1}, 'instance_processes': {'2': {'pid': 3}}}))
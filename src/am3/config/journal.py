@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+状态日志模块
+以只追加的方式记录应用的状态变化(注册、启动、退出、关键字重启、停止、删除)，
+每条记录是一行紧凑的 JSON，写入是 O(1) 的，fsync 按批次进行
+
+日志超过一定大小后会在后台压缩为快照: 快照保存每个应用的最新状态和最近的事件，
+然后清空日志文件，读取方(am history、API推送)只需要读快照和日志的增量部分
+"""
+import os
+import sys
+import json
+import time
+import atexit
+import fcntl
+import tempfile
+import threading
+import subprocess
+
+from loguru import logger
+
+# 日志超过这个大小就触发后台压缩
+COMPACT_THRESHOLD = 1024 * 1024
+# 触发压缩后日志仍然超过阈值(压缩进程失败)时，过多少秒再次触发
+COMPACT_RETRY_INTERVAL = 60
+# 快照中保留的最近事件数量
+SNAPSHOT_EVENTS = 1000
+# 累积多少条记录或多少秒后 fsync 一次
+FSYNC_BATCH = 64
+FSYNC_INTERVAL = 1.0
+
+
+class StateJournal:
+    """只追加的状态日志"""
+
+    def __init__(self, data_path):
+        self.journal_path = os.path.join(data_path, 'journal.log')
+        self.snapshot_path = os.path.join(data_path, 'journal.snapshot.json')
+        self._fd = None
+        self._pending = 0
+        self._last_fsync = time.monotonic()
+        # 上次触发压缩的时间，日志回到阈值以下后清除
+        self._compact_requested_at = None
+        # 批量操作时多个线程共用一个日志对象
+        self._lock = threading.Lock()
+
+    def _open(self):
+        with self._lock:
+            if self._fd is None:
+                self._fd = os.open(self.journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                # 进程退出前把没有 fsync 的记录落盘
+                atexit.register(self.close)
+        return self._fd
+
+    def append(self, event, app_id=None, **fields):
+        """追加一条记录"""
+        record = {'ts': round(time.time(), 3), 'event': event}
+        if app_id is not None:
+            record['app_id'] = str(app_id)
+        record.update(fields)
+        line = (json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n').encode('utf-8')
+
+        try:
+            fd = self._open()
+            # 共享锁只和压缩互斥，多个写入方之间依靠 O_APPEND 保证不会互相覆盖
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            try:
+                os.write(fd, line)
+                size = os.fstat(fd).st_size
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+            self._pending += 1
+            if self._pending >= FSYNC_BATCH or time.monotonic() - self._last_fsync >= FSYNC_INTERVAL:
+                self.flush()
+
+            if size > COMPACT_THRESHOLD:
+                self._request_compact()
+            elif self._compact_requested_at is not None:
+                # 压缩已经完成，之后再超过阈值时再次触发，常驻的写入方的日志不会无限增长
+                self._compact_requested_at = None
+        except Exception as e:
+            logger.exception(f"写入状态日志时出错: {e}")
+
+    def flush(self):
+        """fsync 已写入的记录"""
+        if self._fd is not None and self._pending:
+            os.fsync(self._fd)
+            self._pending = 0
+        self._last_fsync = time.monotonic()
+
+    def close(self):
+        if self._fd is not None:
+            try:
+                self.flush()
+            finally:
+                os.close(self._fd)
+                self._fd = None
+
+    def _request_compact(self):
+        """启动一个后台进程压缩日志，压缩完成之前不重复触发"""
+        now = time.monotonic()
+        if self._compact_requested_at is not None and now - self._compact_requested_at < COMPACT_RETRY_INTERVAL:
+            return
+        self._compact_requested_at = now
+        subprocess.Popen(
+            [sys.executable, '-m', 'am3.config.journal', 'compact', os.path.dirname(self.journal_path)],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+
+    def load_snapshot(self):
+        """读取快照，不存在时返回空快照"""
+        if not os.path.exists(self.snapshot_path):
+            return {'compacted_at': 0, 'apps': {}, 'events': []}
+        with open(self.snapshot_path, 'r', encoding='utf-8') as f:
+            return json.loads(f.read())
+
+    def compact(self):
+        """把日志合并进快照并清空日志"""
+        with open(self.journal_path, 'a+b') as f:
+            # 排他锁期间所有写入方都会等待，不会丢失记录
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                records = _parse_lines(f.read())
+                if not records:
+                    return
+
+                snapshot = self.load_snapshot()
+                for record in records:
+                    _apply_record(snapshot['apps'], record)
+                snapshot['events'] = (snapshot['events'] + records)[-SNAPSHOT_EVENTS:]
+                snapshot['compacted_at'] = time.time()
+                self._write_snapshot(snapshot)
+
+                # 写入方使用 O_APPEND，清空后会从文件开头继续追加
+                f.truncate(0)
+                os.fsync(f.fileno())
+                logger.info(f'状态日志已压缩, 合并 {len(records)} 条记录')
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _write_snapshot(self, snapshot):
+        directory = os.path.dirname(self.snapshot_path)
+        fd, tmp_path = tempfile.mkstemp(prefix='.journal.', suffix='.tmp', dir=directory)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(snapshot, ensure_ascii=False))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+
+    def _snapshot_mtime(self):
+        try:
+            return os.stat(self.snapshot_path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def read_events(self, app_id=None):
+        """读取快照中的最近事件和日志中的全部事件，返回 (事件列表, 读取位置)，读取位置传给 read_new_events"""
+        events, position = self.read_new_events((0, None, 0))
+        if app_id is not None:
+            events = [event for event in events if event.get('app_id') == str(app_id)]
+        return events, position
+
+    def read_new_events(self, position=None):
+        """读取 position 之后追加的事件，返回 (事件列表, 新的读取位置)
+
+        position 为None时从日志末尾开始，不返回已有的事件。
+        日志被压缩过(快照有变化)时，压缩前还没读到的事件从快照中取出，再从头读取日志
+        """
+        try:
+            f = open(self.journal_path, 'rb')
+        except FileNotFoundError:
+            f = None
+        events = []
+        offset = 0
+        snapshot_mtime = self._snapshot_mtime()
+        last_ts = 0
+        if position is not None:
+            offset, last_mtime, last_ts = position
+            if last_mtime != snapshot_mtime:
+                events = [event for event in self.load_snapshot()['events'] if event['ts'] > last_ts]
+                offset = 0
+        content = b''
+        if f is not None:
+            with f:
+                # 共享锁和压缩互斥，读取期间日志不会被清空
+                fcntl.flock(f, fcntl.LOCK_SH)
+                try:
+                    if self._snapshot_mtime() != snapshot_mtime:
+                        # 取得锁之前刚压缩过，重新读取
+                        return self.read_new_events(position)
+                    if os.fstat(f.fileno()).st_size < offset:
+                        offset = 0
+                    f.seek(offset)
+                    content = f.read()
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+        # 最后一行可能还没写完，只读到最后一个换行
+        end = content.rfind(b'\n') + 1
+        if position is not None:
+            events += _parse_lines(content[:end])
+        else:
+            # 从末尾开始时只需要最后一条记录的时间，压缩后据此跳过快照中已有的事件
+            events = _parse_lines(content[content.rfind(b'\n', 0, end - 1) + 1:end]) \
+                or self.load_snapshot()['events'][-1:]
+        if events:
+            last_ts = max(last_ts, events[-1]['ts'])
+        if position is None:
+            events = []
+        return events, (offset + end, snapshot_mtime, last_ts)
+
+    def read_app_states(self, apps=None, position=None):
+        """每个应用的最新状态(启动、重启次数和最后一条记录)，返回 (状态, 读取位置)
+
+        传入上次返回的状态和读取位置时只读取日志的增量部分，日志被压缩过(快照有变化)时从快照重新读取
+        """
+        try:
+            f = open(self.journal_path, 'rb')
+        except FileNotFoundError:
+            return self.load_snapshot()['apps'], None
+        with f:
+            # 共享锁和压缩互斥，不会读到已经合并进快照但还没清空的日志
+            fcntl.flock(f, fcntl.LOCK_SH)
+            try:
+                try:
+                    snapshot_mtime = os.stat(self.snapshot_path).st_mtime_ns
+                except FileNotFoundError:
+                    snapshot_mtime = None
+                size = os.fstat(f.fileno()).st_size
+                offset = 0
+                if apps is not None and position is not None and position[1] == snapshot_mtime \
+                        and size >= position[0]:
+                    offset = position[0]
+                else:
+                    apps = self.load_snapshot()['apps']
+                f.seek(offset)
+                content = f.read()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        # 最后一行可能还没写完，只读到最后一个换行
+        end = content.rfind(b'\n') + 1
+        for record in _parse_lines(content[:end]):
+            _apply_record(apps, record)
+        return apps, (offset + end, snapshot_mtime)
+
+    def follow(self, position=None, app_id=None, interval=0.5):
+        """从 position 开始持续读取新事件，日志被压缩后从快照和日志开头继续"""
+        while True:
+            events, position = self.read_new_events(position)
+            for event in events:
+                if app_id is None or event.get('app_id') == str(app_id):
+                    yield event
+            time.sleep(interval)
+
+
+def _parse_lines(content):
+    """解析日志内容，跳过损坏的行"""
+    records = []
+    for line in content.splitlines():
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            continue
+    return records
+
+
+def _apply_record(apps, record):
+    """把一条记录合并进每个应用的最新状态"""
+    app_id = record.get('app_id')
+    if app_id is None:
+        return
+    if record['event'] == 'delete':
+        apps.pop(app_id, None)
+        return
+    state = apps.get(app_id, {'starts': 0, 'restarts': 0})
+    counters = {'starts': state['starts'], 'restarts': state['restarts']}
+    if record['event'] == 'start':
+        counters['starts'] += 1
+    elif record['event'] == 'restart':
+        counters['restarts'] += 1
+    # 只保留计数和最后一条记录，其他字段以最后一条记录为准
+    apps[app_id] = {**counters, **{key: value for key, value in record.items() if key != 'app_id'}}
+
+
+if __name__ == '__main__':
+    # 后台压缩入口: python -m am3.config.journal compact <数据目录>
+    if len(sys.argv) == 3 and sys.argv[1] == 'compact':
+        StateJournal(sys.argv[2]).compact()
@@ -6,26 +6,42 @@
 """
 import os
 import json
-import fcntl
 import getpass
 import uuid
 import socket
-from datetime import datetime
+import tempfile
+import time
 
-import psutil
 import click
 from loguru import logger
 
-from am3.utils.path_util import format_path
+from am3.config.dependency import DependencyError, check_dependencies
+from am3.config.dump import DumpStore
+from am3.config.instances import app_processes, instance_metrics_name
+from am3.config.journal import StateJournal
+from am3.config.store import create_state_store
+from am3.utils.hash_util import apps_digest, canonical_hash, state_hash
+from am3.utils.path_util import format_path, format_name
 from am3.utils.linux_util import detect_init_system
+from am3.utils.process_util import CREATE_TIME_TOLERANCE, is_same_process
 from am3.version import __version__
 
 
+def _same_process(identity, other):
+    """两个进程身份是否是同一个进程"""
+    return identity['pid'] == other['pid'] \
+        and abs(identity['create_time'] - other['create_time']) <= CREATE_TIME_TOLERANCE
+
+
 class ConfigManager:
     """配置管理器类，处理所有配置相关操作"""
 
-    def __init__(self):
-        """初始化配置管理器"""
+    def __init__(self, state_backend=None):
+        """初始化配置管理器
+
+        Args:
+            state_backend: 状态存储后端 sqlite/json，默认读取环境变量 AM3_STATE_BACKEND
+        """
         # 基础路径
         self.am3_data_path = format_path('~/.am3')
         self._ensure_directory(self.am3_data_path)
@@ -40,84 +56,118 @@ class ConfigManager:
         self.am3_init_path = os.path.join(self.am3_data_path, 'init')
         self._ensure_directory(self.am3_init_path)
 
+        # 应用资源指标的环形文件，由监控进程写入
+        self.am3_metrics_path = os.path.join(self.am3_data_path, 'metrics')
+        self._ensure_directory(self.am3_metrics_path)
+
         # 文件路径
         self.am3_status_path = os.path.join(self.am3_data_path, 'status.json')
+        self.am3_state_db_path = os.path.join(self.am3_data_path, 'state.db')
         self.am3_log_path = os.path.join(self.am3_data_path, 'am3.log')
+        # supervisor 守护进程发布的应用状态表，见 am3.core.status_board
+        self.am3_status_board_path = os.path.join(self.am3_data_path, 'status.board')
+        # 旧版本的单文件 dump 和它的哈希，只在没有版本目录时读取
         self.am3_dump_path = os.path.join(self.am3_data_path, 'dump.json')
-        self.am3_dump_bak_path = os.path.join(self.am3_data_path, 'dump_bak.json')
+        self.am3_dump_digest_path = os.path.join(self.am3_data_path, 'dump.digest.json')
+
+        # 按版本保存的应用列表
+        self.am3_dumps_path = os.path.join(self.am3_data_path, 'dumps')
+        self.dump_store = DumpStore(self.am3_dumps_path)
+
+        # 状态存储后端
+        self.state_store = create_state_store(self.am3_data_path, state_backend)
+
+        # 只追加的状态日志，记录应用的状态变化
+        self.journal = StateJournal(self.am3_data_path)
+
+        # 状态缓存 (文件签名, 状态数据)，文件没有变化时直接复用解析结果
+        self._status_cache = None
+        # get_status_data 的调用次数和实际解析次数，用于性能统计
+        self.status_read_count = 0
+        self.status_parse_count = 0
 
         # 初始化状态文件
         self._init_status_file()
 
-        # 检查系统启动时间
-        self._check_system_boot_time()
-
     def _ensure_directory(self, directory):
         """确保目录存在"""
         if not os.path.exists(directory):
             os.makedirs(directory)
 
-    def _init_status_file(self):
-        """初始化状态文件"""
-        if not os.path.exists(self.am3_status_path):
-            with open(self.am3_status_path, 'w') as f:
-                logger.info('初始化 am3 status 文件')
-                f.write(json.dumps({
-                    'version': __version__,
-                    'apps': {},
-                    'system_boot_time': str(datetime.fromtimestamp(psutil.boot_time())),
-                    'api': {
-                        'api_token': '',
-                        'node_name': '',
-                        'server_address': '',
-                        'namespace': '',
-                        'socketio_path': '',
-                    }
-                }, ensure_ascii=False, indent=4))
-
-    def _check_system_boot_time(self):
-        """检查系统启动时间，如果系统重启过，清理PID文件"""
-        try:
-            with open(self.am3_status_path, 'r') as f:
-                content = f.read()
-                if not content:
-                    return
-
-                am3_status = json.loads(content)
-                current_boot_time = str(datetime.fromtimestamp(psutil.boot_time()))
-
-                if am3_status.get('system_boot_time') != current_boot_time:
-                    logger.info('系统重启过，进程pid都要设置为失效')
-                    # 清理PID目录
-                    for file in os.listdir(self.am3_pids_path):
-                        os.remove(os.path.join(self.am3_pids_path, file))
+    def _default_status_data(self):
+        """初始状态数据"""
+        return {
+            'version': __version__,
+            'apps': {},
+            'api': {
+                'api_token': '',
+                'node_name': '',
+                'server_address': '',
+                'namespace': '',
+                'socketio_path': '',
+            }
+        }
 
-                    # 更新启动时间
-                    am3_status['system_boot_time'] = current_boot_time
-                    with open(self.am3_status_path, 'w') as f2:
-                        logger.info('更新系统启动时间')
-                        f2.write(json.dumps(am3_status, ensure_ascii=False, indent=4))
-        except Exception as e:
-            logger.exception(f"检查系统启动时间时出错: {e}")
+    def _init_status_file(self):
+        """初始化状态存储，sqlite 后端首次运行时会自动迁移旧的 status.json"""
+        if self.state_store.exists():
+            return
+        if self.state_store.backend == 'sqlite':
+            self.state_store.initialize(self._default_status_data(), status_path=self.am3_status_path)
+        else:
+            self.state_store.initialize(self._default_status_data())
 
     def get_status_data(self):
-        """获取状态数据"""
+        """获取状态数据
+
+        返回的是共享的缓存对象，调用方只能读取，不能修改，修改请使用 mutate()
+        缓存以状态存储的 signature() 为键，状态变化后才会重新解析
+        """
+        self.status_read_count += 1
         try:
-            with open(self.am3_status_path, 'r') as f:
-                return json.loads(f.read())
+            # 先取签名再读取，读取期间如果文件被修改，下次调用时签名不一致会重新解析
+            signature = self.state_store.signature()
+            if self._status_cache is not None and self._status_cache[0] == signature:
+                return self._status_cache[1]
+
+            status_data = self.state_store.load()
+            self.status_parse_count += 1
+            self._status_cache = (signature, status_data)
+            return status_data
         except Exception as e:
             logger.exception(f"读取状态数据时出错: {e}")
-            return {'version': __version__, 'apps': {}, 'system_boot_time': '', 'api': {}}
+            return {'version': __version__, 'apps': {}, 'api': {}}
+
+    def get_state_hash(self, status_data=None):
+        """获取状态哈希，应用部分使用存储中增量维护的摘要，不会遍历所有应用"""
+        status_data = status_data if status_data is not None else self.get_status_data()
+        stored = status_data.get('apps_digest')
+        digest = int(stored, 16) if stored else apps_digest(status_data.get('apps', {}))
+        return state_hash(digest, status_data)
+
+    def get_generation(self):
+        """获取状态的 generation，每次提交修改都会加一"""
+        return self.get_status_data().get('generation', 0)
+
+    def mutate(self, fn, expected_generation=None):
+        """原子地修改状态
+
+        fn 接收一个事务对象(get_app/put_app/delete_app/next_app_id/get_meta/set_meta 等)，
+        整个 读取-修改-写入 过程都持有写锁，多个 am 命令并行执行时不会互相覆盖
+
+        Args:
+            fn: 修改函数，返回值会原样返回
+            expected_generation: 如果提供，状态的 generation 不一致时抛出 StateConflictError
+
+        Returns:
+            fn 的返回值
+        """
+        return self.state_store.mutate(fn, expected_generation)
 
     def update_status_data(self, status_data):
         """更新状态数据"""
         try:
-            with open(self.am3_status_path, 'r+') as f:
-                fcntl.flock(f, fcntl.LOCK_EX)
-                f.seek(0)
-                f.truncate()
-                f.write(json.dumps(status_data, ensure_ascii=False, indent=4))
-                fcntl.flock(f, fcntl.LOCK_UN)
+            self.mutate(lambda txn: txn.replace_all(status_data))
             return True
         except Exception as e:
             logger.exception(f"更新状态数据时出错: {e}")
@@ -125,56 +175,256 @@ class ConfigManager:
 
     def get_app_config(self, app_id):
         """获取应用配置"""
-        status_data = self.get_status_data()
-        app_id = str(app_id)
-
-        if app_id in status_data['apps']:
-            return status_data['apps'][app_id]['app_conf']
+        app = self.get_status_data()['apps'].get(str(app_id))
+        if app:
+            return app['app_conf']
         return None
 
-    def save_app_config(self, app_config, app_id=None):
-        """保存应用配置"""
-        status_data = self.get_status_data()
+    def _register_app(self, txn, app_config, app_id=None):
+        """在事务内注册或更新一个应用，返回app_id"""
+        # 确保UUID存在
+        if 'uuid' not in app_config:
+            app_config['uuid'] = str(uuid.uuid4())
 
         # 如果没有提供app_id，查找是否已存在相同启动路径的应用
         if app_id is None:
-            app_exists = False
-            max_id = -1
-
-            for id_str in status_data['apps']:
-                max_id = max(max_id, int(id_str))
-                if status_data['apps'][id_str]['app_conf']['start'] == app_config['start']:
-                    app_exists = True
-                    app_id = id_str
-                    break
-
-            if not app_exists:
-                app_id = str(max_id + 1)
-        else:
-            app_id = str(app_id)
+            app_id = txn.find_app_id('start', app_config['start'])
+        if app_id is None:
+            app_id = txn.next_app_id()
+        app_id = str(app_id)
 
-        # 确保UUID存在
-        if 'uuid' not in app_config:
-            app_config['uuid'] = str(uuid.uuid4())
+        # 默认的日志路径，和其他应用重名时添加序号，防止多个应用写到同一个日志里
+        if not app_config.get('app_log_path'):
+            name = format_name(app_config['name'])
+            app_log_path = os.path.join(self.am3_logs_path, f'{name}.log')
+            counter = 0
+            while txn.log_path_in_use(app_log_path, app_id):
+                counter += 1
+                app_log_path = os.path.join(self.am3_logs_path, f'{name}-{counter}.log')
+            app_config['app_log_path'] = app_log_path
 
         # 更新或创建应用配置
-        if app_id in status_data['apps']:
-            status_data['apps'][app_id]['app_conf'].update(app_config)
+        app = txn.get_app(app_id) or {'app_conf': {}}
+        app['app_conf'].update(app_config)
+        txn.put_app(app_id, app)
+        return app_id
+
+    def _check_dependencies(self, txn, app_configs):
+        """写入的配置声明了依赖时，在同一个事务内检查依赖，有问题时抛出异常回滚事务"""
+        if any(app_config.get('depends_on') for app_config in app_configs):
+            check_dependencies(dict(txn.items()))
+
+    def save_app_config(self, app_config, app_id=None):
+        """保存应用配置"""
+        def register(txn):
+            registered_id = self._register_app(txn, app_config, app_id)
+            self._check_dependencies(txn, [app_config])
+            return registered_id
+
+        try:
+            app_id = self.mutate(register)
+        except DependencyError as e:
+            click.echo(f"错误: {e}")
+            return False, app_id
+        except Exception as e:
+            logger.exception(f"保存应用配置时出错: {e}")
+            return False, app_id
+        self.journal.append('register', app_id, name=app_config['name'])
+        return True, app_id
+
+    def register_many(self, app_configs, app_ids=None):
+        """在一个事务内批量注册应用
+
+        Args:
+            app_configs: 应用配置列表
+            app_ids: 与 app_configs 一一对应的应用ID列表，不提供则自动分配
+
+        Returns:
+            (是否成功, 应用ID列表)
+        """
+        if app_ids is None:
+            app_ids = [None] * len(app_configs)
+
+        def register(txn):
+            registered_ids = [self._register_app(txn, app_config, app_id)
+                              for app_config, app_id in zip(app_configs, app_ids)]
+            self._check_dependencies(txn, app_configs)
+            return registered_ids
+
+        try:
+            registered_ids = self.mutate(register)
+        except DependencyError as e:
+            click.echo(f"错误: {e}")
+            return False, []
+        except Exception as e:
+            logger.exception(f"批量保存应用配置时出错: {e}")
+            return False, []
+        for app_id, app_config in zip(registered_ids, app_configs):
+            self.journal.append('register', app_id, name=app_config['name'])
+        return True, registered_ids
+
+    def _put_app_process(self, app, identity, instance):
+        """在应用记录中保存实例的进程身份，identity 为None时清除，返回记录是否有变化
+
+        实例 0 记录在 app['process']，其他实例记录在 app['instance_processes']
+        """
+        if instance:
+            processes = app.setdefault('instance_processes', {})
+            if identity is None:
+                processes.pop(str(instance), None)
+            else:
+                processes[str(instance)] = identity
+            if not processes:
+                app.pop('instance_processes')
+        elif identity is None:
+            if 'process' not in app:
+                return False
+            app.pop('process')
         else:
-            status_data['apps'][app_id] = {'app_conf': app_config}
+            app['process'] = identity
+        return True
+
+    def set_app_process(self, app_id, identity, instance=0):
+        """记录应用(监控)进程的身份 (pid, 创建时间, 命令行指纹)，identity 为None时清除，instance 为实例编号"""
+        def update(txn):
+            app = txn.get_app(app_id)
+            if app is None:
+                return False
+            new_identity = identity
+            previous = app_processes(app).get(instance)
+            if new_identity is not None and previous is not None and 'app_pid' in previous \
+                    and 'app_pid' not in new_identity and _same_process(previous, new_identity):
+                # 监控进程可能已经先记录了应用进程的PID
+                new_identity = {**new_identity, 'app_pid': previous['app_pid']}
+            if self._put_app_process(app, new_identity, instance):
+                txn.put_app(app_id, app)
+            return True
+
+        try:
+            return self.mutate(update)
+        except Exception as e:
+            logger.exception(f"保存应用进程信息时出错: {e}")
+            return False
+
+    def set_app_pid(self, app_id, monitor_identity, app_pid, instance=0):
+        """监控进程记录它当前启动的应用进程的PID(app_pid)，应用退出等待重启时为None
+
+        启动方可能还没有记录监控进程的身份，这时先记录监控进程的身份，启动方写入时会保留 app_pid
+        """
+        def update(txn):
+            app = txn.get_app(app_id)
+            if app is None:
+                return False
+            identity = app_processes(app).get(instance)
+            if identity is None or not _same_process(identity, monitor_identity):
+                # 实例已经由其他还在运行的监控进程管理
+                if app_pid is None or (identity is not None and is_same_process(identity)):
+                    return False
+                identity = monitor_identity
+            self._put_app_process(app, {**identity, 'app_pid': app_pid}, instance)
+            txn.put_app(app_id, app)
+            return True
 
-        # 保存状态数据
-        return self.update_status_data(status_data), app_id
+        try:
+            return self.mutate(update)
+        except Exception as e:
+            logger.exception(f"保存应用进程PID时出错: {e}")
+            return False
 
     def delete_app_config(self, app_id):
         """删除应用配置"""
-        status_data = self.get_status_data()
+        try:
+            deleted = self.mutate(lambda txn: txn.delete_app(app_id))
+        except Exception as e:
+            logger.exception(f"删除应用配置时出错: {e}")
+            return False
+        if deleted:
+            self.journal.append('delete', app_id)
+            self._remove_app_metrics(app_id)
+        return deleted
+
+    def delete_many(self, app_ids):
+        """在一个事务内批量删除应用，返回实际删除的应用ID列表"""
+        def delete(txn):
+            return [str(app_id) for app_id in app_ids if txn.delete_app(app_id)]
+
+        try:
+            deleted_ids = self.mutate(delete)
+        except Exception as e:
+            logger.exception(f"批量删除应用配置时出错: {e}")
+            return []
+        for app_id in deleted_ids:
+            self.journal.append('delete', app_id)
+            self._remove_app_metrics(app_id)
+        return deleted_ids
+
+    def get_metrics_path(self, app_id, instance=0):
+        """应用(实例)资源指标文件的路径"""
+        return os.path.join(self.am3_metrics_path, instance_metrics_name(app_id, instance))
+
+    def _remove_app_metrics(self, app_id):
+        """删除应用所有实例的资源指标文件，应用ID被复用时不会看到旧应用的数据"""
+        for name in os.listdir(self.am3_metrics_path):
+            if name.startswith(f'{app_id}.') and name.endswith('.ring'):
+                try:
+                    os.remove(os.path.join(self.am3_metrics_path, name))
+                except FileNotFoundError:
+                    pass
+
+    def set_app_instances(self, app_id, count):
+        """修改应用的实例数量，应用不存在时返回False"""
+        def update(txn):
+            app = txn.get_app(app_id)
+            if app is None:
+                return False
+            app['app_conf']['instances'] = count
+            txn.put_app(app_id, app)
+            return True
+
+        try:
+            return self.mutate(update)
+        except Exception as e:
+            logger.exception(f"修改应用实例数量时出错: {e}")
+            return False
+
+    def set_app_errored(self, app_id, reason):
+        """记录应用超过重启次数限制、不再自动重启(reason 为原因)，reason 为None时清除"""
         app_id = str(app_id)
+        if reason is None and not self.get_status_data()['apps'].get(app_id, {}).get('errored'):
+            return True
+
+        def update(txn):
+            app = txn.get_app(app_id)
+            if app is None:
+                return False
+            if reason is None:
+                app.pop('errored', None)
+            else:
+                app['errored'] = {'ts': round(time.time(), 3), 'reason': reason}
+            txn.put_app(app_id, app)
+            return True
 
-        if app_id in status_data['apps']:
-            del status_data['apps'][app_id]
-            return self.update_status_data(status_data)
-        return False
+        try:
+            return self.mutate(update)
+        except Exception as e:
+            logger.exception(f"保存应用出错状态时出错: {e}")
+            return False
+
+    def get_app_id_by_uuid(self, app_uuid):
+        """通过uuid查找应用ID，找不到返回None"""
+        return self.state_store.find_app_id('uuid', app_uuid)
+
+    def get_app_id_by_start(self, start):
+        """通过启动路径查找应用ID，找不到返回None"""
+        return self.state_store.find_app_id('start', start)
+
+    def get_app_id_by_name(self, name):
+        """通过应用名称查找应用ID，找不到返回None"""
+        return self.state_store.find_app_id('name', name)
+
+    def is_log_path_in_use(self, log_path, exclude_app_id=None):
+        """日志路径是否已被其他应用使用"""
+        return self.state_store.log_path_in_use(log_path, exclude_app_id)
 
     def get_all_app_ids(self):
         """获取所有应用ID"""
@@ -200,73 +450,185 @@ class ConfigManager:
             logger.exception(f"保存配置到文件时出错: {e}")
             return False
 
-    def save_apps_dump(self):
-        """保存应用列表到dump文件"""
+    def _get_dump_data(self):
+        """当前状态、应用状态列表和它们的哈希"""
         from am3.core.app_manager import AppManager
 
         status_data = self.get_status_data()
-        app_manager = AppManager(self)
-        app_list = app_manager.get_app_list()
+        # 保存时以当前的进程状态为准，不读取守护进程的状态表
+        app_list = AppManager(self).get_app_list(use_board=False)
+        digest_data = {
+            'status_hash': self.get_state_hash(status_data),
+            'app_list_hash': canonical_hash(app_list),
+        }
+        return status_data, app_list, digest_data
 
+    def save_apps_dump(self, backup=False):
+        """保存应用列表为一个新的版本，返回版本名，失败时返回None"""
         # 修复旧版本缺少uuid的问题
-        for app_id in status_data['apps']:
-            if 'uuid' not in status_data['apps'][app_id]['app_conf']:
-                status_data['apps'][app_id]['app_conf']['uuid'] = str(uuid.uuid4())
-
-        dump_data = {
-            'status_data': status_data,
-            'app_list': app_list,
-        }
+        def fix_uuid(txn):
+            for app_id, app in txn.items():
+                if 'uuid' not in app['app_conf']:
+                    app['app_conf']['uuid'] = str(uuid.uuid4())
+                    txn.put_app(app_id, app)
 
         try:
-            with open(self.am3_dump_path, 'w', encoding='utf-8') as f:
-                f.write(json.dumps(dump_data, ensure_ascii=False, indent=4))
-            return True
+            self.mutate(fix_uuid)
+            return self.dump_store.save(*self._get_dump_data(), backup=backup)
         except Exception as e:
-            logger.exception(f"保存应用列表到dump文件时出错: {e}")
-            return False
+            logger.exception(f"保存应用列表时出错: {e}")
+            return None
 
-    def load_apps_dump(self):
-        """从dump文件加载应用列表"""
-        if not os.path.exists(self.am3_dump_path):
-            logger.warning('应用列表dump文件不存在')
-            return False
+    def has_apps_dump(self):
+        """是否保存过应用列表"""
+        return self.dump_store.latest() is not None or os.path.exists(self.am3_dump_path)
 
-        # 先备份当前状态
-        self.save_apps_dump_to_file(self.am3_dump_bak_path)
+    def _write_dump_digest(self, digest_data):
+        """保存旧版本 dump 文件的哈希，记录 dump 文件的签名用于判断哈希是否过期"""
+        stat = os.stat(self.am3_dump_path)
+        digest_data = {**digest_data, 'dump_signature': [stat.st_mtime_ns, stat.st_size]}
+        with open(self.am3_dump_digest_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(digest_data, ensure_ascii=False))
 
-        try:
-            with open(self.am3_dump_path, 'r', encoding='utf-8') as f:
-                dump_data = json.loads(f.read())
-                status_data = dump_data['status_data']
+    def get_dump_digest(self):
+        """获取最新保存的应用列表的哈希，没有保存过时返回None
 
-                # 更新系统启动时间
-                status_data['system_boot_time'] = str(datetime.fromtimestamp(psutil.boot_time()))
+        版本目录的哈希直接从 meta.json 读取；只有旧版本的 dump.json 时，
+        优先读取哈希文件，哈希文件不存在或 dump 文件被改动过时解析一次 dump 文件重新计算并保存哈希
+        """
+        generation = self.dump_store.latest()
+        if generation is not None:
+            return self.dump_store.read_meta(generation)
 
-                # 更新状态数据
-                self.update_status_data(status_data)
-                return True
+        if not os.path.exists(self.am3_dump_path):
+            return None
+
+        stat = os.stat(self.am3_dump_path)
+        if os.path.exists(self.am3_dump_digest_path):
+            try:
+                with open(self.am3_dump_digest_path, 'r', encoding='utf-8') as f:
+                    digest_data = json.loads(f.read())
+                if digest_data.get('dump_signature') == [stat.st_mtime_ns, stat.st_size]:
+                    return digest_data
+            except ValueError:
+                pass
+
+        with open(self.am3_dump_path, 'r', encoding='utf-8') as f:
+            dump_data = json.loads(f.read())
+        digest_data = {
+            'status_hash': self.get_state_hash(dump_data['status_data']),
+            'app_list_hash': canonical_hash(dump_data['app_list']),
+        }
+        self._write_dump_digest(digest_data)
+        return digest_data
+
+    def _open_apps_dump(self, generation=None):
+        """打开一个保存的版本，返回 (除应用外的状态字段, 应用ID列表, 读取单个应用的函数)
+
+        没有指定版本时使用最新版本，没有任何版本时使用旧版本的 dump.json
+        """
+        if generation is None:
+            generation = self.dump_store.latest()
+
+        if generation is not None:
+            meta = self.dump_store.read_meta(generation)
+            return meta['status_meta'], meta['app_ids'], lambda app_id: self.dump_store.read_app(generation, app_id)
+
+        with open(self.am3_dump_path, 'r', encoding='utf-8') as f:
+            status_data = json.loads(f.read())['status_data']
+        dump_apps = status_data.pop('apps', {})
+        return status_data, list(dump_apps), lambda app_id: dump_apps[app_id]
+
+    def load_apps_dump(self, generation=None, only=None):
+        """从保存的版本加载应用列表
+
+        Args:
+            generation: 版本名，默认为最新版本
+            only: 只恢复这些应用ID，其他应用和全局配置保持不变
+        """
+        if generation is not None and not self.dump_store.exists(generation):
+            logger.warning(f'应用列表版本 {generation} 不存在')
+            return False
+        if not self.has_apps_dump():
+            logger.warning('没有保存过应用列表')
+            return False
+
+        try:
+            status_meta, dump_app_ids, read_app = self._open_apps_dump(generation)
+            if only is not None:
+                only = [str(app_id) for app_id in only]
+                missing = [app_id for app_id in only if app_id not in dump_app_ids]
+                if missing:
+                    logger.warning(f"保存的应用列表中不存在应用: {', '.join(missing)}")
+                    return False
+            # 只读取需要恢复的应用
+            dump_apps = {app_id: read_app(app_id) for app_id in (only if only is not None else dump_app_ids)}
+
+            # 先备份当前状态
+            self.save_apps_dump(backup=True)
+
+            deleted = []
+
+            def restore(txn):
+                # 在一个事务内删除需要恢复的应用，再按原来的ID注册保存的应用
+                processes = {}
+                deleted.clear()
+                for app_id in (only if only is not None else txn.app_ids()):
+                    app = txn.get_app(app_id)
+                    if app:
+                        processes[app_id] = {key: app[key] for key in ('process', 'instance_processes') if key in app}
+                    if txn.delete_app(app_id):
+                        deleted.append(app_id)
+                for app_id, app in dump_apps.items():
+                    self._register_app(txn, dict(app['app_conf']), app_id)
+                    # 正在运行的应用保留所有实例的进程信息
+                    if processes.get(app_id):
+                        restored = txn.get_app(app_id)
+                        restored.update(processes[app_id])
+                        txn.put_app(app_id, restored)
+                self._check_dependencies(txn, [app['app_conf'] for app in dump_apps.values()])
+                if only is not None:
+                    return
+                for key, value in status_meta.items():
+                    if key not in ('generation', 'apps_digest', 'system_boot_time'):
+                        txn.set_meta(key, value)
+
+            self.mutate(restore)
+            for app_id in deleted:
+                if app_id not in dump_apps:
+                    self.journal.append('delete', app_id)
+            for app_id, app in dump_apps.items():
+                self.journal.append('register', app_id, name=app['app_conf']['name'])
+            return True
+        except DependencyError as e:
+            click.echo(f"错误: {e}")
+            return False
         except Exception as e:
-            logger.exception(f"从dump文件加载应用列表时出错: {e}")
+            logger.exception(f"加载应用列表时出错: {e}")
             return False
 
     def save_apps_dump_to_file(self, file_path):
         """保存应用列表到指定文件"""
         try:
-            with open(self.am3_status_path, 'r') as f:
-                status_data = json.loads(f.read())
-
-            from am3.core.app_manager import AppManager
-            app_manager = AppManager(self)
-            app_list = app_manager.get_app_list()
-
+            status_data, app_list, digest_data = self._get_dump_data()
             dump_data = {
                 'status_data': status_data,
                 'app_list': app_list,
+                **digest_data,
             }
 
-            with open(file_path, 'w', encoding='utf-8') as f:
-                f.write(json.dumps(dump_data, ensure_ascii=False, indent=4))
+            # 先写临时文件再替换，写入中途出错不会破坏原文件
+            directory = os.path.dirname(os.path.abspath(file_path))
+            fd, tmp_path = tempfile.mkstemp(prefix='.dump.', suffix='.tmp', dir=directory)
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    f.write(json.dumps(dump_data, ensure_ascii=False, indent=4))
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, file_path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
             return True
         except Exception as e:
             logger.exception(f"保存应用列表到指定文件时出错: {e}")
@@ -274,9 +636,6 @@ class ConfigManager:
 
     def init_api(self):
         """初始化API服务配置"""
-        # 获取当前配置
-        status_data = self.get_status_data()
-
         # 交互式设置
         default_node_name = socket.gethostname()
         node_name = click.prompt(f'API节点名称', default=default_node_name)
@@ -289,20 +648,24 @@ class ConfigManager:
 
         socketio_path = click.prompt('AM控制中心服务socketio路径', default='/socket.io')
 
-        # 更新配置
-        if 'api' not in status_data:
-            status_data['api'] = {}
+        # 更新配置，只更新 api 字段
+        def update_api(txn):
+            api_data = txn.get_meta('api', {})
+            api_data.update({
+                'node_name': node_name,
+                'api_token': api_token,
+                'server_address': server_address,
+                'namespace': namespace,
+                'socketio_path': socketio_path,
+            })
+            txn.set_meta('api', api_data)
 
-        status_data['api'].update({
-            'node_name': node_name,
-            'api_token': api_token,
-            'server_address': server_address,
-            'namespace': namespace,
-            'socketio_path': socketio_path,
-        })
-
-        # 保存配置
-        return self.update_status_data(status_data)
+        try:
+            self.mutate(update_api)
+            return True
+        except Exception as e:
+            logger.exception(f"保存API配置时出错: {e}")
+            return False
 
     def setup_startup(self):
         """设置开机自启动"""
@@ -0,0 +1,576 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+状态存储模块
+提供可替换的状态存储后端:
+- sqlite: WAL 模式的 SQLite 数据库，每个应用一行，单个应用的修改只写一行
+- json: 旧版的 status.json 整文件存储
+
+所有修改都通过 mutate(fn) 完成，fn 在持有写锁的事务内执行，
+每次提交都会让 generation 加一，可用于乐观并发校验
+
+signature() 在状态变化时随之改变，调用方可以据此缓存解析结果:
+json 后端是文件的 (st_ino, st_mtime_ns, st_size)，sqlite 后端还包括 PRAGMA data_version 和本进程的提交次数
+
+uuid、启动路径、名称到 app_id 的索引以及日志路径集合随每次修改增量维护，
+查找都是 O(1)，不需要遍历所有应用
+
+apps_digest 是所有应用配置摘要的异或，同样随每次修改增量维护，
+用于不解析 dump 文件就能判断当前配置和保存的配置是否一致
+"""
+import os
+import copy
+import json
+import fcntl
+import sqlite3
+import tempfile
+import threading
+
+from loguru import logger
+
+from am3.utils.hash_util import app_digest, apps_digest
+
+# 默认使用的存储后端，可以用环境变量 AM3_STATE_BACKEND 覆盖
+DEFAULT_STATE_BACKEND = 'sqlite'
+
+# 由存储自己维护的顶层字段，整体替换状态时不会被覆盖
+INTERNAL_META_KEYS = ('generation', 'apps_digest')
+
+# 建立索引的字段 索引名 -> app_conf 中的字段
+INDEX_FIELDS = {
+    'uuid': 'uuid',
+    'start': 'start',
+    'name': 'name',
+    'log_path': 'app_log_path',
+}
+
+
+class StateConflictError(Exception):
+    """状态的 generation 与预期不一致，说明期间被其他进程修改过"""
+
+
+def _index_values(app):
+    """应用需要建立索引的字段值"""
+    app_conf = app.get('app_conf', {})
+    return {index: app_conf.get(field) or None for index, field in INDEX_FIELDS.items()}
+
+
+class AppIndex:
+    """内存中的应用索引，索引名 -> 字段值 -> app_id 集合"""
+
+    def __init__(self, apps):
+        self.indexes = {index: {} for index in INDEX_FIELDS}
+        for app_id, app in apps.items():
+            self.add(app_id, app)
+
+    def add(self, app_id, app):
+        for index, value in _index_values(app).items():
+            if value is not None:
+                self.indexes[index].setdefault(value, set()).add(str(app_id))
+
+    def remove(self, app_id, app):
+        for index, value in _index_values(app).items():
+            app_ids = self.indexes[index].get(value)
+            if app_ids:
+                app_ids.discard(str(app_id))
+                if not app_ids:
+                    del self.indexes[index][value]
+
+    def find_app_id(self, index, value):
+        """按字段值查找应用，有多个时返回 id 最小的"""
+        app_ids = self.indexes[index].get(value)
+        if not app_ids:
+            return None
+        return min(app_ids, key=int)
+
+    def log_path_in_use(self, log_path, exclude_app_id=None):
+        """日志路径是否已被其他应用使用"""
+        app_ids = self.indexes['log_path'].get(log_path, set())
+        return bool(app_ids - {str(exclude_app_id)})
+
+
+def _file_signature(path):
+    """文件签名，文件不存在时返回 None"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+class JsonStateTransaction:
+    """status.json 的事务视图，直接修改内存中的状态字典"""
+
+    def __init__(self, status_data):
+        self.status_data = status_data
+        self.generation = status_data.get('generation', 0)
+        self.changed = False
+        self._index = None
+        self._digest = None
+
+    @property
+    def digest(self):
+        """当前所有应用配置摘要的异或，旧版本的状态文件没有保存时现场计算"""
+        if self._digest is None:
+            stored = self.status_data.get('apps_digest')
+            self._digest = int(stored, 16) if stored else apps_digest(self.status_data['apps'])
+        return self._digest
+
+    def _set_digest(self, digest):
+        self._digest = digest
+        self.status_data['apps_digest'] = f'{digest:064x}'
+
+    @property
+    def index(self):
+        """第一次查找时建立索引，之后随修改增量更新"""
+        if self._index is None:
+            self._index = AppIndex(self.status_data['apps'])
+        return self._index
+
+    def get_app(self, app_id):
+        # 返回副本，调用方修改后必须 put_app 才会生效，摘要和索引才能正确更新
+        return copy.deepcopy(self.status_data['apps'].get(str(app_id)))
+
+    def put_app(self, app_id, app):
+        old_app = self.status_data['apps'].get(str(app_id))
+        digest = self.digest
+        if old_app is not None:
+            digest ^= app_digest(app_id, old_app)
+        self._set_digest(digest ^ app_digest(app_id, app))
+        if self._index is not None:
+            if old_app is not None:
+                self._index.remove(app_id, old_app)
+            self._index.add(app_id, app)
+        self.status_data['apps'][str(app_id)] = app
+        self.changed = True
+
+    def delete_app(self, app_id):
+        if str(app_id) not in self.status_data['apps']:
+            return False
+        digest = self.digest
+        old_app = self.status_data['apps'].pop(str(app_id))
+        self._set_digest(digest ^ app_digest(app_id, old_app))
+        if self._index is not None:
+            self._index.remove(app_id, old_app)
+        self.changed = True
+        return True
+
+    def find_app_id(self, index, value):
+        return self.index.find_app_id(index, value)
+
+    def log_path_in_use(self, log_path, exclude_app_id=None):
+        return self.index.log_path_in_use(log_path, exclude_app_id)
+
+    def app_ids(self):
+        return list(self.status_data['apps'].keys())
+
+    def items(self):
+        return copy.deepcopy(list(self.status_data['apps'].items()))
+
+    def next_app_id(self):
+        return str(max((int(app_id) for app_id in self.status_data['apps']), default=-1) + 1)
+
+    def get_meta(self, key, default=None):
+        return self.status_data.get(key, default)
+
+    def set_meta(self, key, value):
+        self.status_data[key] = value
+        self.changed = True
+
+    def replace_all(self, status_data):
+        """整体替换状态，generation 不随之回退"""
+        self.status_data.clear()
+        self.status_data.update({key: value for key, value in status_data.items()
+                                 if key not in INTERNAL_META_KEYS})
+        self.status_data.setdefault('apps', {})
+        self._index = None
+        self._set_digest(apps_digest(self.status_data['apps']))
+        self.changed = True
+
+
+class JsonStateStore:
+    """status.json 整文件存储，每次修改都会重写整个文件"""
+
+    backend = 'json'
+
+    def __init__(self, status_path):
+        self.status_path = status_path
+        # 写入是 临时文件+重命名，文件的 inode 会变，所以单独用一个锁文件
+        self.lock_path = f'{status_path}.lock'
+        self._index_cache = None
+
+    def exists(self):
+        """状态是否已经初始化"""
+        return os.path.exists(self.status_path)
+
+    def initialize(self, status_data):
+        """写入初始状态"""
+        def init(txn):
+            if not txn.app_ids() and txn.get_meta('version') is None:
+                logger.info('初始化 am3 status 文件')
+                txn.replace_all(status_data)
+
+        self.mutate(init)
+
+    def signature(self):
+        """status.json 的文件签名，每次写入都会换成新的 inode"""
+        return _file_signature(self.status_path)
+
+    def load(self):
+        """读取完整状态，写入是原子替换的，读取不需要加锁"""
+        with open(self.status_path, 'r') as f:
+            return json.loads(f.read())
+
+    def get_app(self, app_id):
+        """读取单个应用"""
+        return self.load()['apps'].get(str(app_id))
+
+    def _get_index(self):
+        """整文件存储没有持久化的索引，按文件签名缓存一份内存索引"""
+        signature = self.signature()
+        if self._index_cache is None or self._index_cache[0] != signature:
+            self._index_cache = (signature, AppIndex(self.load()['apps']))
+        return self._index_cache[1]
+
+    def find_app_id(self, index, value):
+        """按索引查找应用"""
+        return self._get_index().find_app_id(index, value)
+
+    def log_path_in_use(self, log_path, exclude_app_id=None):
+        """日志路径是否已被其他应用使用"""
+        return self._get_index().log_path_in_use(log_path, exclude_app_id)
+
+    def _write_atomic(self, status_data):
+        """写入临时文件后重命名，崩溃时不会留下写了一半的 status.json"""
+        directory = os.path.dirname(self.status_path)
+        fd, tmp_path = tempfile.mkstemp(prefix='.status.', suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(json.dumps(status_data, ensure_ascii=False, indent=4))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.status_path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def mutate(self, fn, expected_generation=None):
+        """在文件锁内完成 读取-修改-写入，返回 fn 的返回值"""
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                if os.path.exists(self.status_path):
+                    status_data = self.load()
+                else:
+                    status_data = {'apps': {}}
+                txn = JsonStateTransaction(status_data)
+                if expected_generation is not None and txn.generation != expected_generation:
+                    raise StateConflictError(f'状态已被修改: {txn.generation} != {expected_generation}')
+
+                result = fn(txn)
+                if txn.changed:
+                    status_data['generation'] = txn.generation + 1
+                    self._write_atomic(status_data)
+                return result
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+# 数据库表结构版本
+SCHEMA_VERSION = 2
+
+_SQL_PUT_APP = (
+    f"INSERT OR REPLACE INTO apps (app_id, data, digest, {', '.join(INDEX_FIELDS)}) "
+    f"VALUES (?, ?, ?, {', '.join('?' for _ in INDEX_FIELDS)})"
+)
+
+
+def _app_row(app_id, app):
+    """apps 表的一行数据，摘要和索引字段单独成列"""
+    return (int(app_id), json.dumps(app, ensure_ascii=False), f'{app_digest(app_id, app):064x}',
+            *_index_values(app).values())
+
+
+def _index_column(index):
+    if index not in INDEX_FIELDS:
+        raise ValueError(f'不支持的索引: {index}')
+    return index
+
+
+class SqliteStateTransaction:
+    """SQLite 的事务视图，每个操作直接对应一条 SQL"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        row = conn.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()
+        self.generation = json.loads(row[0]) if row else 0
+        self.changed = False
+        self.digest = None
+
+    def get_app(self, app_id):
+        row = self.conn.execute('SELECT data FROM apps WHERE app_id = ?', (int(app_id),)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def _load_digest(self):
+        """读取 meta 中保存的所有应用摘要的异或"""
+        if self.digest is None:
+            self.digest = int(self.get_meta('apps_digest', '0' * 64), 16)
+        return self.digest
+
+    def _pop_app_digest(self, app_id):
+        """从总摘要中异或掉一个应用的旧摘要，应用不存在时返回False"""
+        row = self.conn.execute('SELECT digest FROM apps WHERE app_id = ?', (int(app_id),)).fetchone()
+        if row is None:
+            return False
+        self.digest = self._load_digest() ^ int(row[0], 16)
+        return True
+
+    def put_app(self, app_id, app):
+        self._pop_app_digest(app_id)
+        row = _app_row(app_id, app)
+        self.conn.execute(_SQL_PUT_APP, row)
+        self.digest = self._load_digest() ^ int(row[2], 16)
+        self.changed = True
+
+    def delete_app(self, app_id):
+        if not self._pop_app_digest(app_id):
+            return False
+        self.conn.execute('DELETE FROM apps WHERE app_id = ?', (int(app_id),))
+        self.changed = True
+        return True
+
+    def app_ids(self):
+        return [str(row[0]) for row in self.conn.execute('SELECT app_id FROM apps ORDER BY app_id')]
+
+    def items(self):
+        return [
+            (str(app_id), json.loads(data))
+            for app_id, data in self.conn.execute('SELECT app_id, data FROM apps ORDER BY app_id')
+        ]
+
+    def next_app_id(self):
+        row = self.conn.execute('SELECT MAX(app_id) FROM apps').fetchone()
+        return str(0 if row[0] is None else row[0] + 1)
+
+    def find_app_id(self, index, value):
+        """按索引查找应用，有多个时返回 id 最小的"""
+        row = self.conn.execute(
+            f'SELECT MIN(app_id) FROM apps WHERE {_index_column(index)} = ?', (value,)
+        ).fetchone()
+        return None if row[0] is None else str(row[0])
+
+    def log_path_in_use(self, log_path, exclude_app_id=None):
+        """日志路径是否已被其他应用使用"""
+        exclude_app_id = -1 if exclude_app_id is None else int(exclude_app_id)
+        row = self.conn.execute(
+            'SELECT 1 FROM apps WHERE log_path = ? AND app_id != ? LIMIT 1', (log_path, exclude_app_id)
+        ).fetchone()
+        return row is not None
+
+    def get_meta(self, key, default=None):
+        row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return default
+        return json.loads(row[0])
+
+    def set_meta(self, key, value):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+            (key, json.dumps(value, ensure_ascii=False))
+        )
+        self.changed = True
+
+    def replace_all(self, status_data):
+        """整体替换状态，generation 不随之回退"""
+        conn = self.conn
+        conn.execute('DELETE FROM apps')
+        conn.execute(f"DELETE FROM meta WHERE key NOT IN ({', '.join('?' for _ in INTERNAL_META_KEYS)})",
+                     INTERNAL_META_KEYS)
+        rows = [_app_row(app_id, app) for app_id, app in status_data.get('apps', {}).items()]
+        conn.executemany(_SQL_PUT_APP, rows)
+        conn.executemany(
+            'INSERT INTO meta (key, value) VALUES (?, ?)',
+            [(key, json.dumps(value, ensure_ascii=False))
+             for key, value in status_data.items() if key != 'apps' and key not in INTERNAL_META_KEYS]
+        )
+        self.digest = 0
+        for row in rows:
+            self.digest ^= int(row[2], 16)
+        self.changed = True
+
+
+class SqliteStateStore:
+    """WAL 模式的 SQLite 存储，apps 表每个应用一行，meta 表保存其余顶层字段"""
+
+    backend = 'sqlite'
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        # sqlite3 连接不能跨线程使用，批量操作的工作线程各自打开连接
+        self._local = threading.local()
+        # 本进程的提交次数，data_version 不反映同一个连接自己的提交
+        self._commits = 0
+        self._commits_lock = threading.Lock()
+
+    @property
+    def conn(self):
+        """延迟打开当前线程的数据库连接"""
+        if getattr(self._local, 'conn', None) is None:
+            # isolation_level=None 表示自动提交，事务由 BEGIN IMMEDIATE 显式控制
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS apps (app_id INTEGER PRIMARY KEY, data TEXT NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            self._upgrade_schema(conn)
+            self._local.conn = conn
+        return self._local.conn
+
+    def _upgrade_schema(self, conn):
+        """按 user_version 升级表结构"""
+        if conn.execute('PRAGMA user_version').fetchone()[0] >= SCHEMA_VERSION:
+            return
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # 拿到写锁后再检查一次，其他进程可能已经升级完成
+            if conn.execute('PRAGMA user_version').fetchone()[0] < SCHEMA_VERSION:
+                # 版本1: 为索引字段增加单独的列
+                # 版本2: 增加应用配置摘要列，meta 中保存所有摘要的异或
+                columns = {row[1] for row in conn.execute('PRAGMA table_info(apps)')}
+                for column in ('digest', *INDEX_FIELDS):
+                    if column not in columns:
+                        conn.execute(f'ALTER TABLE apps ADD COLUMN {column} TEXT')
+                for index in INDEX_FIELDS:
+                    conn.execute(f'CREATE INDEX IF NOT EXISTS idx_apps_{index} ON apps ({index})')
+
+                # 回填已有数据
+                rows = [_app_row(app_id, json.loads(data))
+                        for app_id, data in conn.execute('SELECT app_id, data FROM apps').fetchall()]
+                conn.executemany(_SQL_PUT_APP, rows)
+                digest = 0
+                for row in rows:
+                    digest ^= int(row[2], 16)
+                conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('apps_digest', ?)",
+                             (json.dumps(f'{digest:064x}'),))
+            conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def close(self):
+        """关闭当前线程的连接"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def exists(self):
+        """状态是否已经初始化，以 meta 表中存在 version 为准"""
+        if not os.path.exists(self.db_path):
+            return False
+        row = self.conn.execute("SELECT 1 FROM meta WHERE key = 'version'").fetchone()
+        return row is not None
+
+    def initialize(self, status_data, status_path=None):
+        """初始化数据库，如果存在旧的 status.json 则自动迁移"""
+        migrated = []
+
+        def init(txn):
+            # 拿到写锁后再检查一次，防止多个进程同时初始化
+            if txn.get_meta('version') is not None:
+                return
+            initial_status = status_data
+            if status_path and os.path.exists(status_path):
+                with open(status_path, 'r') as f:
+                    content = f.read()
+                if content:
+                    logger.info(f'迁移 {status_path} 到 {self.db_path}')
+                    # 旧文件可能缺少部分字段，用默认值补齐
+                    initial_status = {**status_data, **json.loads(content)}
+                    migrated.append(status_path)
+            else:
+                logger.info('初始化 am3 状态数据库')
+            txn.replace_all(initial_status)
+
+        self.mutate(init)
+
+        if migrated:
+            # 保留旧文件作为备份，同时避免再次迁移
+            os.replace(status_path, f'{status_path}.migrated')
+
+    def signature(self):
+        """状态的签名
+
+        检查点之后 WAL 从头重写，inode 和大小不变，同一个时间戳精度内的两次提交文件签名可能相同，
+        所以还要加上 PRAGMA data_version(其他连接提交后改变)和本进程的提交次数
+        """
+        if not os.path.exists(self.db_path):
+            return None
+        data_version = self.conn.execute('PRAGMA data_version').fetchone()[0]
+        return (_file_signature(self.db_path), _file_signature(f'{self.db_path}-wal'),
+                data_version, self._commits)
+
+    def load(self):
+        """读取完整状态"""
+        conn = self.conn
+        status_data = {key: json.loads(value) for key, value in conn.execute('SELECT key, value FROM meta')}
+        status_data['apps'] = {
+            str(app_id): json.loads(data)
+            for app_id, data in conn.execute('SELECT app_id, data FROM apps ORDER BY app_id')
+        }
+        return status_data
+
+    def get_app(self, app_id):
+        """读取单个应用"""
+        return SqliteStateTransaction(self.conn).get_app(app_id)
+
+    def find_app_id(self, index, value):
+        """按索引查找应用，直接使用数据库索引"""
+        return SqliteStateTransaction(self.conn).find_app_id(index, value)
+
+    def log_path_in_use(self, log_path, exclude_app_id=None):
+        """日志路径是否已被其他应用使用"""
+        return SqliteStateTransaction(self.conn).log_path_in_use(log_path, exclude_app_id)
+
+    def mutate(self, fn, expected_generation=None):
+        """在一个写事务内执行 fn，返回 fn 的返回值"""
+        conn = self.conn
+        # BEGIN IMMEDIATE 会立即拿到写锁，整个 读取-修改-写入 过程都在锁内
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            txn = SqliteStateTransaction(conn)
+            if expected_generation is not None and txn.generation != expected_generation:
+                raise StateConflictError(f'状态已被修改: {txn.generation} != {expected_generation}')
+
+            result = fn(txn)
+            if txn.changed:
+                conn.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES ('generation', ?)",
+                    (json.dumps(txn.generation + 1),)
+                )
+            if txn.digest is not None:
+                conn.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES ('apps_digest', ?)",
+                    (json.dumps(f'{txn.digest:064x}'),)
+                )
+            conn.execute('COMMIT')
+            with self._commits_lock:
+                self._commits += 1
+            return result
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+
+def create_state_store(data_path, backend=None):
+    """根据配置创建状态存储后端"""
+    backend = backend or os.environ.get('AM3_STATE_BACKEND') or DEFAULT_STATE_BACKEND
+    if backend == 'json':
+        return JsonStateStore(os.path.join(data_path, 'status.json'))
+    if backend == 'sqlite':
+        return SqliteStateStore(os.path.join(data_path, 'state.db'))
+    raise ValueError(f'不支持的状态存储后端: {backend}')
@@ -7,17 +7,58 @@
 import os
 import sys
 import json
+import math
+import time
+import threading
 import subprocess
+import contextvars
 from datetime import datetime
+from concurrent.futures import Future, FIRST_COMPLETED, wait
 
 import click
 import psutil
 from loguru import logger
 from prettytable import PrettyTable
 
-from am3.utils.color_util import bright_cyan, bool_color, green
-from am3.utils.path_util import format_path, format_name
+from am3.config.dependency import DependencyError, check_dependencies, reverse_dependencies
+from am3.config.instances import app_processes, instance_count, instance_log_path
+from am3.utils.color_util import bright_cyan, bool_color, green, red
+from am3.utils.hash_util import canonical_hash
+from am3.utils.output_util import RowWriter
+from am3.utils.path_util import format_path, get_working_directory, resolve_path
+from am3.utils.process_util import is_same_process, ProcessTable
 from am3.process.process_manager import ProcessManager
+from am3.process.metrics import MetricsRing
+from am3.core.dashboard import Dashboard, format_bytes
+from am3.core.status_board import StatusBoard
+
+
+# 机器可读输出中各命令的字段
+APP_LIST_FIELDS = ['app_id', 'name', 'running', 'state', 'pid', 'children', 'instances', 'uuid', 'start',
+                   'working_directory', 'app_log_path']
+HISTORY_FIELDS = ['ts', 'event', 'app_id', 'instance', 'pid', 'rc', 'utime', 'stime', 'maxrss', 'reason', 'name']
+# 批量启动、停止、重启时默认同时处理的应用数量
+DEFAULT_PARALLEL = 8
+
+STATS_FIELDS = ['ts', 'cpu_percent', 'rss', 'read_bytes', 'write_bytes', 'read_rate', 'write_rate', 'fds']
+
+
+def _run_in_thread(fn, *args):
+    """在新的守护线程中执行 fn，返回 Future，命令退出时不等待还没有完成的线程
+
+    在当前线程的上下文中执行，守护进程中执行时输出能回到发起命令的客户端
+    """
+    future = Future()
+    context = contextvars.copy_context()
+
+    def target():
+        try:
+            future.set_result(context.run(fn, *args))
+        except Exception as e:
+            future.set_exception(e)
+
+    threading.Thread(target=target, daemon=True).start()
+    return future
 
 
 class AppManager:
@@ -28,15 +69,105 @@ class AppManager:
         self.config_manager = config_manager
         self.process_manager = ProcessManager(config_manager)
 
-    def get_app_list(self):
-        """获取应用列表"""
+    def get_app_statuses(self, apps=None, process_table=None):
+        """一次遍历进程表，得到所有应用的运行状态
+
+        Args:
+            apps: 应用记录，默认为所有应用
+            process_table: 进程表快照，不提供时重新遍历
+
+        Returns:
+            {app_id: {'running': 是否运行,
+                      'pid': 第一个运行中实例的应用进程PID，应用正在重启时为None,
+                      'pids': 应用的所有PID，每个实例的监控进程排在它的进程前面,
+                      'children': 除监控进程和应用进程以外的子孙进程数量，没有运行时为None,
+                      'instances': {运行中的实例编号: 监控进程PID}}}
+        """
+        if apps is None:
+            apps = self.config_manager.get_status_data()['apps']
+
+        if process_table is None:
+            process_table = ProcessTable()
+        statuses = {}
+        for app_id, app in apps.items():
+            instances = self._resolve_instances(app, process_table)
+            app_pids = self._instance_app_pids(app, instances)
+            pids = self._app_pids(app, instances, process_table)
+            statuses[app_id] = {
+                'running': bool(instances),
+                'pid': next((pid for pid in app_pids.values() if pid is not None), None),
+                'pids': pids,
+                'children': len(set(pids) - set(instances.values()) - set(app_pids.values()))
+                if instances else None,
+                'instances': instances,
+            }
+        return statuses
+
+    def _instance_app_pids(self, app, instances):
+        """运行中实例的应用进程PID {实例编号: PID}
+
+        监控进程启动应用后把应用进程的PID记录为 app_pid，由引擎启动或旧版本启动的应用记录的就是应用进程
+        """
+        processes = app_processes(app)
+        return {index: processes[index].get('app_pid', pid) if index in processes else pid
+                for index, pid in instances.items()}
+
+    def _app_pids(self, app, instances, process_table):
+        """应用所有运行中实例的进程，优先使用 cgroup / 进程组的成员，旧版本启动的应用遍历进程树"""
+        processes = app_processes(app)
+        pids = []
+        for index, pid in instances.items():
+            if index in processes:
+                pids.extend(process_table.members(processes[index]))
+            else:
+                pids.extend(process_table.tree(pid))
+        return pids
+
+    def _resolve_instances(self, app, process_table):
+        """在进程表快照中查找应用每个实例的监控进程，返回 {运行中的实例编号: 监控进程PID}"""
+        processes = app_processes(app)
+        if processes:
+            return {index: identity['pid'] for index, identity in processes.items()
+                    if process_table.is_same_process(identity)}
+
+        # 旧版本启动的应用只记录了PID文件
+        app_pid_file = app['app_conf'].get('app_pid_file')
+        if not app_pid_file or not os.path.exists(app_pid_file):
+            return {}
+        try:
+            with open(app_pid_file) as f:
+                app_pid = int(f.read().strip())
+        except (OSError, ValueError):
+            return {}
+        return {0: app_pid} if process_table.pid_exists(app_pid) else {}
+
+    def read_status_board(self):
+        """读取 supervisor 守护进程发布的应用状态表，返回 AppStatus 列表，守护进程没有运行时返回None"""
+        return StatusBoard(self.config_manager.am3_status_board_path).read()
+
+    def get_app_list(self, statuses=None, use_board=True):
+        """获取应用列表，statuses 为 get_app_statuses() 的结果
+
+        不提供 statuses 时优先读取守护进程发布的状态表(最多延迟 1 秒)，use_board 为False或状态表失效时重新获取
+        """
+        if statuses is None and use_board:
+            board = self.read_status_board()
+            if board is not None:
+                return [{
+                    'app_id': status.app_id,
+                    'app_name': status.name,
+                    'app_is_running': status.state == 'running',
+                    'uuid': status.uuid,
+                } for status in board]
+
         status_data = self.config_manager.get_status_data()
+        if statuses is None:
+            statuses = self.get_app_statuses(status_data['apps'])
         app_list = []
 
         for app_id in status_data['apps']:
             app = status_data['apps'][app_id]
-            # 检查应用是否在运行
-            app_is_running = self.check_app_running(app)
+            app_is_running = statuses[app_id]['running'] if app_id in statuses else False
 
             app_list.append({
                 'app_id': app_id,
@@ -47,13 +178,83 @@ class AppManager:
 
         return app_list
 
-    def list_apps(self, show_details=False):
-        """列出所有应用"""
-        app_list = self.get_app_list()
+    def _board_list_statuses(self, apps):
+        """从守护进程发布的状态表得到 am list 需要的状态，不需要遍历进程表
+
+        状态表失效或和状态存储中的应用不一致时返回None
+        """
+        board = self.read_status_board()
+        if board is None:
+            return None
+        statuses = {status.app_id: {
+            'running': status.state == 'running',
+            'state': status.state,
+            'pid': status.pid,
+            'children': status.children,
+            'running_instances': status.instances,
+        } for status in board}
+        return statuses if statuses.keys() == apps.keys() else None
+
+    def _scan_list_statuses(self, apps, process_table=None):
+        """遍历进程表得到 am list 需要的状态，格式和 _board_list_statuses 相同"""
+        return {app_id: {
+            'running': status['running'],
+            'state': 'running' if status['running'] else 'errored' if apps[app_id].get('errored') else 'stopped',
+            'pid': status['pid'],
+            'children': status['children'],
+            'running_instances': len(status['instances']),
+        } for app_id, status in self.get_app_statuses(apps, process_table).items()}
+
+    def write_app_list(self, output_format, board_only=False):
+        """以机器可读的格式逐个输出应用，解析一个输出一个，不输出颜色，也不检查配置一致性
+
+        守护进程发布的状态表有效时直接使用，board_only 为True时状态表无效则不输出并返回False
+        """
+        apps = self.config_manager.get_status_data()['apps']
+        board = self._board_list_statuses(apps)
+        if board is None and board_only:
+            return False
+        process_table = ProcessTable() if board is None else None
+        writer = RowWriter(output_format, APP_LIST_FIELDS)
+        for app_id, app in apps.items():
+            status = board[app_id] if board is not None else self._scan_list_statuses({app_id: app}, process_table)[app_id]
+            app_conf = app['app_conf']
+            writer.write({
+                'app_id': app_id,
+                'name': app_conf['name'],
+                'running': status['running'],
+                'state': status['state'],
+                'pid': status['pid'],
+                'children': status['children'],
+                'instances': instance_count(app_conf),
+                'uuid': app_conf.get('uuid'),
+                'start': app_conf.get('start'),
+                'working_directory': app_conf.get('working_directory'),
+                'app_log_path': app_conf.get('app_log_path'),
+            })
+        writer.close()
+        return True
+
+    def list_apps(self, show_details=False, output_format=None, board_only=False):
+        """列出所有应用，指定 output_format 时以机器可读的格式输出
+
+        守护进程发布的状态表有效时直接使用，不遍历进程表；
+        board_only 为True时状态表无效则不输出并返回False，由调用方交给守护进程或自己遍历
+        """
+        if output_format:
+            return self.write_app_list(output_format, board_only)
+
+        status_data = self.config_manager.get_status_data()
+        statuses = self._board_list_statuses(status_data['apps'])
+        if statuses is None:
+            if board_only:
+                return False
+            statuses = self._scan_list_statuses(status_data['apps'])
+        app_list = self.get_app_list(statuses)
 
         if not app_list:
             click.echo("没有注册的应用")
-            return
+            return True
 
         # 创建表格
         table = PrettyTable()
@@ -61,20 +262,20 @@ class AppManager:
         # 设置表头
         field_names = ['ID', '名称', '运行中']
         if show_details:
-            field_names.extend(['启动路径', '工作目录', 'PID文件'])
+            field_names.extend(['启动路径', '工作目录', 'PID', '子进程', '实例'])
 
         # 设置标题颜色
         colored_field_names = [bright_cyan(name) for name in field_names]
         table.field_names = colored_field_names
 
         # 添加数据行
-        status_data = self.config_manager.get_status_data()
         for app in app_list:
             app_id = app['app_id']
+            app_status = statuses[app_id]
             row = [
                 bright_cyan(app_id),
                 app['app_name'],
-                bool_color(app['app_is_running'])
+                red('errored') if app_status['state'] == 'errored' else bool_color(app['app_is_running'])
             ]
 
             if show_details:
@@ -82,7 +283,9 @@ class AppManager:
                 row.extend([
                     app_conf['start'],
                     app_conf['working_directory'],
-                    app_conf['app_pid_file']
+                    app_status['pid'] or '',
+                    app_status['children'] if app_status['children'] is not None else '',
+                    f"{app_status['running_instances']}/{instance_count(app_conf)}",
                 ])
 
             table.add_row(row)
@@ -91,31 +294,17 @@ class AppManager:
         click.echo(table)
 
         # 检查应用列表是否已保存
-        if not os.path.exists(self.config_manager.am3_dump_path):
+        if not self.config_manager.has_apps_dump():
             if app_list:
                 click.echo(f"应用列表未保存，请使用 {green('am save')} 来保存应用列表")
-            return
+            return True
 
-        # 检查配置一致性
+        # 检查配置一致性，只比较哈希，不解析 dump 文件
         try:
-            with open(self.config_manager.am3_dump_path, 'r', encoding='utf-8') as f:
-                dump_data = json.loads(f.read())
-                dump_status_data = dump_data['status_data']
-                dump_app_list = dump_data['app_list']
-
-            status_data = self.config_manager.get_status_data()
-
-            # 移除启动时间再比较
-            status_data_copy = status_data.copy()
-            dump_status_data_copy = dump_status_data.copy()
-
-            if 'system_boot_time' in status_data_copy:
-                status_data_copy.pop('system_boot_time')
-            if 'system_boot_time' in dump_status_data_copy:
-                dump_status_data_copy.pop('system_boot_time')
+            dump_digest = self.config_manager.get_dump_digest()
 
-            configs_match = status_data_copy == dump_status_data_copy
-            lists_match = app_list == dump_app_list
+            configs_match = self.config_manager.get_state_hash() == dump_digest['status_hash']
+            lists_match = canonical_hash(app_list) == dump_digest['app_list_hash']
 
             click.echo(f"应用配置一致: {configs_match}")
             click.echo(f"应用状态列表一致: {lists_match}")
@@ -124,12 +313,22 @@ class AppManager:
                 click.echo(f"应用配置和状态可能有修改, 请使用 {green('am save')} 进行保存")
         except Exception as e:
             logger.exception(f"检查配置一致性时出错: {e}")
+        return True
 
-    def check_app_running(self, app):
-        """检查应用是否在运行"""
-        app_pid_file = app['app_conf']['app_pid_file']
+    def watch_apps(self, interval=2.0):
+        """持续刷新应用的资源占用，按 Ctrl+C 退出"""
+        Dashboard(self, interval).run()
+        return True
 
-        if not os.path.exists(app_pid_file):
+    def check_app_running(self, app):
+        """检查应用是否在运行(有一个实例在运行即可)，比较记录的进程身份，PID被复用不会误判为运行中"""
+        processes = app_processes(app)
+        if processes:
+            return any(is_same_process(identity) for identity in processes.values())
+
+        # 旧版本启动的应用只记录了PID文件
+        app_pid_file = app['app_conf'].get('app_pid_file')
+        if not app_pid_file or not os.path.exists(app_pid_file):
             return False
 
         try:
@@ -141,8 +340,8 @@ class AppManager:
             logger.exception(f"检查应用运行状态时出错: {e}")
             return False
 
-    def start_app_by_id(self, app_id):
-        """通过ID启动应用"""
+    def start_app_by_id(self, app_id, timeout=None):
+        """通过ID启动应用，timeout 为前置检查最多等待的秒数"""
         app_id = str(app_id)
         logger.info(f"启动应用 ID: {app_id}")
 
@@ -158,11 +357,10 @@ class AppManager:
             self.stop_app_by_id(app_id)
 
         # 启动应用
-        return self.process_manager.start_process(app['app_conf'])
+        return self.process_manager.start_process(app['app_conf'], app_id, timeout)
 
-    def start_app(self, app_config):
-        """启动新应用"""
-        # 处理应用配置
+    def _prepare_app_config(self, app_config):
+        """补全新应用的配置，缺少启动路径时返回False"""
         if not app_config.get('start'):
             click.echo("错误: 必须提供启动路径")
             return False
@@ -172,8 +370,9 @@ class AppManager:
 
         # 设置工作目录
         if not app_config.get('working_directory'):
-            app_config['working_directory'] = os.getcwd()
-        app_config['working_directory'] = format_path(app_config['working_directory'])
+            app_config['working_directory'] = get_working_directory()
+        # 工作目录不会在 PATH 中查找，相对路径总是按当前命令的工作目录解析
+        app_config['working_directory'] = resolve_path(app_config['working_directory'])
 
         # 猜测解释器
         if not app_config.get('interpreter'):
@@ -189,32 +388,20 @@ class AppManager:
                 name = name.rsplit('.', 1)[0]
             app_config['name'] = name
 
-        # 设置日志路径
-        if not app_config.get('app_log_path'):
-            app_log_path = f"{self.config_manager.am3_logs_path}/{format_name(app_config['name'])}.log"
-
-            # 检查是否有重名的应用日志
-            status_data = self.config_manager.get_status_data()
-            log_paths = set()
-
-            for app_id in status_data['apps']:
-                other_app = status_data['apps'][app_id]['app_conf']
-                if other_app['start'] != app_config['start']:
-                    log_paths.add(other_app.get('app_log_path', ''))
-
-            # 如果日志路径冲突，添加序号
-            counter = 0
-            while app_log_path in log_paths:
-                counter += 1
-                app_log_path = f"{self.config_manager.am3_logs_path}/{format_name(app_config['name'])}-{counter}.log"
-
-            app_config['app_log_path'] = app_log_path
-
         # 添加UUID
         if not app_config.get('uuid'):
             import uuid
             app_config['uuid'] = str(uuid.uuid4())
 
+        # 日志路径在保存配置时分配，保证和其他应用不冲突
+        return True
+
+    def start_app(self, app_config):
+        """启动新应用"""
+        # 处理应用配置
+        if not self._prepare_app_config(app_config):
+            return False
+
         # 保存应用配置
         success, app_id = self.config_manager.save_app_config(app_config)
 
@@ -223,7 +410,7 @@ class AppManager:
             return False
 
         # 启动应用
-        return self.process_manager.start_process(app_config)
+        return self.process_manager.start_process(app_config, app_id)
 
     def generate_app_config(self, app_config, output_file):
         """生成应用配置文件
@@ -247,8 +434,9 @@ class AppManager:
 
         # 设置工作目录
         if not app_config.get('working_directory'):
-            app_config['working_directory'] = os.getcwd()
-        app_config['working_directory'] = format_path(app_config['working_directory'])
+            app_config['working_directory'] = get_working_directory()
+        # 工作目录不会在 PATH 中查找，相对路径总是按当前命令的工作目录解析
+        app_config['working_directory'] = resolve_path(app_config['working_directory'])
 
         # 猜测解释器
         if not app_config.get('interpreter'):
@@ -280,14 +468,38 @@ class AppManager:
             click.echo(f"生成配置文件失败: {e}")
             return False
 
-    def start_app_from_config(self, config_file):
-        """从配置文件启动应用"""
+    def start_apps(self, app_configs, parallel=None, timeout=None):
+        """批量注册并启动新应用，所有配置在一个事务内保存"""
+        for app_config in app_configs:
+            if not self._prepare_app_config(app_config):
+                return False
+
+        success, app_ids = self.config_manager.register_many(app_configs)
+        if not success:
+            click.echo("保存应用配置失败")
+            return False
+
+        # 注册时已经检查过依赖，这里按依赖顺序启动
+        dependencies = self._get_dependencies()
+        if dependencies is None:
+            return False
+        return self._start_in_order(app_ids, dependencies, parallel, timeout) == len(app_ids)
+
+    def start_app_from_config(self, config_file, parallel=None, timeout=None):
+        """从配置文件启动应用
+
+        配置文件可以是单个应用配置，也可以是应用配置列表或 {"apps": [...]}
+        """
         app_config = self.config_manager.load_app_config_from_file(config_file)
 
         if not app_config:
             click.echo(f"错误: 无法加载配置文件 {config_file}")
             return False
 
+        if isinstance(app_config, dict) and isinstance(app_config.get('apps'), list):
+            return self.start_apps(app_config['apps'], parallel, timeout)
+        if isinstance(app_config, list):
+            return self.start_apps(app_config, parallel, timeout)
         return self.start_app(app_config)
 
     def stop_app_by_id(self, app_id):
@@ -301,18 +513,83 @@ class AppManager:
             return False
 
         app = status_data['apps'][app_id]
-        return self.process_manager.stop_process(app['app_conf'])
+        return self.process_manager.stop_process(app['app_conf'], app_id)
 
-    def restart_app_by_id(self, app_id):
-        """重启应用"""
+    def restart_app_by_id(self, app_id, timeout=None):
+        """重启应用，多实例的应用在运行时逐个滚动重启"""
         app_id = str(app_id)
         logger.info(f"重启应用 ID: {app_id}")
 
+        app_config = self.config_manager.get_app_config(app_id)
+        if app_config and instance_count(app_config) > 1 and self.process_manager.is_running(app_id):
+            return self._rolling_restart(app_id, app_config, timeout)
+
         # 先停止再启动
         if self.stop_app_by_id(app_id):
-            return self.start_app_by_id(app_id)
+            return self.start_app_by_id(app_id, timeout)
         return False
 
+    def _rolling_restart(self, app_id, app_config, timeout=None):
+        """逐个重启应用的实例，一个实例就绪后才重启下一个，重启期间其他实例一直在运行
+
+        某个实例没有就绪时停止滚动，还没有重启的实例保持运行
+        """
+        count = instance_count(app_config)
+        app = self.config_manager.get_status_data()['apps'][app_id]
+        # 减少实例数量后还没有停止的实例
+        for index in app_processes(app):
+            if index >= count:
+                self.process_manager.stop_process(app_config, app_id, index)
+
+        for index in range(count):
+            click.echo(f"重启应用 {app_config['name']} 的实例 {index} ({index + 1}/{count})")
+            if not self.process_manager.stop_process(app_config, app_id, index):
+                click.echo(f"错误: 停止实例 {index} 失败，停止滚动重启")
+                return False
+            if not (self.process_manager.start_process(app_config, app_id, timeout, index)
+                    and self.process_manager.wait_ready(app_config, app_id, timeout, index)):
+                click.echo(f"错误: 实例 {index} 没有就绪，停止滚动重启，其余实例保持运行")
+                return False
+        return True
+
+    def scale_app(self, app_id, count, timeout=None):
+        """调整应用的实例数量，应用在运行时启动新增的实例、停止多出的实例"""
+        app_id = str(app_id)
+        logger.info(f"调整应用 ID: {app_id} 的实例数量为 {count}")
+
+        status_data = self.config_manager.get_status_data()
+        if app_id not in status_data['apps']:
+            click.echo(f"错误: 应用ID {app_id} 不存在")
+            return False
+        if count < 1:
+            click.echo("错误: 实例数量至少为 1")
+            return False
+
+        running = self.check_app_running(status_data['apps'][app_id])
+        if not self.config_manager.set_app_instances(app_id, count):
+            click.echo("保存应用配置失败")
+            return False
+        app_config = self.config_manager.get_app_config(app_id)
+        if not running:
+            click.echo(f"应用 {app_config['name']} 的实例数量已设置为 {count}，下次启动时生效")
+            return True
+
+        # 先启动新增的实例，再停止多出的实例
+        success = True
+        for index in range(count):
+            if not self.process_manager.is_running(app_id, index):
+                success = self.process_manager.start_process(app_config, app_id, timeout, index) and success
+        app = self.config_manager.get_status_data()['apps'][app_id]
+        for index in app_processes(app):
+            if index >= count:
+                success = self.process_manager.stop_process(app_config, app_id, index) and success
+
+        if success:
+            click.echo(f"应用 {app_config['name']} 已调整为 {count} 个实例")
+        else:
+            click.echo(f"错误: 调整应用 {app_config['name']} 的实例数量失败，请查看 am3.log")
+        return success
+
     def delete_app_by_id(self, app_id):
         """删除应用"""
         app_id = str(app_id)
@@ -329,52 +606,154 @@ class AppManager:
             click.echo(f"删除应用 ID: {app_id} 失败")
             return False
 
-    def start_all_apps(self):
-        """启动所有应用"""
+    def _run_bulk(self, action, app_ids, parallel, verb, dependencies=None, require_success=True, timeout=None):
+        """同时对最多 parallel 个应用执行 action，每完成一个就输出结果，返回成功的数量
+
+        耗时主要在等待子进程和前置检查，线程足够，总耗时接近最慢的那个应用
+        dependencies 为 {app_id: [需要先完成的app_id]}，应用要等它在本次操作中的依赖都完成后才开始，
+        require_success 为True时依赖失败的应用直接记为失败，不再执行
+        timeout 为每个应用从开始执行算起最多等待的秒数，超时的应用记为失败，不再等待它:
+        它的线程在后台继续运行，不占用并行数量，也不会阻塞命令退出
+        """
+        dependencies = dependencies or {}
+        parallel = max(1, parallel or DEFAULT_PARALLEL)
+        app_ids = list(app_ids)
+        selected = set(app_ids)
+        waiting = {app_id: [dependency for dependency in dependencies.get(app_id, ()) if dependency in selected]
+                   for app_id in app_ids}
+        results = {}
+        started = time.monotonic()
+        # 依赖都已完成、等待执行的应用
+        ready = []
+        # 正在执行的应用 {future: (app_id, 开始时间)}
+        running = {}
+
+        def report(app_id, success, reason=''):
+            results[app_id] = success
+            click.echo(f"[{time.monotonic() - started:.1f}s] 应用 ID: {app_id} {verb}"
+                       f"{green('成功') if success else red('失败')}{reason}")
+
+        def submit_ready():
+            # 依赖失败会让依赖它的应用也失败，循环直到没有新的变化
+            changed = True
+            while changed:
+                changed = False
+                for app_id in [app_id for app_id, pending in waiting.items()
+                               if all(dependency in results for dependency in pending)]:
+                    failed = [dependency for dependency in waiting.pop(app_id) if not results[dependency]]
+                    if failed and require_success:
+                        report(app_id, False, f" (依赖的应用 {', '.join(failed)} 未就绪)")
+                        changed = True
+                    else:
+                        ready.append(app_id)
+            while ready and len(running) < parallel:
+                app_id = ready.pop(0)
+                running[_run_in_thread(action, app_id)] = (app_id, time.monotonic())
+
+        submit_ready()
+        while running:
+            wait_timeout = None
+            if timeout is not None:
+                wait_timeout = max(min(begin for _, begin in running.values()) + timeout - time.monotonic(), 0)
+            done, _ = wait(running, timeout=wait_timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                app_id, _ = running.pop(future)
+                try:
+                    success = future.result()
+                except Exception as e:
+                    logger.exception(f"{verb}应用 ID: {app_id} 时出错: {e}")
+                    success = False
+                report(app_id, bool(success))
+            if timeout is not None:
+                now = time.monotonic()
+                for future, (app_id, begin) in list(running.items()):
+                    if now - begin >= timeout:
+                        del running[future]
+                        logger.error(f"{verb}应用 ID: {app_id} 超过 {timeout:g} 秒未完成")
+                        report(app_id, False, f" (超过 {timeout:g} 秒未完成)")
+            submit_ready()
+
+        success_count = sum(results.values())
+        click.echo(f"已{verb} {success_count}/{len(app_ids)} 个应用")
+        return success_count
+
+    def _get_dependencies(self):
+        """所有应用的依赖图，依赖有问题时输出错误并返回None"""
+        try:
+            return check_dependencies(self.config_manager.get_status_data()['apps'])
+        except DependencyError as e:
+            click.echo(f"错误: {e}")
+            return None
+
+    def _start_with_dependents(self, app_id, dependents, timeout=None):
+        """启动应用，本次操作中有应用依赖它时，等它就绪后才算完成"""
+        if not self.start_app_by_id(app_id, timeout):
+            return False
+        if not dependents.get(app_id):
+            return True
+        app_config = self.config_manager.get_app_config(app_id)
+        return self.process_manager.wait_ready(app_config, app_id, timeout)
+
+    def _start_in_order(self, app_ids, dependencies, parallel, timeout, verb='启动'):
+        """按依赖顺序启动应用，没有依赖关系的应用并行启动"""
+        dependents = reverse_dependencies(dependencies)
+        selected = set(app_ids)
+        # 只等待本次操作中会启动的应用
+        dependents = {app_id: [dependent for dependent in app_dependents if dependent in selected]
+                      for app_id, app_dependents in dependents.items()}
+        return self._run_bulk(lambda app_id: self._start_with_dependents(app_id, dependents, timeout),
+                              app_ids, parallel, verb, dependencies, timeout=timeout)
+
+    def _stop_in_order(self, app_ids, dependencies, parallel, timeout=None):
+        """按依赖的相反顺序停止应用，依赖它的应用都停止后才停止它
+
+        停止主要是在等待进程退出，没有指定并行数量时同时停止所有应用，
+        总耗时约为一个 kill_timeout 乘以依赖的层数，timeout 为每个应用最多等待的秒数
+        """
+        return self._run_bulk(self.stop_app_by_id, app_ids, parallel or len(app_ids), '停止',
+                              reverse_dependencies(dependencies), require_success=False, timeout=timeout)
+
+    def start_all_apps(self, parallel=None, timeout=None):
+        """按依赖顺序启动所有应用，timeout 为每个应用(包括前置检查和就绪检查)最多等待的秒数"""
         app_ids = self.config_manager.get_all_app_ids()
 
         if not app_ids:
             click.echo("没有注册的应用")
             return
 
-        success_count = 0
-        for app_id in app_ids:
-            if self.start_app_by_id(app_id):
-                success_count += 1
-
-        click.echo(f"已启动 {success_count}/{len(app_ids)} 个应用")
+        dependencies = self._get_dependencies()
+        if dependencies is None:
+            return
+        self._start_in_order(app_ids, dependencies, parallel, timeout)
 
-    def stop_all_apps(self):
-        """停止所有应用"""
+    def stop_all_apps(self, parallel=None, timeout=None):
+        """按依赖的相反顺序停止所有应用，timeout 为每个应用最多等待的秒数"""
         app_ids = self.config_manager.get_all_app_ids()
 
         if not app_ids:
             click.echo("没有注册的应用")
             return
 
-        success_count = 0
-        for app_id in app_ids:
-            if self.stop_app_by_id(app_id):
-                success_count += 1
-
-        click.echo(f"已停止 {success_count}/{len(app_ids)} 个应用")
+        dependencies = self._get_dependencies()
+        if dependencies is None:
+            return
+        self._stop_in_order(app_ids, dependencies, parallel, timeout)
 
-    def restart_all_apps(self):
-        """重启所有应用"""
+    def restart_all_apps(self, parallel=None, timeout=None):
+        """重启所有应用，先按依赖的相反顺序全部停止，再按依赖顺序启动"""
         app_ids = self.config_manager.get_all_app_ids()
 
         if not app_ids:
             click.echo("没有注册的应用")
             return
 
-        success_count = 0
-        for app_id in app_ids:
-            if self.restart_app_by_id(app_id):
-                success_count += 1
-
-        click.echo(f"已重启 {success_count}/{len(app_ids)} 个应用")
+        dependencies = self._get_dependencies()
+        if dependencies is None:
+            return
+        self._stop_in_order(app_ids, dependencies, parallel, timeout)
+        self._start_in_order(app_ids, dependencies, parallel, timeout, '重启')
 
-    def delete_all_apps(self):
+    def delete_all_apps(self, parallel=None):
         """删除所有应用"""
         app_ids = self.config_manager.get_all_app_ids()
 
@@ -382,33 +761,50 @@ class AppManager:
             click.echo("没有注册的应用")
             return
 
-        success_count = 0
-        for app_id in app_ids:
-            if self.delete_app_by_id(app_id):
-                success_count += 1
+        # 先停止所有应用，再在一个事务内删除配置，依赖有问题时也要能删除，不按依赖顺序
+        self._run_bulk(self.stop_app_by_id, app_ids, parallel or len(app_ids), '停止')
+        deleted_ids = self.config_manager.delete_many(app_ids)
 
-        click.echo(f"已删除 {success_count}/{len(app_ids)} 个应用")
+        click.echo(f"已删除 {len(deleted_ids)}/{len(app_ids)} 个应用")
 
     def save_apps(self):
         """保存应用列表"""
-        if self.config_manager.save_apps_dump():
-            click.echo("应用列表已保存")
+        generation = self.config_manager.save_apps_dump()
+        if generation:
+            click.echo(f"应用列表已保存, 版本: {generation}")
             return True
         else:
             click.echo("保存应用列表失败")
             return False
 
-    def load_apps(self):
-        """加载应用列表"""
-        if self.config_manager.load_apps_dump():
+    def load_apps(self, generation=None, only=None):
+        """加载应用列表，可以指定版本和只加载部分应用"""
+        if self.config_manager.load_apps_dump(generation, only):
             click.echo("应用列表已加载")
             return True
         else:
             click.echo("加载应用列表失败")
             return False
 
-    def view_app_log(self, app_id, follow=False, lines=10):
-        """查看应用日志"""
+    def list_saved_generations(self):
+        """列出保存的应用列表版本"""
+        dump_store = self.config_manager.dump_store
+        generations = dump_store.list_generations()
+        if not generations:
+            click.echo("没有保存的应用列表版本")
+            return
+
+        latest = dump_store.latest()
+        table = PrettyTable()
+        table.field_names = [bright_cyan(name) for name in ['版本', '保存时间', '应用数量', '最新']]
+        for generation in reversed(generations):
+            meta = dump_store.read_meta(generation)
+            created_at = datetime.fromisoformat(meta['created_at']).strftime('%Y-%m-%d %H:%M:%S')
+            table.add_row([generation, created_at, len(meta['app_ids']), bool_color(generation == latest)])
+        click.echo(table)
+
+    def view_app_log(self, app_id, follow=False, lines=10, instance=0):
+        """查看应用日志，instance 为实例编号"""
         app_id = str(app_id)
         app_config = self.config_manager.get_app_config(app_id)
 
@@ -416,20 +812,140 @@ class AppManager:
             click.echo(f"错误: 应用ID {app_id} 不存在")
             return False
 
-        log_path = app_config.get('app_log_path')
+        log_path = instance_log_path(app_config, instance) if app_config.get('app_log_path') else None
         if not log_path or not os.path.exists(log_path):
             click.echo(f"错误: 日志文件 {log_path} 不存在")
             return False
 
         # 查看日志
         if follow:
-            cmd = f"tail -f {log_path}"
+            os.system(f"tail -f {log_path}")
         else:
-            cmd = f"tail -n {lines} {log_path}"
+            self._print_last_lines(log_path, lines)
+        return True
+
+    def _print_last_lines(self, log_path, lines, block_size=65536):
+        """输出文件的最后几行，从文件末尾按块向前读，不读取整个文件"""
+        with open(log_path, 'rb') as f:
+            end = f.seek(0, os.SEEK_END)
+            position = end
+            data = b''
+            # 多读一个换行符，第一行才是完整的
+            while position > 0 and data.count(b'\n') <= lines:
+                size = min(block_size, position)
+                position -= size
+                f.seek(position)
+                data = f.read(size) + data
+        text = data.decode('utf-8', errors='replace')
+        # 和 tail 一样只按 \n 分行，最后一行没有换行符时也算一行
+        newline = '\n' if text.endswith('\n') else ''
+        last_lines = text[:len(text) - len(newline)].split('\n')[-lines:] if lines > 0 and text else []
+        text = '\n'.join(last_lines) + newline if last_lines else ''
+        # 和 tail 一样保留应用输出的颜色
+        click.echo(text, nl=False, color=True)
+
+    def view_stats(self, app_id, since=3600, rows=30, output_format=None, instance=0):
+        """查看应用最近一段时间的资源指标
+
+        Args:
+            app_id: 应用ID
+            since: 查看最近多少秒
+            rows: 最多显示的行数，记录更多时均匀抽取
+            output_format: 机器可读的输出格式，指定时输出所有记录
+            instance: 实例编号
+        """
+        app_id = str(app_id)
+        if self.config_manager.get_app_config(app_id) is None:
+            click.echo(f"错误: 应用ID {app_id} 不存在")
+            return False
+
+        samples = MetricsRing(self.config_manager.get_metrics_path(app_id, instance)).read(
+            since=time.time() - since)
+        if not samples:
+            click.echo(f"应用 ID: {app_id} 在这段时间内没有资源指标记录")
+            return False
+
+        # IO 速率由相邻两条记录的差值计算，进程树变化导致累计值变小时记为0
+        rates = [(0.0, 0.0)]
+        for previous, sample in zip(samples, samples[1:]):
+            elapsed = sample.ts - previous.ts
+            rates.append((max(sample.read_bytes - previous.read_bytes, 0) / elapsed if elapsed > 0 else 0.0,
+                          max(sample.write_bytes - previous.write_bytes, 0) / elapsed if elapsed > 0 else 0.0))
+
+        if output_format:
+            writer = RowWriter(output_format, STATS_FIELDS)
+            for sample, (read_rate, write_rate) in zip(samples, rates):
+                row = sample._asdict()
+                row.update(read_rate=round(read_rate, 1), write_rate=round(write_rate, 1))
+                if math.isnan(sample.cpu_percent):
+                    row['cpu_percent'] = None
+                writer.write(row)
+            writer.close()
+            return True
 
-        os.system(cmd)
+        indexes = range(len(samples))
+        if rows > 0 and len(samples) > rows:
+            indexes = sorted({round(i * (len(samples) - 1) / (rows - 1)) for i in range(rows)}) if rows > 1 else [len(samples) - 1]
+
+        table = PrettyTable()
+        table.field_names = [bright_cyan(name) for name in ['时间', 'CPU%', '内存', '读取/秒', '写入/秒', '文件描述符']]
+        for index in indexes:
+            sample = samples[index]
+            read_rate, write_rate = rates[index]
+            table.add_row([
+                datetime.fromtimestamp(sample.ts).strftime('%Y-%m-%d %H:%M:%S'),
+                '' if math.isnan(sample.cpu_percent) else f'{sample.cpu_percent:.1f}',
+                format_bytes(sample.rss),
+                format_bytes(read_rate),
+                format_bytes(write_rate),
+                sample.fds,
+            ])
+        click.echo(table)
+
+        cpu_values = [sample.cpu_percent for sample in samples if not math.isnan(sample.cpu_percent)]
+        rss_values = [sample.rss for sample in samples]
+        click.echo(f"记录数: {len(samples)}  "
+                   f"内存 最小/最大/最新: {format_bytes(min(rss_values))}/{format_bytes(max(rss_values))}/"
+                   f"{format_bytes(rss_values[-1])}  "
+                   f"CPU% 平均/最大: "
+                   + (f"{sum(cpu_values) / len(cpu_values):.1f}/{max(cpu_values):.1f}" if cpu_values else '-'))
         return True
 
+    def view_history(self, app_id=None, follow=False, lines=20, output_format=None):
+        """查看应用的状态变化历史，指定 output_format 时以机器可读的格式输出"""
+        journal = self.config_manager.journal
+        events, position = journal.read_events(app_id)
+
+        writer = RowWriter(output_format, HISTORY_FIELDS) if output_format else None
+
+        def output(event):
+            if writer is not None:
+                writer.write(event)
+            else:
+                click.echo(self._format_event(event))
+
+        for event in events[-lines:] if lines > 0 else events:
+            output(event)
+
+        if follow:
+            try:
+                for event in journal.follow(position, app_id):
+                    output(event)
+                    if writer is not None:
+                        writer.stream.flush()
+            except KeyboardInterrupt:
+                pass
+        if writer is not None:
+            writer.close()
+        return True
+
+    def _format_event(self, event):
+        """格式化一条状态变化记录"""
+        event_time = datetime.fromtimestamp(event['ts']).strftime('%Y-%m-%d %H:%M:%S')
+        details = ' '.join(f'{key}={value}' for key, value in event.items()
+                           if key not in ('ts', 'event', 'app_id'))
+        return f"{event_time}  {bright_cyan(event.get('app_id', '-'))}  {event['event']:<8} {details}"
+
     def view_am3_log(self, follow=False, lines=10):
         """查看AM3自身的日志"""
         log_path = self.config_manager.am3_log_path
@@ -441,11 +957,9 @@ class AppManager:
 
         # 查看日志
         if follow:
-            cmd = f"tail -f {log_path}"
+            os.system(f"tail -f {log_path}")
         else:
-            cmd = f"tail -n {lines} {log_path}"
-
-        os.system(cmd)
+            self._print_last_lines(log_path, lines)
         return True
 
     def start_api_service(self):
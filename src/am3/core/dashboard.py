@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+实时监控面板模块
+am top / am list --watch 定时刷新每个应用所有进程的 CPU、内存、线程数、文件描述符和运行时间
+
+每次刷新只遍历一次进程表，Linux 上读取 /proc/<pid>/stat 就能得到 CPU 时间、内存和线程数，
+CPU 使用率由两次刷新之间 CPU 时间的差值计算，终端只重绘内容有变化的行
+"""
+import re
+import sys
+import time
+import unicodedata
+from datetime import datetime
+
+from am3.utils.color_util import bright_cyan, bool_color
+from am3.utils.process_util import ProcessTable, count_fds
+
+
+FIELD_NAMES = ['ID', '名称', '运行中', 'PID', '进程数', 'CPU%', '内存', '线程', '文件描述符', '运行时间']
+
+# 终端颜色控制符，计算显示宽度时去掉
+ANSI_PATTERN = re.compile(r'\033\[[0-9;]*m')
+
+
+def display_width(text):
+    """字符串在终端中的显示宽度，中文等宽字符占两列"""
+    if '\033' in text:
+        text = ANSI_PATTERN.sub('', text)
+    if text.isascii():
+        return len(text)
+    return sum(2 if unicodedata.east_asian_width(char) in ('W', 'F') else 1 for char in text)
+
+
+def format_table(table):
+    """按列对齐输出表格，第一行为表头
+
+    和 PrettyTable 的样式一致，每次刷新都要格式化整个表格，自己拼接比 PrettyTable 快得多
+    """
+    widths = [max(display_width(row[column]) for row in table) for column in range(len(table[0]))]
+    border = '+' + '+'.join('-' * (width + 2) for width in widths) + '+'
+
+    def format_row(row):
+        cells = []
+        for cell, width in zip(row, widths):
+            padding = width - display_width(cell)
+            left = padding // 2
+            cells.append(' ' * (left + 1) + cell + ' ' * (padding - left + 1))
+        return '|' + '|'.join(cells) + '|'
+
+    lines = [border, format_row(table[0]), border]
+    lines.extend(format_row(row) for row in table[1:])
+    lines.append(border)
+    return lines
+
+
+def format_bytes(size):
+    """字节数转换为便于阅读的格式"""
+    for unit in ('B', 'K', 'M', 'G'):
+        if size < 1024:
+            return f'{size:.0f}{unit}' if unit == 'B' else f'{size:.1f}{unit}'
+        size /= 1024
+    return f'{size:.1f}T'
+
+
+def format_uptime(seconds):
+    """运行时间转换为 [天数d ]时:分:秒"""
+    days, seconds = divmod(int(seconds), 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    uptime = f'{hours:02d}:{minutes:02d}:{seconds:02d}'
+    return f'{days}d {uptime}' if days else uptime
+
+
+class Dashboard:
+    """定时刷新的应用资源监控面板"""
+
+    def __init__(self, app_manager, interval=2.0, output=None, with_fds=True):
+        self.app_manager = app_manager
+        self.interval = interval
+        self.output = output or sys.stdout
+        # 是否统计文件描述符，需要读取每个进程的 /proc/<pid>/fd 目录
+        self.with_fds = with_fds
+        # 上一次采样的时间和每个进程的 CPU 时间，键为 (pid, 创建时间)，防止 pid 复用时算错
+        self._last_sample_time = None
+        self._last_cpu_times = {}
+        # 上一次输出的每一行，用于只重绘有变化的行
+        self._last_lines = []
+        # 已经核对过命令行的进程，下次刷新不用再读取
+        self._cmdline_cache = None
+
+    def sample(self):
+        """采样所有应用，返回每个应用所有进程的汇总数据"""
+        apps = self.app_manager.config_manager.get_status_data()['apps']
+        process_table = ProcessTable(self._cmdline_cache)
+        self._cmdline_cache = process_table.cmdline_cache
+        statuses = self.app_manager.get_app_statuses(apps, process_table)
+
+        now = time.monotonic()
+        elapsed = now - self._last_sample_time if self._last_sample_time is not None else None
+        cpu_times = {}
+        rows = []
+        for app_id, app in apps.items():
+            row = {
+                'app_id': app_id,
+                'name': app['app_conf']['name'],
+                'running': statuses[app_id]['running'],
+                'pid': statuses[app_id]['pid'],
+                'children': statuses[app_id]['children'],
+                'instances': len(statuses[app_id]['instances']),
+                'processes': 0,
+                'cpu_percent': None,
+                'rss': 0,
+                'threads': 0,
+                'fds': 0,
+                'uptime': None,
+            }
+            for pid in statuses[app_id]['pids']:
+                info = process_table.get(pid)
+                if info is None:
+                    continue
+                key = (pid, round(info.create_time, 2))
+                cpu_times[key] = info.cpu_time
+                if elapsed and key in self._last_cpu_times:
+                    cpu_percent = (info.cpu_time - self._last_cpu_times[key]) / elapsed * 100
+                    row['cpu_percent'] = (row['cpu_percent'] or 0) + max(cpu_percent, 0)
+                row['processes'] += 1
+                row['rss'] += info.rss
+                row['threads'] += info.threads
+                if self.with_fds:
+                    row['fds'] += count_fds(pid) or 0
+                if pid == row['pid']:
+                    row['uptime'] = time.time() - info.create_time
+            rows.append(row)
+
+        self._last_sample_time = now
+        self._last_cpu_times = cpu_times
+        return rows
+
+    def render(self, rows):
+        """把采样数据转换为要输出的行"""
+        table = [[bright_cyan(name) for name in FIELD_NAMES]]
+        for row in rows:
+            running = row['running']
+            table.append([
+                bright_cyan(row['app_id']),
+                row['name'],
+                bool_color(running),
+                str(row['pid']) if running and row['pid'] else '',
+                str(row['processes']) if running else '',
+                f"{row['cpu_percent']:.1f}" if running and row['cpu_percent'] is not None else '',
+                format_bytes(row['rss']) if running else '',
+                str(row['threads']) if running else '',
+                str(row['fds']) if running else '',
+                format_uptime(row['uptime']) if running and row['uptime'] is not None else '',
+            ])
+
+        running_count = sum(row['running'] for row in rows)
+        header = (f"am top - {datetime.now().strftime('%H:%M:%S')}  "
+                  f"应用: {len(rows)}  运行中: {running_count}  刷新间隔: {self.interval}秒  按 Ctrl+C 退出")
+        return [header, ''] + format_table(table)
+
+    def draw(self, lines):
+        """输出到终端，只重绘内容有变化的行"""
+        if not self.output.isatty():
+            self.output.write('\n'.join(lines) + '\n\n')
+            self.output.flush()
+            return
+
+        parts = []
+        if not self._last_lines:
+            # 第一次输出时清屏
+            parts.append('\033[2J')
+        for index, line in enumerate(lines):
+            if index >= len(self._last_lines) or self._last_lines[index] != line:
+                parts.append(f'\033[{index + 1};1H{line}\033[K')
+        if len(lines) < len(self._last_lines):
+            # 应用变少时清除多余的行
+            parts.append(f'\033[{len(lines) + 1};1H\033[J')
+        self.output.write(''.join(parts))
+        self.output.flush()
+        self._last_lines = lines
+
+    def run(self):
+        """刷新到按下 Ctrl+C 为止"""
+        is_tty = self.output.isatty()
+        if is_tty:
+            # 隐藏光标
+            self.output.write('\033[?25l')
+        try:
+            while True:
+                self.draw(self.render(self.sample()))
+                time.sleep(self.interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if is_tty:
+                # 光标移动到面板下方并恢复显示
+                self.output.write(f'\033[{len(self._last_lines) + 1};1H\033[?25h')
+                self.output.flush()
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+应用状态表模块
+supervisor 守护进程定时把所有应用的状态(运行状态、PID、子进程数量、重启次数、CPU、内存)发布到 ~/.am3/status.board，
+其他进程(am list、cron 任务、API 推送、get_app_list)通过 mmap 直接读取，不需要连接守护进程，也不需要解析 JSON
+
+文件是固定格式的表: 文件头之后是固定数量、固定长度的记录，每个应用一条。
+文件头中的版本号是 seqlock: 写入前加一变为奇数，写完再加一变为偶数，
+读取方读到奇数或读取前后版本号不同时重新读取，读写双方都不需要加锁
+"""
+import os
+import math
+import mmap
+import time
+import struct
+import threading
+from collections import namedtuple
+
+from am3.core.dashboard import Dashboard
+
+# 文件头: 魔数, 格式版本, 容量(记录数), 应用数, 写入方PID, seqlock 版本号, 发布时间
+HEADER = struct.Struct('<4sIIII4xQd')
+MAGIC = b'AM3B'
+VERSION = 2
+# 一条记录: 应用ID, uuid, 名称, 状态, 标记, 运行中的实例数量, PID, 子进程数量, 重启次数, CPU使用率, 内存(RSS)
+SLOT = struct.Struct('<16s40s128sBBHIIIfQ')
+# 固定长度的字段放不下时设置标记，读取方改为从状态存储读取
+FLAG_TRUNCATED = 1
+
+STATES = ('stopped', 'running', 'errored')
+
+# 默认容量，应用更多时重新创建更大的文件
+DEFAULT_CAPACITY = 256
+# 守护进程发布的间隔(秒)，超过 STALE_AFTER 秒没有发布视为失效
+PUBLISH_INTERVAL = 1
+STALE_AFTER = 5
+# 读取时遇到正在写入的最多重试次数
+READ_RETRIES = 100
+
+AppStatus = namedtuple('AppStatus', ['app_id', 'uuid', 'name', 'state', 'pid', 'restarts', 'cpu_percent', 'rss',
+                                     'children', 'instances'])
+
+
+def _encode(text, size):
+    """编码为固定长度的字段，放不下时返回None"""
+    data = (text or '').encode('utf-8')
+    return data if len(data) <= size else None
+
+
+def _decode(data):
+    return data.rstrip(b'\0').decode()
+
+
+class StatusBoard:
+    """固定格式的应用状态表文件"""
+
+    def __init__(self, path):
+        self.path = path
+        self.capacity = 0
+        self._mm = None
+        self._seq = 0
+
+    def _file_size(self, capacity):
+        return HEADER.size + capacity * SLOT.size
+
+    def _create(self, capacity):
+        """创建新文件并替换旧文件，正在读取旧文件的进程读到的是完整的旧数据"""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, self._file_size(capacity))
+            os.pwrite(fd, HEADER.pack(MAGIC, VERSION, capacity, 0, os.getpid(), 0, 0.0), 0)
+            mm = mmap.mmap(fd, self._file_size(capacity), access=mmap.ACCESS_WRITE)
+        finally:
+            # mmap 持有自己的引用，可以关闭文件描述符
+            os.close(fd)
+        os.replace(tmp_path, self.path)
+        self.close()
+        self._mm = mm
+        self.capacity = capacity
+        self._seq = 0
+
+    def _write_header(self, count):
+        self._seq += 1
+        HEADER.pack_into(self._mm, 0, MAGIC, VERSION, self.capacity, count, os.getpid(), self._seq, time.time())
+
+    def publish(self, statuses):
+        """写入所有应用的状态，statuses 为 AppStatus 列表"""
+        if self._mm is None or len(statuses) > self.capacity:
+            capacity = DEFAULT_CAPACITY
+            while capacity < len(statuses):
+                capacity *= 2
+            self._create(capacity)
+
+        # 版本号为奇数表示正在写入
+        self._write_header(len(statuses))
+        for index, status in enumerate(statuses):
+            app_id, uuid, name = _encode(status.app_id, 16), _encode(status.uuid, 40), _encode(status.name, 128)
+            flags = 0
+            if app_id is None or uuid is None or name is None:
+                flags |= FLAG_TRUNCATED
+            SLOT.pack_into(
+                self._mm, HEADER.size + index * SLOT.size,
+                app_id or b'', uuid or b'', name or b'', STATES.index(status.state), flags, status.instances,
+                status.pid or 0, status.children or 0, status.restarts,
+                math.nan if status.cpu_percent is None else status.cpu_percent, status.rss,
+            )
+        self._write_header(len(statuses))
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+
+    def remove(self):
+        """守护进程退出时删除文件，之后的读取方回到状态存储"""
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def read(self, max_age=STALE_AFTER):
+        """读取所有应用的状态，文件不存在、已失效、写入方已退出或字段被截断时返回None"""
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except FileNotFoundError:
+            return None
+        try:
+            size = os.fstat(fd).st_size
+            if size < HEADER.size:
+                return None
+            mm = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+
+        with mm:
+            for _ in range(READ_RETRIES):
+                magic, version, capacity, count, pid, seq, updated_at = HEADER.unpack_from(mm, 0)
+                if magic != MAGIC or version != VERSION or size != self._file_size(capacity) or count > capacity:
+                    return None
+                if seq % 2:
+                    # 正在写入，让出 CPU 后重试
+                    time.sleep(0)
+                    continue
+                # 直接在映射的内存上解析，不复制
+                view = memoryview(mm)[HEADER.size:HEADER.size + count * SLOT.size]
+                try:
+                    rows = list(SLOT.iter_unpack(view))
+                finally:
+                    view.release()
+                if HEADER.unpack_from(mm, 0)[5] == seq:
+                    break
+            else:
+                return None
+
+        if time.time() - updated_at > max_age or not _pid_alive(pid):
+            return None
+        if any(row[4] & FLAG_TRUNCATED for row in rows):
+            return None
+        return [AppStatus(
+            _decode(app_id), _decode(uuid), _decode(name), STATES[state], app_pid or None, restarts,
+            None if math.isnan(cpu_percent) else cpu_percent, rss,
+            children if STATES[state] == 'running' else None, instances,
+        ) for app_id, uuid, name, state, _, instances, app_pid, children, restarts, cpu_percent, rss in rows]
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class StatusPublisher:
+    """在 supervisor 守护进程中采样所有应用的状态并写入状态表，可以在多个线程中调用"""
+
+    def __init__(self, app_manager):
+        self.config_manager = app_manager.config_manager
+        self.board = StatusBoard(self.config_manager.am3_status_board_path)
+        # 和 am top 相同的采样，不统计文件描述符
+        self._dashboard = Dashboard(app_manager, with_fds=False)
+        # 状态日志中每个应用的重启次数，只读取增量部分
+        self._journal_apps = None
+        self._journal_position = None
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def publish(self):
+        with self._lock:
+            if self._closed:
+                return
+            rows = self._dashboard.sample()
+            self._journal_apps, self._journal_position = self.config_manager.journal.read_app_states(
+                self._journal_apps, self._journal_position)
+            apps = self.config_manager.get_status_data()['apps']
+            statuses = []
+            for row in rows:
+                running = row['running']
+                uuid = apps[row['app_id']]['app_conf'].get('uuid') if row['app_id'] in apps else None
+                errored = row['app_id'] in apps and apps[row['app_id']].get('errored')
+                state = 'running' if running else 'errored' if errored else 'stopped'
+                statuses.append(AppStatus(
+                    row['app_id'], uuid, row['name'], state, row['pid'] if running else None,
+                    self._journal_apps.get(row['app_id'], {}).get('restarts', 0),
+                    row['cpu_percent'] if running else None, row['rss'] if running else 0,
+                    row['children'], row['instances'],
+                ))
+            self.board.publish(statuses)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self.board.remove()
+
+
+if __name__ == '__main__':
+    import tempfile
+    board = StatusBoard(os.path.join(tempfile.mkdtemp(), 'status.board'))
+    board.publish([AppStatus('1', 'uuid-1', 'app-1', 'running', os.getpid(), 2, 1.5, 1024, 3, 1),
+                   AppStatus('2', 'uuid-2', 'app-2', 'stopped', None, 0, None, 0, None, 0)])
+    print(board.read())
+    board.close()
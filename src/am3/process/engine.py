@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+多路复用的应用监控引擎
+在 supervisor 守护进程中运行，所有应用的输出管道和退出事件都注册到守护进程的同一个 asyncio 事件循环(epoll)上，
+不再为每个应用启动一个监控进程。输出日志、重启关键字和状态日志的处理和监控进程完全相同(共用 AppMonitor)
+
+应用在自己的会话和进程组中运行，记录的进程身份就是应用本身，守护进程退出后仍然可以通过进程组停止应用
+"""
+import os
+import signal
+import asyncio
+import concurrent.futures
+
+import psutil
+from loguru import logger
+
+from am3.config.instances import instance_metrics_name
+from am3.process.exit_watcher import ExitStatus, open_pidfd, reap
+from am3.process.metrics import MetricsRing, MetricsSampler, DEFAULT_INTERVAL
+from am3.process.monitor import AppMonitor, OUTPUT_CHUNK
+from am3.utils.cgroup_util import join_cgroup
+from am3.utils.process_util import process_identity
+
+
+class EngineApp(AppMonitor):
+    """在 MonitorEngine 中运行的一个应用，方法都在事件循环的线程中调用"""
+
+    def __init__(self, engine, app_id, app_config, cgroup=None, instance=0, env=None):
+        super().__init__(app_id, app_config, engine.journal, engine.metrics_path, cgroup, instance,
+                         engine.config_manager, env)
+        self.engine = engine
+        self.loop = engine.loop
+        self.task = None
+        self.sampler = None
+        self._output = None
+        self._pidfd = None
+        self._exit = None
+        self._stop_event = asyncio.Event()
+        self._sample_handle = None
+
+    def launch(self, log_file):
+        """启动一次应用并注册它的输出和退出事件，返回进程身份，应用立即退出时为None"""
+        process = self.spawn(cwd=self.app_config.get('working_directory') or None, start_new_session=True)
+        if self.cgroup:
+            try:
+                # 应用启动后立即加入 cgroup，之后创建的子孙进程都在 cgroup 中
+                join_cgroup(self.cgroup, process.pid)
+            except OSError as e:
+                logger.warning(f"应用 {self.app_id} 加入 cgroup 失败，只使用进程组: {e}")
+        self.begin_run(process, log_file)
+
+        self._output = process.stdout.fileno()
+        os.set_blocking(self._output, False)
+        self.loop.add_reader(self._output, self._on_output)
+        self._exit = self.loop.create_future()
+        self._pidfd = open_pidfd(process.pid)
+        if self._pidfd is not None:
+            self.loop.add_reader(self._pidfd, self._on_exit)
+        else:
+            self.engine.watch_sigchld(self)
+        if self.sampler is not None:
+            self.sampler.root_pid = process.pid
+
+        argv = process.args if isinstance(process.args, list) else ['/bin/sh', '-c', process.args]
+        identity = process_identity(process.pid, argv)
+        if identity is not None:
+            identity['pgid'] = process.pid
+            # 引擎直接启动应用，进程身份就是应用进程
+            identity['app_pid'] = process.pid
+            if self.cgroup:
+                identity['cgroup'] = self.cgroup
+        # 在事件循环的线程中同步写入，stop 之后不会再有旧的进程身份写入
+        self.engine.config_manager.set_app_process(self.app_id, identity, self.instance)
+        # 应用可能在注册之前就已经退出了
+        self._on_exit()
+        return identity
+
+    def record_app_pid(self, pid):
+        # 引擎直接启动应用，launch 记录的进程身份就是应用进程
+        pass
+
+    def _on_output(self):
+        try:
+            data = os.read(self._output, OUTPUT_CHUNK)
+        except BlockingIOError:
+            return
+        if not data:
+            # 输出关闭了但应用还在运行，继续等它退出
+            self.loop.remove_reader(self._output)
+            return
+        try:
+            self.handle_output(data)
+        except Exception as e:
+            self.log_file.write(f"监控出错: {e}\n")
+            self.log_file.flush()
+
+    def _on_exit(self):
+        if self._exit.done():
+            return
+        try:
+            exit_status = reap(self.process.pid)
+        except ChildProcessError:
+            exit_status = ExitStatus(None, None, None, None)
+        if exit_status is not None:
+            self._exit.set_result(exit_status)
+
+    def _finish(self, exit_status):
+        """应用退出后取消注册并处理剩余的输出，返回是否需要重启"""
+        self.loop.remove_reader(self._output)
+        if self._pidfd is not None:
+            self.loop.remove_reader(self._pidfd)
+            os.close(self._pidfd)
+            self._pidfd = None
+        else:
+            self.engine.unwatch_sigchld(self)
+        try:
+            self.drain_output(self._output)
+        except Exception as e:
+            self.log_file.write(f"监控出错: {e}\n")
+        return self.end_run(exit_status)
+
+    def start_sampler(self):
+        """启动资源指标采样，所有应用的采样都是事件循环里的定时器，不使用线程"""
+        interval = self.app_config.get('metrics_interval', DEFAULT_INTERVAL)
+        if not interval or self.metrics_path is None:
+            return
+        ring = MetricsRing(os.path.join(self.metrics_path, instance_metrics_name(self.app_id, self.instance)))
+        ring.open_for_write()
+        self.sampler = MetricsSampler(ring, interval, self.process.pid, self.cgroup, include_root=True)
+        # 先采样一次作为 CPU 时间的基准
+        self._sample(append=False)
+
+    def _sample(self, append=True):
+        try:
+            sample = self.sampler.sample()
+            if append:
+                self.sampler.ring.append(sample)
+        except (OSError, psutil.Error):
+            # 应用正在重启
+            pass
+        self._sample_handle = self.loop.call_later(self.sampler.interval, self._sample)
+
+    def stop(self):
+        """不再重启应用，应用进程由调用方停止"""
+        self.stopped = True
+        self._stop_event.set()
+
+    async def run(self, log_file):
+        """等待应用退出，需要重启时重新启动，直到不需要重启或被停止"""
+        try:
+            while True:
+                restart_needed = self._finish(await self._exit)
+                if not restart_needed or self.stopped:
+                    break
+                wait_time = self.restart_wait()
+                if wait_time is None:
+                    break
+                try:
+                    await asyncio.wait_for(self._stop_event.wait(), wait_time)
+                except asyncio.TimeoutError:
+                    pass
+                if self.stopped:
+                    break
+                self.launch(log_file)
+        except Exception as e:
+            logger.exception(f"监控应用 {self.app_id} 时出错: {e}")
+        finally:
+            if self._sample_handle is not None:
+                self._sample_handle.cancel()
+            if self.sampler is not None:
+                self.sampler.ring.close()
+            log_file.close()
+            if self.engine.apps.get((self.app_id, self.instance)) is self:
+                del self.engine.apps[(self.app_id, self.instance)]
+
+
+class MonitorEngine:
+    """在一个事件循环中监控所有应用
+
+    start、stop 可以在任意线程中调用，实际的操作都交给事件循环的线程执行
+    """
+
+    def __init__(self, config_manager, loop):
+        self.config_manager = config_manager
+        self.journal = config_manager.journal
+        self.metrics_path = config_manager.am3_metrics_path
+        self.loop = loop
+        # (app_id, 实例编号) -> EngineApp
+        self.apps = {}
+        # 不支持 pidfd 时，所有应用共用一个 SIGCHLD 处理函数
+        self._sigchld_apps = set()
+
+    def _call(self, fn, *args):
+        """在事件循环的线程中执行 fn 并返回结果"""
+        future = concurrent.futures.Future()
+
+        def run():
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+        self.loop.call_soon_threadsafe(run)
+        return future.result()
+
+    def start(self, app_id, app_config, cgroup=None, instance=0, env=None):
+        """启动应用(实例)并开始监控，返回进程身份，应用立即退出时为None
+
+        env 为发起命令的客户端的环境变量，应用和之后的每次重启都使用它，为None时使用守护进程的环境变量
+        """
+        return self._call(self._start, str(app_id), app_config, cgroup, instance, env)
+
+    def stop(self, app_id, instance=None):
+        """不再重启应用，instance 为None时包括所有实例，返回应用是否由引擎监控"""
+        return self._call(self._stop, str(app_id), instance)
+
+    def app_ids(self):
+        return self._call(lambda: list(dict.fromkeys(app_id for app_id, _ in self.apps)))
+
+    def _start(self, app_id, app_config, cgroup, instance=0, env=None):
+        app = EngineApp(self, app_id, app_config, cgroup, instance, env)
+        log_file = open(app.log_path, 'a')
+        try:
+            identity = app.launch(log_file)
+            app.start_sampler()
+        except Exception:
+            log_file.close()
+            raise
+        previous = self.apps.get((app_id, instance))
+        if previous is not None:
+            previous.stop()
+        self.apps[(app_id, instance)] = app
+        app.task = self.loop.create_task(app.run(log_file))
+        return identity
+
+    def _stop(self, app_id, instance):
+        apps = [app for key, app in self.apps.items()
+                if key[0] == app_id and (instance is None or key[1] == instance)]
+        for app in apps:
+            app.stop()
+        return bool(apps)
+
+    def watch_sigchld(self, app):
+        if not self._sigchld_apps:
+            self.loop.add_signal_handler(signal.SIGCHLD, self._on_sigchld)
+        self._sigchld_apps.add(app)
+
+    def unwatch_sigchld(self, app):
+        self._sigchld_apps.discard(app)
+        if not self._sigchld_apps:
+            self.loop.remove_signal_handler(signal.SIGCHLD)
+
+    def _on_sigchld(self):
+        # SIGCHLD 可能合并，检查所有在等待的应用
+        for app in list(self._sigchld_apps):
+            app._on_exit()
+
+    async def wait_closed(self, timeout=None):
+        """等待所有应用的监控结束"""
+        tasks = [app.task for app in self.apps.values() if app.task is not None]
+        if tasks:
+            await asyncio.wait(tasks, timeout=timeout)
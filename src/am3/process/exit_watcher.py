@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+子进程退出检测模块
+把"子进程退出"变成一个可读的文件描述符，可以和应用输出的管道放在同一个 select/poll 里等待，
+子进程一退出就能收到通知，不需要等输出管道 EOF (应用的子孙进程可能还持有管道)
+
+内核支持时使用 pidfd (Linux 5.3+，Python 3.9+)，否则使用 SIGCHLD 和 signal.set_wakeup_fd，
+退出后通过 wait4 同时得到退出状态和资源使用情况
+"""
+import os
+import signal
+from collections import namedtuple
+
+# returncode 和 subprocess 一致: 被信号杀死时为负的信号值
+# utime/stime 为用户态和内核态 CPU 时间(秒)，maxrss 为最大常驻内存(KB)
+ExitStatus = namedtuple('ExitStatus', ['returncode', 'utime', 'stime', 'maxrss'])
+
+
+def _returncode(status):
+    """wait 状态转换为返回码，等同于 Python 3.9 的 os.waitstatus_to_exitcode"""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def open_pidfd(pid):
+    """打开子进程的 pidfd，子进程退出时变为可读，内核或 Python 不支持时返回None"""
+    if not hasattr(os, 'pidfd_open'):
+        return None
+    try:
+        return os.pidfd_open(pid)
+    except OSError:
+        # 内核不支持 (ENOSYS) 时退回到 SIGCHLD
+        return None
+
+
+def reap(pid):
+    """子进程已退出时回收它，返回 ExitStatus，还在运行时返回None"""
+    pid, status, rusage = os.wait4(pid, os.WNOHANG)
+    if pid == 0:
+        return None
+    return ExitStatus(_returncode(status), round(rusage.ru_utime, 3), round(rusage.ru_stime, 3), rusage.ru_maxrss)
+
+
+class ExitWatcher:
+    """监视一个子进程的退出，fileno() 可以交给 selectors 使用"""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self._pidfd = None
+        self._wakeup_fds = None
+        self._previous_handler = None
+        self._previous_wakeup_fd = None
+
+        self._pidfd = open_pidfd(pid)
+        if self._pidfd is None:
+            # 信号处理函数什么也不做，信号到达时 Python 会往 wakeup fd 写一个字节
+            read_fd, write_fd = os.pipe()
+            os.set_blocking(read_fd, False)
+            os.set_blocking(write_fd, False)
+            self._wakeup_fds = (read_fd, write_fd)
+            self._previous_handler = signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+            self._previous_wakeup_fd = signal.set_wakeup_fd(write_fd)
+
+    @property
+    def method(self):
+        return 'pidfd' if self._pidfd is not None else 'sigchld'
+
+    def fileno(self):
+        return self._pidfd if self._pidfd is not None else self._wakeup_fds[0]
+
+    def reap(self):
+        """子进程已退出时回收它，返回 ExitStatus，还在运行时返回None"""
+        if self._wakeup_fds is not None:
+            # 清空唤醒管道，SIGCHLD 可能来自其他子进程，所以仍然要用 WNOHANG 检查
+            try:
+                while os.read(self._wakeup_fds[0], 512):
+                    pass
+            except BlockingIOError:
+                pass
+        return reap(self.pid)
+
+    def close(self):
+        if self._pidfd is not None:
+            os.close(self._pidfd)
+            self._pidfd = None
+        if self._wakeup_fds is not None:
+            signal.set_wakeup_fd(self._previous_wakeup_fd)
+            signal.signal(signal.SIGCHLD, self._previous_handler)
+            for fd in self._wakeup_fds:
+                os.close(fd)
+            self._wakeup_fds = None
+
+
+if __name__ == '__main__':
+    import time
+    import selectors
+    import subprocess
+    process = subprocess.Popen(['sh', '-c', 'sleep 0.2; exit 3'])
+    watcher = ExitWatcher(process.pid)
+    begin = time.monotonic()
+    with selectors.DefaultSelector() as selector:
+        selector.register(watcher, selectors.EVENT_READ)
+        exit_status = watcher.reap()
+        while exit_status is None:
+            selector.select()
+            exit_status = watcher.reap()
+    print(watcher.method, exit_status, f'{time.monotonic() - begin:.3f}s')
+    watcher.close()
+    process.returncode = exit_status.returncode
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+应用资源指标模块
+监控进程按固定间隔采样应用所有进程的 CPU、内存、IO 和文件描述符，
+写入 ~/.am3/metrics/<app_id>.ring
+
+ring 文件是固定大小的环形数组: 文件头之后是固定数量、固定长度的记录，
+新记录覆盖最旧的记录，每个应用占用的空间和运行时间无关。
+读取方通过 mmap 按结构体直接解析，不需要解析文本
+"""
+import os
+import re
+import math
+import mmap
+import time
+import struct
+import threading
+from collections import namedtuple
+
+import psutil
+
+from am3.utils.cgroup_util import cgroup_pids, cgroup_stats
+from am3.utils.process_util import ProcessTable, in_process_group
+
+# 文件头: 魔数, 版本, 容量(记录数), 已写入的记录总数
+HEADER = struct.Struct('<4sIIQ')
+MAGIC = b'AM3M'
+VERSION = 1
+# 一条记录: 时间戳, CPU使用率, 文件描述符数, 内存(RSS), 累计读取字节数, 累计写入字节数
+RECORD = struct.Struct('<dfIQQQ')
+
+# 默认 10 秒采样一次，保留 8640 条即 24 小时，每个应用的文件约 340KB
+DEFAULT_INTERVAL = 10
+DEFAULT_CAPACITY = 8640
+# 没有 cgroup 时应用的进程需要遍历 /proc 才能找到，每隔这么多秒(或已知的进程退出时)才重新遍历
+MEMBERS_REFRESH_INTERVAL = 60
+
+Sample = namedtuple('Sample', ['ts', 'cpu_percent', 'fds', 'rss', 'read_bytes', 'write_bytes'])
+
+
+class MetricsRing:
+    """固定大小的环形指标文件"""
+
+    def __init__(self, path, capacity=DEFAULT_CAPACITY):
+        self.path = path
+        self.capacity = capacity
+        self._mm = None
+
+    def _file_size(self, capacity):
+        return HEADER.size + capacity * RECORD.size
+
+    def open_for_write(self):
+        """打开或创建文件，已有文件格式不对时重新创建"""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            size = os.fstat(fd).st_size
+            header = os.pread(fd, HEADER.size, 0) if size >= HEADER.size else b''
+            valid = False
+            if header:
+                magic, version, capacity, _ = HEADER.unpack(header)
+                if magic == MAGIC and version == VERSION and size == self._file_size(capacity):
+                    # 沿用已有文件的容量，重启应用后继续追加
+                    self.capacity = capacity
+                    valid = True
+            if not valid:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, self._file_size(self.capacity))
+                os.pwrite(fd, HEADER.pack(MAGIC, VERSION, self.capacity, 0), 0)
+            self._mm = mmap.mmap(fd, self._file_size(self.capacity), access=mmap.ACCESS_WRITE)
+        finally:
+            # mmap 持有自己的引用，可以关闭文件描述符
+            os.close(fd)
+
+    def append(self, sample):
+        """写入一条记录，先写记录再更新记录总数，读取方不会读到写了一半的最新记录"""
+        _, _, capacity, count = HEADER.unpack_from(self._mm, 0)
+        RECORD.pack_into(self._mm, HEADER.size + (count % capacity) * RECORD.size, *sample)
+        HEADER.pack_into(self._mm, 0, MAGIC, VERSION, capacity, count + 1)
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+
+    def read(self, since=None):
+        """按时间顺序读取所有记录，since 为时间戳，只返回之后的记录"""
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < HEADER.size:
+                return []
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                magic, version, capacity, count = HEADER.unpack_from(mm, 0)
+                if magic != MAGIC or version != VERSION or len(mm) != self._file_size(capacity):
+                    return []
+                total = min(count, capacity)
+                first = (count - total) % capacity
+                offset = HEADER.size + first * RECORD.size
+                # 环形数组从最旧的记录开始分两段读取
+                if first + total <= capacity:
+                    data = mm[offset:offset + total * RECORD.size]
+                else:
+                    data = mm[offset:] + mm[HEADER.size:HEADER.size + (first + total - capacity) * RECORD.size]
+        samples = [Sample(*values) for values in RECORD.iter_unpack(data)]
+
+        if since is not None:
+            samples = [sample for sample in samples if sample.ts >= since]
+        return samples
+
+
+class MetricsSampler(threading.Thread):
+    """在监控进程中定时采样应用进程树的资源占用"""
+
+    def __init__(self, ring, interval=DEFAULT_INTERVAL, root_pid=None, cgroup=None, include_root=False):
+        super().__init__(daemon=True)
+        self.ring = ring
+        self.interval = interval
+        self.root_pid = root_pid or os.getpid()
+        self.cgroup = cgroup
+        # root_pid 是应用本身而不是监控进程时，统计时包括它
+        self.include_root = include_root
+        self._stop_event = threading.Event()
+        # 上一次采样的时间和每个进程的 CPU 时间，键为 (pid, 创建时间)
+        self._last_time = None
+        self._last_cpu_times = {}
+        self._last_cgroup_cpu_time = None
+        # 上次遍历 /proc 得到的进程和时间，root_pid 变化(应用重启)时重新遍历
+        self._members = None
+        self._members_root = None
+        self._members_time = 0
+
+    def members(self):
+        """应用的所有进程，不包括监控进程自己(include_root 为False时)
+
+        应用和监控进程在同一个 cgroup / 进程组中，直接读取成员，脱离进程树的子孙进程也能统计到。
+        有 cgroup 时每次读取 cgroup.procs；没有时遍历 /proc 的结果会缓存，
+        之后只检查这些进程，每隔 MEMBERS_REFRESH_INTERVAL 秒或已知的进程退出时才重新遍历
+        """
+        if self.cgroup:
+            pids = cgroup_pids(self.cgroup)
+        else:
+            pids = self._cached_members()
+        if self.include_root:
+            return pids
+        return [pid for pid in pids if pid != self.root_pid]
+
+    def _cached_members(self):
+        now = time.monotonic()
+        if self._members is not None and self._members_root == self.root_pid \
+                and now - self._members_time < MEMBERS_REFRESH_INTERVAL:
+            pgid = os.getpgid(self.root_pid)
+            alive = [pid for pid in self._members if in_process_group(pid, pgid)]
+            if len(alive) == len(self._members):
+                return alive
+
+        if os.getpgid(self.root_pid) == self.root_pid:
+            pids = ProcessTable().group(self.root_pid)
+        else:
+            # 监控进程不是进程组组长时，进程组里可能有无关的进程，只能遍历进程树
+            pids = [self.root_pid] + [child.pid for child in psutil.Process(self.root_pid).children(recursive=True)]
+        self._members, self._members_root, self._members_time = pids, self.root_pid, now
+        return pids
+
+    def sample(self):
+        """采样一次，统计应用所有进程的资源占用之和"""
+        now = time.time()
+        cpu_times = {}
+        cpu_delta = 0.0
+        fds = rss = read_bytes = write_bytes = 0
+        for pid in self.members():
+            try:
+                process = psutil.Process(pid)
+                with process.oneshot():
+                    key = (process.pid, process.create_time())
+                    times = process.cpu_times()
+                    cpu_times[key] = times.user + times.system
+                    cpu_delta += max(cpu_times[key] - self._last_cpu_times.get(key, cpu_times[key]), 0)
+                    rss += process.memory_info().rss
+                    fds += process.num_fds()
+                    try:
+                        io = process.io_counters()
+                        read_bytes += io.read_bytes
+                        write_bytes += io.write_bytes
+                    except (psutil.AccessDenied, AttributeError):
+                        pass
+            except psutil.Error:
+                # 采样期间退出的进程
+                continue
+
+        if self.cgroup:
+            # cgroup 的 CPU 时间包括两次采样之间已经退出的进程
+            cgroup_cpu_time = cgroup_stats(self.cgroup)['cpu_time']
+            if cgroup_cpu_time is not None and self._last_cgroup_cpu_time is not None:
+                cpu_delta = max(cgroup_cpu_time - self._last_cgroup_cpu_time, 0)
+            self._last_cgroup_cpu_time = cgroup_cpu_time
+
+        # 第一次采样没有上一次的 CPU 时间，记为 NaN
+        cpu_percent = cpu_delta / (now - self._last_time) * 100 if self._last_time else math.nan
+        self._last_time = now
+        self._last_cpu_times = cpu_times
+        return Sample(now, cpu_percent, fds, rss, read_bytes, write_bytes)
+
+    def run(self):
+        self.ring.open_for_write()
+        try:
+            # 先采样一次作为 CPU 时间的基准
+            self.sample()
+            while not self._stop_event.wait(self.interval):
+                self.ring.append(self.sample())
+        finally:
+            self.ring.close()
+
+    def stop(self):
+        self._stop_event.set()
+
+
+def parse_duration(text):
+    """解析 30s、15m、1h、7d 这样的时长，返回秒数，格式不对时返回None"""
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([smhd]?)\s*', text)
+    if not match:
+        return None
+    value, unit = match.groups()
+    return float(value) * {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}[unit]
+
+
+if __name__ == '__main__':
+    import tempfile
+    ring = MetricsRing(os.path.join(tempfile.mkdtemp(), 'test.ring'), capacity=4)
+    ring.open_for_write()
+    for i in range(6):
+        ring.append(Sample(time.time(), float(i), i, i * 1024, 0, 0))
+    ring.close()
+    print([sample.cpu_percent for sample in ring.read()])
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+应用监控模块
+每个应用由一个独立的监控进程启动和守护:
+把应用输出写入日志，输出匹配重启关键字时杀掉并重启应用，
+并把启动、退出、重启等状态变化写入状态日志
+
+启动方式: python -m am3.process.monitor <JSON参数>
+"""
+import os
+import re
+import sys
+import json
+import time
+import io
+import codecs
+import selectors
+import subprocess
+from datetime import datetime
+
+from am3.config.instances import instance_env, instance_log_path, instance_metrics_name
+from am3.config.manager import ConfigManager
+from am3.process.exit_watcher import ExitStatus, ExitWatcher
+from am3.process.metrics import MetricsRing, MetricsSampler, DEFAULT_INTERVAL
+from am3.process.restart_policy import RestartPolicy
+from am3.utils.cgroup_util import join_cgroup
+from am3.utils.cmd_util import build_command
+from am3.utils.process_util import process_identity
+
+# 每次从输出管道读取的最大字节数
+OUTPUT_CHUNK = 65536
+# 应用退出后最多再读取多少次管道里剩余的输出，子孙进程持续输出时不会一直读下去
+DRAIN_CHUNKS = 16
+
+
+class AppMonitor:
+    """单个应用的监控器"""
+
+    def __init__(self, app_id, app_config, journal, metrics_path=None, cgroup=None, instance=0,
+                 config_manager=None, env=None):
+        self.app_id = app_id
+        self.app_config = app_config
+        self.journal = journal
+        self.metrics_path = metrics_path
+        self.cgroup = cgroup
+        # 多实例应用中的实例编号
+        self.instance = instance
+        self.log_path = instance_log_path(app_config, instance)
+        # 重启的等待时间和次数限制，跨多次运行保存状态
+        self.restart_policy = RestartPolicy(app_config)
+        # 提供时把应用进程的PID和出错状态记录到状态存储中
+        self.config_manager = config_manager
+        # 应用的基础环境变量，为None时使用当前进程的环境变量
+        self.env = env
+        self._monitor_identity = None
+        # 被停止后应用异常退出也不再重启
+        self.stopped = False
+        # 当前这次运行的状态，由 begin_run 初始化
+        self.process = None
+        self.log_file = None
+        self.begin_time = None
+        self.restart_needed = False
+        self._decoder = None
+        self._pending = ''
+
+    def build_command(self):
+        """构建启动命令，默认为 argv 列表，配置 shell 为True时为 shell 命令字符串"""
+        return build_command(self.app_config.get('interpreter') or '', self.app_config.get('start') or '',
+                             self.app_config.get('params') or '', self.app_config.get('shell', False))
+
+    def match_restart(self, line):
+        """检查输出是否匹配重启关键字，返回匹配到的关键字或正则"""
+        for keyword in self.app_config.get('restart_keyword') or []:
+            if keyword in line:
+                return f"关键字 '{keyword}'"
+        for pattern in self.app_config.get('restart_keyword_regex') or []:
+            if re.search(pattern, line):
+                return f"正则 '{pattern}'"
+        return None
+
+    def spawn(self, **kwargs):
+        """启动应用进程，输出和错误输出合并到一个管道，kwargs 传给 subprocess.Popen"""
+        # 不经过 shell 时 subprocess 用 vfork/posix_spawn 直接 exec 应用，pid 就是应用进程
+        return subprocess.Popen(
+            self.build_command(),
+            shell=self.app_config.get('shell', False),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            env={**(os.environ if self.env is None else self.env),
+                 **instance_env(self.app_config, self.instance)},
+            **kwargs
+        )
+
+    def journal_event(self, event, **fields):
+        """写入状态日志，多实例应用的记录带上实例编号"""
+        if self.instance:
+            fields['instance'] = self.instance
+        self.journal.append(event, self.app_id, **fields)
+
+    def record_app_pid(self, pid):
+        """记录当前应用进程的PID，进程身份是监控进程的，am list 显示的是应用进程"""
+        if self.config_manager is None or self.app_id is None:
+            return
+        if self._monitor_identity is None:
+            # 监控进程是新会话的组长
+            self._monitor_identity = process_identity(os.getpid())
+            self._monitor_identity['pgid'] = os.getpid()
+            if self.cgroup:
+                self._monitor_identity['cgroup'] = self.cgroup
+        self.config_manager.set_app_pid(self.app_id, self._monitor_identity, pid, self.instance)
+
+    def begin_run(self, process, log_file):
+        """应用进程启动后调用，之后由 handle_output 处理它的输出"""
+        self.process = process
+        self.log_file = log_file
+        self.begin_time = datetime.now()
+        self.restart_needed = False
+        # 和文本模式的 readline 一样按 utf-8 解码，并把 \r\n、\r 转换为 \n
+        self._decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder('utf-8')(errors='replace'), True)
+        self._pending = ''
+        self.journal_event('start', pid=process.pid)
+        self.record_app_pid(process.pid)
+        log_file.write(f"\n\n--- 进程启动于 {self.begin_time} ---\n")
+        log_file.flush()
+
+    def handle_output(self, data, final=False):
+        """写入日志并检查完整的行，不完整的行留到下次，final 为True时全部处理"""
+        restart_control = self.app_config.get('restart_control', True)
+        restart_check_delay = self.app_config.get('restart_check_delay', 0)
+
+        *lines, self._pending = (self._pending + self._decoder.decode(data, final)).split('\n')
+        lines = [line + '\n' for line in lines]
+        if final and self._pending:
+            lines.append(self._pending)
+            self._pending = ''
+        for line in lines:
+            self.log_file.write(line)
+            if self.restart_needed or not restart_control or \
+                    (datetime.now() - self.begin_time).seconds <= restart_check_delay:
+                continue
+            matched = self.match_restart(line)
+            if matched:
+                self.log_file.write(f"输出匹配{matched}，需要重启\n")
+                self.journal_event('restart', pid=self.process.pid, reason=matched)
+                self.process.kill()
+                self.restart_needed = True
+        self.log_file.flush()
+
+    def drain_output(self, output):
+        """应用退出后只读取管道里已有的输出，子孙进程还在写时也不等待"""
+        try:
+            for _ in range(DRAIN_CHUNKS):
+                data = os.read(output, OUTPUT_CHUNK)
+                if not data:
+                    break
+                self.handle_output(data)
+        except BlockingIOError:
+            pass
+        self.handle_output(b'', final=True)
+
+    def end_run(self, exit_status):
+        """应用进程退出并回收后调用，返回是否需要重启"""
+        self.process.stdout.close()
+        # 进程已经由 wait4 回收，告诉 subprocess 不要再 wait
+        self.process.returncode = exit_status.returncode
+        self.log_file.write(f"进程退出，返回码: {exit_status.returncode}\n")
+        self.log_file.flush()
+        self.journal_event('exit', pid=self.process.pid, rc=exit_status.returncode,
+                           utime=exit_status.utime, stime=exit_status.stime, maxrss=exit_status.maxrss)
+        self.record_app_pid(None)
+        if not self.restart_needed and not self.stopped and exit_status.returncode \
+                and self.app_config.get('restart_on_failure', False):
+            # 返回码非零(包括被信号杀死)时也按重启策略重启
+            reason = f"返回码 {exit_status.returncode}"
+            self.log_file.write(f"进程异常退出({reason})，需要重启\n")
+            self.log_file.flush()
+            self.journal_event('restart', pid=self.process.pid, reason=reason)
+            self.restart_needed = True
+        return self.restart_needed
+
+    def restart_wait(self):
+        """应用需要重启时调用，返回重启前等待的秒数，超过重启次数限制时记录 errored 状态并返回None"""
+        uptime = (datetime.now() - self.begin_time).total_seconds()
+        wait_time = self.restart_policy.next_wait(uptime)
+        if wait_time is None:
+            reason = self.restart_policy.describe_limit()
+            self.log_file.write(f"{reason}，不再自动重启应用\n")
+            self.log_file.flush()
+            self.journal_event('errored', pid=self.process.pid, reason=reason)
+            if self.config_manager is not None and self.app_id is not None:
+                # am list 从状态存储读取出错状态，不需要扫描状态日志
+                self.config_manager.set_app_errored(self.app_id, reason)
+            return None
+        self.log_file.write(f"等待 {wait_time:.1f} 秒后自动重启应用\n")
+        self.log_file.flush()
+        return wait_time
+
+    def run_once(self, log_file):
+        """启动一次应用并监控到它退出，返回是否需要重启
+
+        应用输出的管道和应用的退出事件在同一个 selector 里等待，应用一退出就记录退出状态，
+        不需要等管道 EOF，应用的子孙进程还持有管道时也不会延迟发现退出
+        """
+        process = self.spawn()
+        watcher = ExitWatcher(process.pid)
+        self.begin_run(process, log_file)
+        output = process.stdout.fileno()
+        os.set_blocking(output, False)
+
+        exit_status = None
+        try:
+            with selectors.DefaultSelector() as selector:
+                selector.register(output, selectors.EVENT_READ, 'output')
+                selector.register(watcher, selectors.EVENT_READ, 'exit')
+                # 应用可能在注册之前就已经退出了
+                exit_status = watcher.reap()
+                while exit_status is None:
+                    for key, _ in selector.select():
+                        if key.data == 'exit':
+                            exit_status = watcher.reap()
+                            continue
+                        try:
+                            data = os.read(output, OUTPUT_CHUNK)
+                        except BlockingIOError:
+                            continue
+                        if data:
+                            self.handle_output(data)
+                        else:
+                            # 输出关闭了但应用还在运行，继续等它退出
+                            selector.unregister(output)
+            self.drain_output(output)
+        except Exception as e:
+            log_file.write(f"监控进程出错: {e}\n")
+            log_file.flush()
+        finally:
+            if exit_status is None:
+                # 监控出错时仍然要回收应用进程
+                process.kill()
+                process.wait()
+                exit_status = ExitStatus(process.returncode, None, None, None)
+            watcher.close()
+        return self.end_run(exit_status)
+
+    def start_metrics_sampler(self):
+        """启动资源指标采样线程，metrics_interval 为 0 时不采样"""
+        interval = self.app_config.get('metrics_interval', DEFAULT_INTERVAL)
+        if not interval or self.metrics_path is None or self.app_id is None:
+            return None
+        ring = MetricsRing(os.path.join(self.metrics_path, instance_metrics_name(self.app_id, self.instance)))
+        sampler = MetricsSampler(ring, interval, cgroup=self.cgroup)
+        sampler.start()
+        return sampler
+
+    def run(self):
+        """监控主循环"""
+        sampler = self.start_metrics_sampler()
+        with open(self.log_path, 'a') as log_file:
+            while self.run_once(log_file):
+                wait_time = self.restart_wait()
+                if wait_time is None:
+                    break
+                time.sleep(wait_time)
+        if sampler is not None:
+            sampler.stop()
+            sampler.join()
+        self.journal.close()
+
+
+def main():
+    args = json.loads(sys.argv[1])
+    if args.get('cgroup'):
+        try:
+            # 启动应用之前加入 cgroup，应用和它的子孙进程都会在这个 cgroup 中
+            join_cgroup(args['cgroup'], os.getpid())
+        except OSError:
+            # 停止时仍然可以通过进程组停止应用
+            args['cgroup'] = None
+    config_manager = ConfigManager(args.get('state_backend'))
+    metrics_path = os.path.join(args['data_path'], 'metrics')
+    AppMonitor(args['app_id'], args['app_config'], config_manager.journal, metrics_path, args.get('cgroup'),
+               args.get('instance', 0), config_manager).run()
+
+
+if __name__ == '__main__':
+    main()
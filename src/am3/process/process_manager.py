@@ -5,18 +5,21 @@
 负责处理进程的启动、监控和停止
 """
 import os
-import re
 import sys
+import json
 import time
 import subprocess
 import importlib.util
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
-import click
-import psutil
 from loguru import logger
 
-from am3.utils.process_util import kill_process_and_all_child
+from am3.config.instances import app_processes, instance_count
+from am3.utils.cgroup_util import app_cgroup_path, cgroup_populated, create_cgroup, get_cgroup_root, kill_cgroup
+from am3.utils.path_util import get_environment, resolve_path
+from am3.utils.process_util import (DEFAULT_KILL_TIMEOUT, SIGKILL_WAIT, kill_process_and_all_child,
+                                    kill_process_group, process_identity, is_same_process, in_process_group,
+                                    process_group_exists)
 
 
 class ProcessManager:
@@ -25,23 +28,88 @@ class ProcessManager:
     def __init__(self, config_manager):
         """初始化进程管理器"""
         self.config_manager = config_manager
+        # 本进程启动的监控进程，常驻的 supervisor 守护进程需要回收它们
+        self._monitors = []
+        # supervisor 守护进程使用监控引擎时为 MonitorEngine，应用由守护进程直接启动和监控
+        self.engine = None
 
-    def start_process(self, app_config):
-        """启动进程"""
+    def start_process(self, app_config, app_id, timeout=None, instance=None):
+        """启动进程，timeout 为前置检查最多等待的秒数，和应用配置的 before_execute_timeout 取较小值
+
+        instance 为None时启动应用的所有实例，否则只启动这个编号的实例
+        """
         logger.info(f"启动进程: {app_config['name']}")
 
         # 检查前置条件
-        if self._check_before_execute(app_config):
+        if self._check_before_execute(app_config, timeout):
+            # 再次启动后不再是出错状态
+            self.config_manager.set_app_errored(app_id, None)
             # 启动进程
-            return self._execute_process(app_config)
+            instances = range(instance_count(app_config)) if instance is None else [instance]
+            results = [self._execute_process(app_config, app_id, index) for index in instances]
+            return all(results)
         else:
             logger.error(f"启动前检查失败: {app_config['name']}")
             return False
 
-    def stop_process(self, app_config):
-        """停止进程"""
+    def _stop_tree(self, app_config, app_id, pid, identity=None, instance=0):
+        """停止应用的所有进程并记录状态日志，返回是否所有进程都已退出
+
+        在 cgroup 中启动的应用杀掉整个 cgroup，在独立进程组中启动的应用 killpg 整个进程组，
+        旧版本启动的应用才遍历进程树
+        """
+        kill_timeout = app_config.get('kill_timeout', DEFAULT_KILL_TIMEOUT)
+        identity = identity or {}
+        killed, survivors = [], []
+        if identity.get('cgroup'):
+            killed, survivors = kill_cgroup(identity['cgroup'], kill_timeout, SIGKILL_WAIT)
+        if identity.get('pgid') is not None:
+            # 监控进程没能加入 cgroup 时进程组仍然能停止应用，已经停止时立即返回
+            group_killed, group_survivors = kill_process_group(identity['pgid'], kill_timeout)
+            killed = sorted(set(killed) | set(group_killed))
+            survivors = sorted(set(survivors) | set(group_survivors))
+        elif not identity.get('cgroup'):
+            killed, survivors = kill_process_and_all_child(pid, kill_timeout)
+
+        fields = {'pid': pid}
+        if instance:
+            fields['instance'] = instance
+        if killed:
+            fields['killed'] = killed
+        if survivors:
+            fields['survivors'] = survivors
+        self.config_manager.journal.append('stop', app_id, **fields)
+        if survivors:
+            logger.error(f"停止进程后仍在运行的 PID: {survivors}")
+            return False
+        logger.info(f"已停止进程 PID: {pid}")
+        return True
+
+    def stop_process(self, app_config, app_id, instance=None):
+        """停止进程，等待整个进程树退出，超过 kill_timeout 的进程强制杀死
+
+        instance 为None时同时停止应用的所有实例，否则只停止这个编号的实例
+        """
         logger.info(f"停止进程: {app_config['name']}")
+        if self.engine is not None:
+            # 先让监控引擎不再重启应用，之后再按记录的进程身份停止
+            self.engine.stop(app_id, instance)
+
+        app = self.config_manager.get_status_data()['apps'].get(str(app_id), {})
+        processes = app_processes(app)
+        if instance is not None:
+            processes = {index: identity for index, identity in processes.items() if index == instance}
+        if len(processes) > 1:
+            with ThreadPoolExecutor(max_workers=len(processes)) as executor:
+                results = list(executor.map(lambda item: self._stop_instance(app_config, app_id, *item),
+                                            processes.items()))
+            return all(results)
+        if processes:
+            return self._stop_instance(app_config, app_id, *next(iter(processes.items())))
+        if instance:
+            return True
 
+        # 旧版本启动的应用只记录了PID文件
         app_pid_file = app_config.get('app_pid_file')
         if not app_pid_file or not os.path.exists(app_pid_file):
             logger.info(f"PID文件不存在: {app_pid_file}")
@@ -51,186 +119,194 @@ class ProcessManager:
             with open(app_pid_file) as f:
                 app_pid = int(f.read().strip())
 
-            # 杀死进程及其子进程
-            kill_process_and_all_child(app_pid)
-            logger.info(f"已停止进程 PID: {app_pid}")
-
-            # 删除PID文件
+            # 杀死进程及其子进程，全部退出后才删除PID文件
+            if not self._stop_tree(app_config, app_id, app_pid):
+                return False
             os.remove(app_pid_file)
             return True
         except Exception as e:
             logger.exception(f"停止进程时出错: {e}")
             return False
 
-    def _check_before_execute(self, app_config):
-        """执行前检查"""
+    def _stop_instance(self, app_config, app_id, instance, identity):
+        """按记录的进程身份停止一个实例"""
+        try:
+            # pid 已经被其他进程复用时不能杀
+            stopped = True
+            if is_same_process(identity):
+                stopped = self._stop_tree(app_config, app_id, identity['pid'], identity, instance)
+                # 监控进程还在时保留进程身份，之后还能再次停止
+                if not stopped and is_same_process(identity):
+                    return False
+            else:
+                logger.info(f"进程 PID: {identity['pid']} 已经不存在")
+                orphaned = self._orphaned_identity(identity)
+                if orphaned is not None:
+                    # 监控进程已经退出(例如上次停止超时后命令退出了)，应用还留在 cgroup / 进程组中
+                    logger.warning(f"停止监控进程 PID: {identity['pid']} 留下的进程")
+                    if not self._stop_tree(app_config, app_id, identity['pid'], orphaned, instance):
+                        return False
+            self.config_manager.set_app_process(app_id, None, instance)
+            return stopped
+        except Exception as e:
+            logger.exception(f"停止进程时出错: {e}")
+            return False
+
+    def _orphaned_identity(self, identity):
+        """监控进程已经退出但 cgroup / 进程组中还有进程时，返回只包含这些还能停止的部分的进程身份，否则返回None
+
+        进程组还有成员时它的 ID 不会被复用；组长还在运行却不是监控进程时，是原来的进程组清空后新建的，不能停止
+        """
+        cgroup = identity.get('cgroup')
+        if cgroup and not cgroup_populated(cgroup):
+            cgroup = None
+        pgid = identity.get('pgid')
+        if pgid is not None and (in_process_group(pgid, pgid) or not process_group_exists(pgid)):
+            pgid = None
+        if not cgroup and pgid is None:
+            return None
+        return {**identity, 'cgroup': cgroup, 'pgid': pgid}
+
+    def reap_monitors(self):
+        """回收已经退出的监控进程，返回还在运行的数量"""
+        self._monitors = [monitor for monitor in self._monitors if monitor.poll() is None]
+        return len(self._monitors)
+
+    def _get_deadline(self, timeout, config_timeout):
+        """本次操作的超时和应用配置的超时取较小值，0 或不设置表示一直等待"""
+        timeouts = [value for value in (timeout, config_timeout) if value]
+        return time.monotonic() + min(timeouts) if timeouts else None
+
+    def _wait_for_check(self, script, deadline, alive=None):
+        """每秒调用一次检查脚本的 check() 直到通过，超时或 alive() 返回False时返回False"""
+        # 加载检查脚本
+        spec = importlib.util.spec_from_file_location("", resolve_path(script))
+        check_module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(check_module)
+
+        # 执行检查函数
+        while True:
+            time.sleep(1)
+            if check_module.check():
+                return True
+            if alive is not None and not alive():
+                return False
+            if deadline is not None and time.monotonic() >= deadline:
+                logger.error(f"检查超时: {script}")
+                return False
+            logger.warning("检查未通过，等待重试")
+
+    def _check_before_execute(self, app_config, timeout=None):
+        """执行前检查，超时仍未通过时返回False"""
         before_execute = app_config.get('before_execute')
         if not before_execute:
             return True  # 没有前置检查，直接返回成功
 
         try:
-            # 加载检查脚本
             logger.info(f"执行前置检查脚本: {before_execute}")
-            spec = importlib.util.spec_from_file_location("", before_execute)
-            check_module = importlib.util.module_from_spec(spec)
-            spec.loader.exec_module(check_module)
-
-            # 执行检查函数
-            while True:
-                time.sleep(1)
-                if check_module.check():
-                    logger.info("环境检查通过")
-                    return True
-                else:
-                    logger.warning("环境检查未通过，等待重试")
+            deadline = self._get_deadline(timeout, app_config.get('before_execute_timeout'))
+            if self._wait_for_check(before_execute, deadline):
+                logger.info("环境检查通过")
+                return True
+            return False
         except Exception as e:
             logger.exception(f"执行前置检查时出错: {e}")
             return False
 
-    def _execute_process(self, app_config):
-        """执行进程"""
-        # 提取配置
-        interpreter = app_config.get('interpreter', '')
-        start = app_config.get('start', '')
-        params = app_config.get('params', '')
-        working_directory = app_config.get('working_directory', '')
-        restart_control = app_config.get('restart_control', True)
-        restart_check_delay = app_config.get('restart_check_delay', 0)
-        restart_keyword = app_config.get('restart_keyword', [])
-        restart_keyword_regex = app_config.get('restart_keyword_regex', [])
-        restart_wait_time = app_config.get('restart_wait_time', 1)
-        app_log_path = app_config.get('app_log_path', '')
-        app_pid_file = app_config.get('app_pid_file', '')
-
-        # 构建命令
-        if interpreter:
-            cmd = [interpreter, start]
-        else:
-            cmd = [start]
+    def is_running(self, app_id, instance=None):
+        """应用的监控进程是否在运行，instance 为None时有一个实例在运行就算运行"""
+        app = self.config_manager.get_status_data()['apps'].get(str(app_id), {})
+        processes = app_processes(app)
+        if instance is not None:
+            return instance in processes and is_same_process(processes[instance])
+        return any(is_same_process(identity) for identity in processes.values())
+
+    def wait_ready(self, app_config, app_id, timeout=None, instance=None):
+        """等待已启动的应用就绪，供依赖它的应用启动前和滚动重启时调用
+
+        应用在运行且配置的 ready_check 脚本通过时认为就绪，没有配置 ready_check 时只要求应用在运行，
+        instance 不为None时只检查这个实例
+        """
+        if not self.is_running(app_id, instance):
+            logger.error(f"应用未在运行: {app_config['name']}")
+            return False
 
-        if params:
-            cmd.append(params)
+        ready_check = app_config.get('ready_check')
+        if not ready_check:
+            return True
 
-        cmd_str = ' '.join(cmd)
-        logger.info(f"执行命令: {cmd_str}")
+        try:
+            logger.info(f"执行就绪检查脚本: {ready_check}")
+            deadline = self._get_deadline(timeout, app_config.get('ready_timeout'))
+            # 等待期间应用退出了就不用再等
+            if self._wait_for_check(ready_check, deadline, alive=lambda: self.is_running(app_id, instance)):
+                logger.info(f"应用已就绪: {app_config['name']}")
+                return True
+            return False
+        except Exception as e:
+            logger.exception(f"执行就绪检查时出错: {e}")
+            return False
 
-        # 创建监控进程
-        monitor_script = self._create_monitor_script(
-            app_config, cmd_str, restart_control, restart_check_delay,
-            restart_keyword, restart_keyword_regex, restart_wait_time
-        )
+    def _execute_process(self, app_config, app_id, instance=0):
+        """执行进程，instance 为实例编号"""
+        working_directory = app_config.get('working_directory', '')
+
+        # 配置了可用的 cgroup v2 根目录时，应用在自己的 cgroup 中运行
+        cgroup = None
+        cgroup_root = get_cgroup_root()
+        if cgroup_root:
+            try:
+                cgroup = app_cgroup_path(cgroup_root, app_id, instance)
+                create_cgroup(cgroup)
+            except OSError as e:
+                logger.warning(f"创建 cgroup 失败，只使用进程组: {e}")
+                cgroup = None
+
+        if self.engine is not None:
+            try:
+                identity = self.engine.start(app_id, app_config, cgroup, instance, get_environment())
+                logger.info(f"应用已由监控引擎启动 PID: {identity['pid'] if identity else None}")
+                return True
+            except Exception as e:
+                logger.exception(f"监控引擎启动应用时出错: {e}")
+                return False
+
+        # 监控进程的参数
+        monitor_args = json.dumps({
+            'app_id': app_id,
+            'data_path': self.config_manager.am3_data_path,
+            'app_config': app_config,
+            'cgroup': cgroup,
+            'instance': instance,
+            'state_backend': self.config_manager.state_store.backend,
+        }, ensure_ascii=False)
 
         # 启动监控进程
         try:
             # 启动一个后台进程来运行监控脚本
+            # 监控进程在新的会话中运行，是进程组的组长，应用和它的子孙进程都在这个进程组里
+            monitor_cmdline = [sys.executable, '-m', 'am3.process.monitor', monitor_args]
             monitor_process = subprocess.Popen(
-                [sys.executable, '-c', monitor_script],
+                monitor_cmdline,
                 stdout=subprocess.DEVNULL,
                 stderr=subprocess.DEVNULL,
-                cwd=working_directory
+                cwd=working_directory,
+                # supervisor 守护进程中执行时，监控进程和应用使用发起命令的客户端的环境变量
+                env=get_environment(),
+                start_new_session=True,
             )
             logger.info(f"监控进程已启动 PID: {monitor_process.pid}")
-
-            # 记录监控进程的PID
-            with open(app_pid_file, 'w') as f:
-                f.write(str(monitor_process.pid))
-
-            return True
+            self._monitors.append(monitor_process)
+
+            # 记录监控进程的身份，之后用它判断应用是否在运行，不会被复用的PID误导
+            identity = process_identity(monitor_process.pid, monitor_cmdline)
+            if identity is None:
+                logger.error(f"监控进程启动后立即退出: {app_config['name']}")
+                return False
+            identity['pgid'] = monitor_process.pid
+            if cgroup:
+                identity['cgroup'] = cgroup
+            return self.config_manager.set_app_process(app_id, identity, instance)
         except Exception as e:
             logger.exception(f"启动监控进程时出错: {e}")
             return False
-
-    def _create_monitor_script(self, app_config, cmd_str, restart_control,
-                              restart_check_delay, restart_keyword,
-                              restart_keyword_regex, restart_wait_time):
-        """创建监控脚本"""
-        # 获取应用配置
-        app_log_path = app_config.get('app_log_path', '')
-        working_directory = app_config.get('working_directory', '')
-
-        # 创建Python脚本内容
-        script = f"""
-import os
-import re
-import sys
-import time
-import subprocess
-from datetime import datetime
-
-# 设置工作目录
-os.chdir('{working_directory}')
-
-# 启动目标进程
-process = subprocess.Popen(
-    '{cmd_str}',
-    shell=True,
-    stdout=subprocess.PIPE,
-    stderr=subprocess.STDOUT,
-    encoding='utf-8',
-    universal_newlines=True
-)
-
-# 记录启动时间
-begin_time = datetime.now()
-
-# 打开日志文件
-log_file = open('{app_log_path}', 'a')
-log_file.write(f"\\n\\n--- 进程启动于 {{datetime.now()}} ---\\n")
-log_file.flush()
-
-# 监控进程输出
-restart_needed = False
-try:
-    for line in iter(process.stdout.readline, ""):
-        # 写入日志
-        log_file.write(line)
-        log_file.flush()
-
-        # 检查是否需要重启
-        if {restart_control} and int((datetime.now() - begin_time).seconds) > {restart_check_delay}:
-            # 检查关键字
-            restart_keywords = {restart_keyword}
-            for keyword in restart_keywords:
-                if keyword in line:
-                    log_file.write(f"输出匹配关键字 '{{keyword}}'，需要重启\\n")
-                    log_file.flush()
-                    process.kill()
-                    restart_needed = True
-                    break
-
-            # 检查正则表达式
-            if not restart_needed:
-                restart_regex = {restart_keyword_regex}
-                for pattern in restart_regex:
-                    if re.search(pattern, line):
-                        log_file.write(f"输出匹配正则 '{{pattern}}'，需要重启\\n")
-                        log_file.flush()
-                        process.kill()
-                        restart_needed = True
-                        break
-
-            if restart_needed:
-                break
-except Exception as e:
-    log_file.write(f"监控进程出错: {{e}}\\n")
-    log_file.flush()
-
-# 关闭文件句柄
-process.stdout.close()
-return_code = process.wait()
-log_file.write(f"进程退出，返回码: {{return_code}}\\n")
-
-# 如果需要重启
-if restart_needed and {restart_control}:
-    log_file.write(f"等待 {restart_wait_time} 秒后自动重启应用\\n")
-    log_file.flush()
-    time.sleep({restart_wait_time})
-
-    # 重新启动进程
-    os.execv(sys.executable, [sys.executable, '-c', __file__])
-
-log_file.close()
-"""
-        return script
-
-
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+重启策略模块
+决定应用需要重启(匹配到重启关键字，或开启 restart_on_failure 后以非零返回码退出)时等待多久，以及是否还应该重启:
+- 等待时间从 restart_wait_time 开始按 restart_backoff 倍数指数增长，最多 restart_max_wait_time 秒，
+  并加上 ±restart_jitter 比例的随机抖动，避免多个应用同时重启
+- restart_window 秒内最多重启 restart_limit 次，超过后不再重启，应用进入 errored 状态
+- 应用稳定运行超过 restart_stable_time 秒后，等待时间和重启计数都重新开始
+"""
+import time
+import random
+from collections import deque
+
+DEFAULT_BACKOFF = 2
+DEFAULT_MAX_WAIT_TIME = 60
+DEFAULT_JITTER = 0.1
+DEFAULT_LIMIT = 10
+DEFAULT_WINDOW = 600
+DEFAULT_STABLE_TIME = 60
+
+
+class RestartPolicy:
+    """一个应用(实例)的重启策略，在监控进程中跨多次运行保存状态"""
+
+    def __init__(self, app_config):
+        self.wait_time = max(float(app_config.get('restart_wait_time', 1)), 0)
+        self.backoff = max(float(app_config.get('restart_backoff', DEFAULT_BACKOFF)), 1)
+        self.max_wait_time = max(float(app_config.get('restart_max_wait_time', DEFAULT_MAX_WAIT_TIME)),
+                                 self.wait_time)
+        self.jitter = min(max(float(app_config.get('restart_jitter', DEFAULT_JITTER)), 0), 1)
+        self.limit = int(app_config.get('restart_limit', DEFAULT_LIMIT))
+        self.window = float(app_config.get('restart_window', DEFAULT_WINDOW))
+        self.stable_time = float(app_config.get('restart_stable_time', DEFAULT_STABLE_TIME))
+        # 连续的不稳定重启次数，决定等待时间
+        self.attempts = 0
+        # 时间窗口内每次重启的时间
+        self._restarts = deque()
+
+    def next_wait(self, uptime, now=None):
+        """应用运行了 uptime 秒后需要重启，返回等待的秒数，超过重启次数限制时返回None"""
+        now = time.monotonic() if now is None else now
+        if uptime >= self.stable_time:
+            self.reset()
+        while self._restarts and now - self._restarts[0] >= self.window:
+            self._restarts.popleft()
+        if self.limit > 0 and len(self._restarts) >= self.limit:
+            return None
+        self._restarts.append(now)
+
+        wait_time = self.wait_time * self.backoff ** self.attempts
+        # 达到最长等待时间后不再增长，不限制重启次数时也不会溢出
+        if wait_time < self.max_wait_time:
+            self.attempts += 1
+        if self.jitter:
+            wait_time *= 1 + random.uniform(-self.jitter, self.jitter)
+        return min(wait_time, self.max_wait_time)
+
+    def reset(self):
+        self.attempts = 0
+        self._restarts.clear()
+
+    def describe_limit(self):
+        return f'{self.window:g} 秒内重启超过 {self.limit} 次'
+
+
+if __name__ == '__main__':
+    policy = RestartPolicy({'restart_wait_time': 1, 'restart_limit': 5, 'restart_window': 600})
+    print([policy.next_wait(uptime=0.5, now=i) for i in range(7)])
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+cgroup v2 工具
+环境变量 AM3_CGROUP_ROOT 指向一个委派给当前用户的 cgroup v2 目录时(例如 systemd 服务设置了 Delegate=yes)，
+每个应用的监控进程会把自己放进 <AM3_CGROUP_ROOT>/app-<app_id>，应用和它的所有子孙进程都会留在这个 cgroup 里，
+两次 fork 或者 setsid 脱离进程组的进程也跑不掉
+
+停止应用时直接杀掉整个 cgroup，进程列表和资源统计也直接从 cgroup 读取，不需要遍历进程树
+"""
+import os
+import time
+import signal
+
+CGROUP_ROOT_ENV = 'AM3_CGROUP_ROOT'
+
+
+def get_cgroup_root():
+    """可用的 cgroup v2 根目录，没有配置或者不可写时返回None"""
+    root = os.environ.get(CGROUP_ROOT_ENV)
+    if not root:
+        return None
+    if not os.path.exists(os.path.join(root, 'cgroup.procs')) or not os.access(root, os.W_OK):
+        return None
+    return root
+
+
+def app_cgroup_path(root, app_id, instance=0):
+    """应用的 cgroup 路径，多实例的应用每个实例一个 cgroup"""
+    return os.path.join(root, f'app-{app_id}.{instance}' if instance else f'app-{app_id}')
+
+
+def create_cgroup(path):
+    os.makedirs(path, exist_ok=True)
+
+
+def join_cgroup(path, pid):
+    """把进程移入 cgroup，之后它创建的进程都会在这个 cgroup 里"""
+    with open(os.path.join(path, 'cgroup.procs'), 'w') as f:
+        f.write(str(pid))
+
+
+def cgroup_pids(path):
+    """cgroup 中所有进程的 pid，cgroup 不存在时返回空列表"""
+    try:
+        with open(os.path.join(path, 'cgroup.procs')) as f:
+            return [int(line) for line in f.read().split()]
+    except OSError:
+        return []
+
+
+def cgroup_populated(path):
+    """cgroup 及其子 cgroup 中是否还有进程"""
+    try:
+        with open(os.path.join(path, 'cgroup.events')) as f:
+            for line in f:
+                key, value = line.split()
+                if key == 'populated':
+                    return value == '1'
+    except OSError:
+        return False
+    return bool(cgroup_pids(path))
+
+
+def cgroup_stats(path):
+    """cgroup 的资源统计: CPU 时间(秒)和内存(字节)，没有启用对应控制器时为None"""
+    stats = {'cpu_time': None, 'memory': None}
+    try:
+        with open(os.path.join(path, 'cpu.stat')) as f:
+            for line in f:
+                key, value = line.split()
+                if key == 'usage_usec':
+                    stats['cpu_time'] = int(value) / 1000000
+    except OSError:
+        pass
+    try:
+        with open(os.path.join(path, 'memory.current')) as f:
+            stats['memory'] = int(f.read())
+    except (OSError, ValueError):
+        pass
+    return stats
+
+
+def _wait_empty(path, timeout, interval=0.1):
+    deadline = time.monotonic() + timeout
+    while cgroup_populated(path):
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(interval)
+    return True
+
+
+def kill_cgroup(path, timeout, kill_wait=1):
+    """停止 cgroup 中的所有进程: 先 SIGTERM，timeout 秒后 SIGKILL，最后删除 cgroup
+
+    Returns:
+        (收到 SIGKILL 的 pid 列表, SIGKILL 后仍未退出的 pid 列表)
+    """
+    for pid in cgroup_pids(path):
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    killed = []
+    if not _wait_empty(path, timeout):
+        killed = cgroup_pids(path)
+        kill_file = os.path.join(path, 'cgroup.kill')
+        if os.path.exists(kill_file):
+            # Linux 5.14+ 一次写入就能杀掉整个 cgroup，期间新 fork 的进程也不会漏掉
+            with open(kill_file, 'w') as f:
+                f.write('1')
+        else:
+            for pid in killed:
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+        _wait_empty(path, kill_wait)
+
+    survivors = cgroup_pids(path)
+    if not survivors:
+        try:
+            os.rmdir(path)
+        except OSError:
+            pass
+    return killed, survivors
+
+
+if __name__ == '__main__':
+    root = get_cgroup_root()
+    print(f'{CGROUP_ROOT_ENV}={os.environ.get(CGROUP_ROOT_ENV)}', '可用' if root else '不可用')
+    if root:
+        print(cgroup_pids(root), cgroup_stats(root))
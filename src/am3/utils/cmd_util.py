@@ -1,4 +1,5 @@
 import os
+import shlex
 import shutil
 
 import click
@@ -23,6 +24,7 @@ import click
 @click.option('--app_pid_file', required=False, help='pid文件路径', default='')
 @click.option('--params', required=False, help='命令参数', default='')
 @click.option('--update_script', required=False, help='更新脚本', default='')
+@click.option('--shell', required=False, help='通过 shell 执行命令', is_flag=True, default=False)
 def parse_args(**args):
     """
     解析启动的命令行参数
@@ -50,5 +52,25 @@ def guess_interpreter(target):
         return 'python', 'Python 程序'
 
 
+def build_command(interpreter, start, params, shell=False):
+    """构建应用的启动命令
+
+    默认返回 argv 列表，直接 exec 应用，不经过 /bin/sh: 少启动一个 shell 进程，记录的 pid 就是应用本身，
+    路径中有空格也不需要转义。interpreter 和 params 按 shell 的规则拆分，可以带引号
+    shell 为True时返回拼接好的字符串，需要用 shell=True 执行，可以使用管道、重定向和环境变量
+    """
+    if shell:
+        cmd = [interpreter, start] if interpreter else [start]
+        if params:
+            cmd.append(params)
+        return ' '.join(cmd)
+    argv = shlex.split(interpreter) if interpreter else []
+    argv.append(start)
+    if params:
+        argv.extend(shlex.split(params))
+    return argv
+
+
 if __name__ == '__main__':
+    print(build_command('python3 -u', '/opt/my app/main.py', '--name "hello world"'))
     print(parse_args(standalone_mode=False))
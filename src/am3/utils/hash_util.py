@@ -0,0 +1,40 @@
+import json
+import hashlib
+
+# 计算状态哈希时忽略的顶层字段
+STATE_HASH_IGNORED_KEYS = ('apps', 'system_boot_time', 'generation', 'apps_digest')
+
+
+def canonical_json(data):
+    """规范化的 JSON 字符串，键排序、无多余空白，相同内容得到相同字符串"""
+    return json.dumps(data, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+
+
+def canonical_hash(data):
+    """内容哈希"""
+    return hashlib.sha256(canonical_json(data).encode('utf-8')).hexdigest()
+
+
+def app_digest(app_id, app):
+    """单个应用配置的摘要，只包含 app_conf，运行时信息的变化不影响摘要"""
+    content = canonical_json([str(app_id), app.get('app_conf', {})])
+    return int.from_bytes(hashlib.sha256(content.encode('utf-8')).digest(), 'big')
+
+
+def apps_digest(apps):
+    """所有应用摘要的异或，增删改一个应用时只需异或出旧摘要、异或入新摘要"""
+    digest = 0
+    for app_id, app in apps.items():
+        digest ^= app_digest(app_id, app)
+    return digest
+
+
+def state_hash(digest, status_data):
+    """由应用摘要和其余顶层字段得到整个状态的哈希"""
+    meta = {key: value for key, value in status_data.items() if key not in STATE_HASH_IGNORED_KEYS}
+    return canonical_hash([f'{digest:064x}', meta])
+
+
+if __name__ == '__main__':
+    apps = {'0': {'app_conf': {'start': 'a'}}, '1': {'app_conf': {'start': 'b'}}}
+    print(state_hash(apps_digest(apps), {'version': '1.1.0', 'apps': apps}))
@@ -0,0 +1,53 @@
+import csv
+import sys
+import json
+
+# 机器可读的输出格式
+OUTPUT_FORMATS = ('json', 'jsonl', 'csv', 'tsv')
+
+
+class RowWriter:
+    """逐行输出记录，不需要先构建整个表格，也不带颜色
+
+    json 输出一个数组，jsonl 每行一个对象，csv/tsv 第一行为表头
+    """
+
+    def __init__(self, output_format, fields, stream=None):
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f'不支持的输出格式: {output_format}')
+        self.output_format = output_format
+        self.fields = fields
+        self.stream = stream or sys.stdout
+        self._count = 0
+        self._csv_writer = None
+
+        if output_format in ('csv', 'tsv'):
+            self._csv_writer = csv.writer(self.stream, delimiter=',' if output_format == 'csv' else '\t',
+                                          lineterminator='\n')
+            self._csv_writer.writerow(fields)
+        elif output_format == 'json':
+            self.stream.write('[')
+
+    def write(self, row):
+        """输出一条记录，row 为字典，只输出 fields 中的字段"""
+        if self._csv_writer is not None:
+            self._csv_writer.writerow(['' if row.get(field) is None else row.get(field) for field in self.fields])
+        else:
+            data = json.dumps({field: row.get(field) for field in self.fields}, ensure_ascii=False)
+            if self.output_format == 'json':
+                self.stream.write(('\n' if self._count == 0 else ',\n') + data)
+            else:
+                self.stream.write(data + '\n')
+        self._count += 1
+
+    def close(self):
+        if self.output_format == 'json':
+            self.stream.write('\n]\n' if self._count else ']\n')
+        self.stream.flush()
+
+
+if __name__ == '__main__':
+    for output_format in OUTPUT_FORMATS:
+        writer = RowWriter(output_format, ['app_id', 'name'])
+        writer.write({'app_id': '0', 'name': 'demo'})
+        writer.close()
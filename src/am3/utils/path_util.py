@@ -1,8 +1,29 @@
 import os
 import platform
+import contextvars
 
 system = platform.system()
 
+# 当前命令的工作目录，supervisor 守护进程执行客户端的命令时设置为客户端的工作目录，不切换整个进程的工作目录
+working_directory = contextvars.ContextVar('working_directory', default=None)
+# 当前命令的环境变量，supervisor 守护进程执行客户端的命令时设置为客户端的环境变量，启动的应用使用它而不是守护进程的
+environment = contextvars.ContextVar('environment', default=None)
+
+
+def get_working_directory():
+    """当前命令的工作目录，没有设置时为进程的工作目录"""
+    return working_directory.get() or os.getcwd()
+
+
+def get_environment():
+    """当前命令的环境变量，没有设置时为None，表示使用进程自己的环境变量"""
+    return environment.get()
+
+
+def resolve_path(file_path):
+    """相对路径按当前命令的工作目录转换为绝对路径"""
+    return os.path.normpath(os.path.join(get_working_directory(), os.path.expanduser(file_path)))
+
 
 def format_path(file_path):
     """
@@ -18,7 +39,7 @@ def format_path(file_path):
 
     if ('\\') in file_path or ('/') in file_path:
         # 使用绝对路径找文件
-        file_path = os.path.abspath(file_path)
+        file_path = resolve_path(file_path)
     else:
         # 使用PATH找文件
         pass
@@ -1,23 +1,371 @@
+import os
+import time
+import signal
+import hashlib
+from collections import namedtuple
+
 import psutil
 from loguru import logger
 
+from am3.utils.cgroup_util import cgroup_pids
+
+# 停止进程时 SIGTERM 后等待的秒数，超时后发送 SIGKILL
+DEFAULT_KILL_TIMEOUT = 5
+# SIGKILL 后再等待的秒数，仍未退出的进程(比如卡在不可中断的IO里)会报告给调用方
+SIGKILL_WAIT = 1
+# 等待进程退出时每次检查的间隔
+WAIT_SLICE = 0.1
+
+# 进程创建时间允许的误差，系统时间校准后 psutil 计算出的创建时间可能有细微变化
+CREATE_TIME_TOLERANCE = 1.0
+
+# 进程表快照中每个进程的信息，cpu_time 为用户态和内核态 CPU 时间之和(秒)，rss 为字节
+ProcessInfo = namedtuple('ProcessInfo', ['ppid', 'pgid', 'create_time', 'zombie', 'cpu_time', 'rss', 'threads'])
+
+
+def cmdline_hash(cmdline):
+    """命令行的指纹"""
+    return hashlib.sha1('\0'.join(cmdline).encode('utf-8')).hexdigest()
+
+
+def process_identity(pid, cmdline=None):
+    """进程的身份: pid、创建时间和命令行指纹，进程不存在时返回None
+
+    刚启动的子进程可能还没有执行 exec，这时读到的命令行是空的，
+    调用方知道启动参数时应通过 cmdline 传入
+    """
+    try:
+        process = psutil.Process(pid)
+        with process.oneshot():
+            return {
+                'pid': pid,
+                'create_time': process.create_time(),
+                'cmdline_hash': cmdline_hash(cmdline if cmdline is not None else process.cmdline()),
+            }
+    except psutil.Error:
+        return None
+
+
+def is_same_process(identity):
+    """identity 对应的进程是否还在运行，pid 被其他进程复用时返回False"""
+    try:
+        process = psutil.Process(identity['pid'])
+        with process.oneshot():
+            if abs(process.create_time() - identity['create_time']) > CREATE_TIME_TOLERANCE:
+                return False
+            if process.status() == psutil.STATUS_ZOMBIE:
+                return False
+            return cmdline_hash(process.cmdline()) == identity['cmdline_hash']
+    except psutil.Error:
+        return False
+
+
+def _pid_cmdline_hash(pid):
+    """进程命令行的指纹，结果和 cmdline_hash(psutil.Process(pid).cmdline()) 一致
+
+    Linux 上直接读取 /proc/<pid>/cmdline，参数以 \0 分隔的常见情况不需要创建 psutil.Process
+    """
+    if os.path.isdir('/proc'):
+        with open(f'/proc/{pid}/cmdline', 'rb') as f:
+            data = f.read()
+        # 修改过进程标题的进程参数可能以空格分隔，交给 psutil 处理
+        if data.endswith(b'\0') and (data.count(b'\0') > 1 or b' ' not in data):
+            try:
+                data[:-1].decode('utf-8')
+                return hashlib.sha1(data[:-1]).hexdigest()
+            except UnicodeDecodeError:
+                pass
+    return cmdline_hash(psutil.Process(pid).cmdline())
+
+
+def _scan_proc():
+    """直接读取 /proc/<pid>/stat，返回 {pid: ProcessInfo}，一次读取就能得到所有字段"""
+    boot_time = psutil.boot_time()
+    clock_ticks = os.sysconf('SC_CLK_TCK')
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    processes = {}
+    for entry in os.scandir('/proc'):
+        if not entry.name.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry.name}/stat', 'rb') as f:
+                data = f.read()
+        except OSError:
+            # 遍历期间退出的进程
+            continue
+        # 进程名可能包含空格和括号，从最后一个右括号之后开始解析
+        fields = data[data.rfind(b')') + 2:].split()
+        processes[int(entry.name)] = ProcessInfo(
+            ppid=int(fields[1]),
+            pgid=int(fields[2]),
+            create_time=boot_time + int(fields[19]) / clock_ticks,
+            zombie=fields[0] == b'Z',
+            cpu_time=(int(fields[11]) + int(fields[12])) / clock_ticks,
+            rss=int(fields[21]) * page_size,
+            threads=int(fields[17]),
+        )
+    return processes
+
+
+def _scan_psutil():
+    """没有 /proc 的系统使用 psutil 遍历进程，返回格式和 _scan_proc() 相同"""
+    processes = {}
+    # process_iter 在 oneshot() 中一次取出所有属性
+    attrs = ['ppid', 'create_time', 'status', 'cpu_times', 'memory_info', 'num_threads']
+    for process in psutil.process_iter(attrs):
+        info = process.info
+        if info['create_time'] is None:
+            continue
+        cpu_times, memory_info = info['cpu_times'], info['memory_info']
+        try:
+            pgid = os.getpgid(process.pid)
+        except OSError:
+            pgid = None
+        processes[process.pid] = ProcessInfo(
+            ppid=info['ppid'],
+            pgid=pgid,
+            create_time=info['create_time'],
+            zombie=info['status'] == psutil.STATUS_ZOMBIE,
+            cpu_time=cpu_times.user + cpu_times.system if cpu_times else 0.0,
+            rss=memory_info.rss if memory_info else 0,
+            threads=info['num_threads'] or 0,
+        )
+    return processes
+
+
+class ProcessTable:
+    """进程表的快照
+
+    一次遍历所有进程得到创建时间、状态和父子关系，之后判断多个应用是否运行、
+    查找进程树都只查这个快照，只有创建时间一致时才读取命令行
+
+    定时刷新时可以传入上一个快照的 cmdline_cache，pid 和创建时间都相同的进程是同一个进程，
+    不需要再次读取命令行
+    """
+
+    def __init__(self, cmdline_cache=None):
+        self._previous_cmdline_cache = cmdline_cache or {}
+        self.cmdline_cache = {}
+        self._processes = _scan_proc() if os.path.isdir('/proc') else _scan_psutil()
+        self._children = {}
+        self._groups = {}
+        for pid, info in self._processes.items():
+            self._children.setdefault(info.ppid, []).append(pid)
+            if not info.zombie:
+                self._groups.setdefault(info.pgid, []).append(pid)
+
+    def pid_exists(self, pid):
+        return pid in self._processes
+
+    def get(self, pid):
+        """进程的 ProcessInfo，进程不存在时返回None"""
+        return self._processes.get(pid)
+
+    def is_same_process(self, identity):
+        """和 is_same_process() 相同，只是进程信息来自快照"""
+        info = self._processes.get(identity['pid'])
+        if info is None:
+            return False
+        if info.zombie or abs(info.create_time - identity['create_time']) > CREATE_TIME_TOLERANCE:
+            return False
+        key = (identity['pid'], info.create_time)
+        digest = self._previous_cmdline_cache.get(key)
+        if digest is None:
+            try:
+                digest = _pid_cmdline_hash(identity['pid'])
+            except (OSError, psutil.Error):
+                return False
+        self.cmdline_cache[key] = digest
+        return digest == identity['cmdline_hash']
+
+    def tree(self, pid):
+        """pid 和它所有子孙进程的 pid 列表"""
+        pids = [pid]
+        index = 0
+        while index < len(pids):
+            pids.extend(self._children.get(pids[index], []))
+            index += 1
+        return pids
+
+    def group(self, pgid):
+        """进程组中所有没有退出的进程的 pid 列表"""
+        return list(self._groups.get(pgid, []))
+
+    def members(self, identity):
+        """应用的所有进程，监控进程排在第一个
 
-def kill_process_and_all_child(parent_pid):
+        在 cgroup 或独立进程组中启动的应用直接读取 cgroup / 进程组的成员，
+        脱离了进程树的子孙进程也能统计到，旧版本启动的应用才遍历进程树
+        """
+        pid = identity['pid']
+        if identity.get('cgroup'):
+            pids = [member for member in cgroup_pids(identity['cgroup']) if member in self._processes]
+        elif identity.get('pgid') is not None:
+            pids = self.group(identity['pgid'])
+        else:
+            return self.tree(pid)
+        return [pid] + [member for member in pids if member != pid]
+
+
+def count_fds(pid):
+    """进程打开的文件描述符数量，没有权限时返回None"""
+    try:
+        if os.path.isdir('/proc'):
+            return len(os.listdir(f'/proc/{pid}/fd'))
+        return psutil.Process(pid).num_fds()
+    except (OSError, psutil.Error, AttributeError):
+        return None
+
+
+def _still_running(processes):
+    """过滤掉已经退出的进程，僵尸进程已经退出，只是还没有被父进程回收"""
+    running = []
+    for process in processes:
+        try:
+            if process.status() != psutil.STATUS_ZOMBIE:
+                running.append(process)
+        except psutil.NoSuchProcess:
+            continue
+    return running
+
+
+def _wait_exit(processes, timeout):
+    """一起等待多个进程退出，返回超时后仍在运行的进程
+
+    分段调用 psutil.wait_procs，它会回收自己的子进程；
+    其他进程退出后由它们的父进程或 init 回收，变成僵尸进程时就认为已经退出，不用等到被回收
+    """
+    deadline = time.monotonic() + timeout
+    alive = _still_running(processes)
+    while alive:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        _, alive = psutil.wait_procs(alive, timeout=min(WAIT_SLICE, remaining))
+        alive = _still_running(alive)
+    return alive
+
+
+def process_group_exists(pgid):
+    """进程组中是否还有没有退出的进程
+
+    先用 killpg(pgid, 0) 判断，没有任何成员时不需要遍历进程；
+    还有成员时可能只剩下等待回收的僵尸进程，这时才遍历 /proc 确认
+    """
+    try:
+        os.killpg(pgid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return bool(ProcessTable().group(pgid))
+
+
+def in_process_group(pid, pgid):
+    """进程是否还在进程组中且没有退出，只读取这一个进程的信息"""
+    try:
+        return os.getpgid(pid) == pgid and psutil.Process(pid).status() != psutil.STATUS_ZOMBIE
+    except (OSError, psutil.Error):
+        return False
+
+
+def _wait_group_exit(pgid, timeout):
+    """等待进程组中的进程全部退出
+
+    killpg(pgid, 0) 成功时可能只剩下僵尸进程，只在开始时和已知的成员都退出后遍历一次 /proc 找到成员，
+    之后每次等待只检查这些成员
+    """
+    deadline = time.monotonic() + timeout
+    members = []
+    while True:
+        try:
+            os.killpg(pgid, 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+        members = [pid for pid in members if in_process_group(pid, pgid)]
+        if not members:
+            members = ProcessTable().group(pgid)
+            if not members:
+                return True
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(WAIT_SLICE)
+
+
+def kill_process_group(pgid, timeout=DEFAULT_KILL_TIMEOUT):
+    """停止整个进程组: 一次 killpg 发送 SIGTERM，timeout 秒后仍有进程时 killpg 发送 SIGKILL
+
+    不需要遍历进程树，中途被托管给 init 的子孙进程只要还在这个进程组里也会被停止
+
+    Returns:
+        (收到 SIGKILL 的 pid 列表, SIGKILL 后仍未退出的 pid 列表)
+    """
+    try:
+        os.killpg(pgid, signal.SIGTERM)
+    except ProcessLookupError:
+        logger.info(f'进程组 {pgid} 不存在')
+        return [], []
+
+    if _wait_group_exit(pgid, timeout):
+        return [], []
+
+    killed = ProcessTable().group(pgid)
+    logger.warning(f'进程组 {pgid} 中的进程 {killed} 在 {timeout} 秒内没有退出，发送 SIGKILL')
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except ProcessLookupError:
+        return killed, []
+    if _wait_group_exit(pgid, SIGKILL_WAIT):
+        return killed, []
+
+    survivors = ProcessTable().group(pgid)
+    logger.error(f'进程组 {pgid} 中的进程 {survivors} 在 SIGKILL 后仍未退出')
+    return killed, survivors
+
+
+def kill_process_and_all_child(parent_pid, timeout=DEFAULT_KILL_TIMEOUT):
+    """停止进程以及所有子孙进程
+
+    先向整个进程树发送 SIGTERM，所有进程一起等待 timeout 秒，仍未退出的进程发送 SIGKILL
+
+    Returns:
+        (收到 SIGKILL 的 pid 列表, SIGKILL 后仍未退出的 pid 列表)
+    """
     parent_pid = int(parent_pid)
-    # 杀掉进程以及所有子进程
-    child_pids = []
-    # 检查进程是否存在
-    if psutil.pid_exists(parent_pid):
+    try:
         parent = psutil.Process(parent_pid)
-        for child in parent.children(recursive=True):
-            child_pids.append(int(child.pid))
-        all_pids = [parent_pid, ] + child_pids
-        logger.info(f'杀死pid {all_pids}')
-        for pid in all_pids:
+        # 先取得整个进程树，父进程退出后子进程会被托管给 init，就找不到了
+        processes = [parent] + parent.children(recursive=True)
+    except psutil.NoSuchProcess:
+        logger.info(f'父级进程 {parent_pid} 不存在')
+        return [], []
+
+    logger.info(f'停止pid {[process.pid for process in processes]}')
+    for process in processes:
+        try:
+            process.terminate()
+        except psutil.NoSuchProcess:
+            pass
+        except psutil.Error as e:
+            logger.info(f'报错 {e}')
+
+    alive = _wait_exit(processes, timeout)
+    killed = []
+    if alive:
+        killed = [process.pid for process in alive]
+        logger.warning(f'进程 {killed} 在 {timeout} 秒内没有退出，发送 SIGKILL')
+        for process in alive:
             try:
-                logger.info(f'进程 {pid} 存在 {psutil.pid_exists(pid)}')
-                psutil.Process(pid).terminate()
-            except Exception as e:
+                process.kill()
+            except psutil.NoSuchProcess:
+                pass
+            except psutil.Error as e:
                 logger.info(f'报错 {e}')
-    else:
-        logger.info(f'父级进程 {parent_pid} 不存在')
+        alive = _wait_exit(alive, SIGKILL_WAIT)
+
+    survivors = [process.pid for process in alive]
+    if survivors:
+        logger.error(f'进程 {survivors} 在 SIGKILL 后仍未退出')
+    return killed, survivors
@@ -0,0 +1,23 @@
+import os
+import sys
+import subprocess
+
+import pytest
+
+
+@pytest.fixture
+def am(tmp_path):
+    """在独立的 HOME 中执行 am 命令，返回 CompletedProcess，测试结束时停止守护进程和所有应用"""
+    home = tmp_path / 'home'
+    home.mkdir()
+    base_env = {**os.environ, 'HOME': str(home)}
+
+    def run(*args, env=None, cwd=None, check=True):
+        return subprocess.run([sys.executable, '-m', 'am3.am', *args], env={**base_env, **(env or {})},
+                              cwd=cwd or tmp_path, capture_output=True, text=True, timeout=60, check=check)
+
+    run.home = home
+    run.path = tmp_path
+    yield run
+    run('stop', 'all', check=False)
+    run('daemon', 'stop', check=False)
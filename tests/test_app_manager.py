@@ -0,0 +1,28 @@
+import time
+import threading
+
+from am3.config.manager import ConfigManager
+from am3.core.app_manager import AppManager
+
+
+def test_run_bulk_reports_hung_apps_as_failed_after_timeout(tmp_path, monkeypatch, capsys):
+    """卡住的应用超时后记为失败，不等待它的线程，也不占用并行数量"""
+    monkeypatch.setenv('HOME', str(tmp_path))
+    app_manager = AppManager(ConfigManager())
+    hang = threading.Event()
+
+    def action(app_id):
+        if app_id.startswith('hung'):
+            hang.wait()
+        return True
+
+    begin = time.monotonic()
+    success = app_manager._run_bulk(action, ['hung-1', 'hung-2', 'ok-1', 'ok-2'], 2, '停止', timeout=0.5)
+    elapsed = time.monotonic() - begin
+    hang.set()
+
+    assert success == 2
+    assert elapsed < 2
+    output = capsys.readouterr().out
+    assert '应用 ID: hung-1 停止失败 (超过 0.5 秒未完成)' in output
+    assert '应用 ID: ok-2 停止成功' in output
@@ -0,0 +1,61 @@
+import subprocess
+
+import pytest
+from click.testing import CliRunner
+
+from am3.cli import client
+from am3.cli.commands import cli
+from am3.cli.context import LazyContext
+from am3.config.manager import ConfigManager
+from am3.core.app_manager import AppManager
+from am3.core.status_board import StatusPublisher
+from am3.utils import process_util
+from am3.utils.process_util import process_identity
+
+
+@pytest.fixture
+def published(tmp_path, monkeypatch):
+    """注册一个运行中的应用并在当前进程中发布状态表，读取方检查写入方 PID 时视为守护进程在运行"""
+    monkeypatch.setenv('HOME', str(tmp_path))
+    config_manager = ConfigManager()
+    process = subprocess.Popen(['sleep', '60'])
+    _, app_ids = config_manager.register_many([{'name': 'board-app', 'start': 'run.sh', 'working_directory': '/tmp'}])
+    config_manager.set_app_process(app_ids[0], process_identity(process.pid, ['sleep', '60']))
+    publisher = StatusPublisher(AppManager(config_manager))
+    publisher.publish()
+    yield process
+    publisher.close()
+    process.kill()
+    process.wait()
+
+
+def no_scan(*args, **kwargs):
+    raise AssertionError('am list 在状态表有效时不应该遍历进程表')
+
+
+def no_forward(*args, **kwargs):
+    raise AssertionError('am list 在状态表有效时不应该连接守护进程')
+
+
+@pytest.mark.parametrize('args', [['list'], ['list', '-a'], ['list', '--format', 'csv']])
+def test_list_reads_fresh_board_without_scanning_proc(published, monkeypatch, args):
+    monkeypatch.setattr(process_util, '_scan_proc', no_scan)
+    monkeypatch.setattr(process_util, '_scan_psutil', no_scan)
+    monkeypatch.setattr(client, 'run_command', no_forward)
+
+    result = CliRunner().invoke(cli, args, obj=LazyContext())
+
+    assert result.exit_code == 0, result.output
+    assert 'board-app' in result.output
+    assert 'True' in result.output
+    if '-a' in args:
+        assert str(published.pid) in result.output
+
+
+def test_list_scans_proc_without_board(published, tmp_path):
+    (tmp_path / '.am3' / 'status.board').unlink()
+
+    result = CliRunner().invoke(cli, ['list', '--format', 'csv'], obj=LazyContext())
+
+    assert result.exit_code == 0, result.output
+    assert 'board-app,True,running' in result.output
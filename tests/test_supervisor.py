@@ -0,0 +1,29 @@
+import time
+
+import pytest
+
+APP = '''import os, time
+print('AM3_TEST_CLIENT=', os.environ.get('AM3_TEST_CLIENT'), flush=True)
+time.sleep(60)
+'''
+
+
+def wait_for_log(path, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if path.exists() and path.read_text():
+            return path.read_text()
+        time.sleep(0.1)
+    return path.read_text() if path.exists() else ''
+
+
+@pytest.mark.parametrize('engine', [False, True])
+def test_app_started_through_daemon_gets_client_environment(am, engine):
+    """守护进程启动的应用使用发起命令的客户端的环境变量，而不是守护进程的"""
+    (am.path / 'envapp.py').write_text(APP)
+    am('daemon', 'start', *(['--engine'] if engine else []))
+
+    am('start', '-s', 'envapp.py', '--name', 'envapp', env={'AM3_TEST_CLIENT': 'client'})
+
+    log = wait_for_log(am.home / '.am3' / 'logs' / 'envapp.log')
+    assert 'AM3_TEST_CLIENT= client' in log